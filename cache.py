@@ -0,0 +1,177 @@
+import os
+import uuid
+import threading
+import collections
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistChunkCache(object):
+    """Mist Chunk Cache
+
+    Keeps chunks retrieved from the network, keyed by the member and data
+    uid they came from. Recently used chunks are held in memory and every
+    chunk is also written to disk when a disk limit is set. Both tiers
+    evict the least recently used chunks once over their byte limit.
+    """
+
+    TMP_EXT = "tmp"
+
+    def __init__(self, memory_size=settings.CHUNK_CACHE_MEMORY_SIZE, disk_size=settings.CHUNK_CACHE_DISK_SIZE, disk_path=settings.CHUNK_CACHE_PATH):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.disk_path = disk_path
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._memory_used = 0
+        self._disk = collections.OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        if self.disk_size > 0:
+            self._LoadDisk()
+
+    @staticmethod
+    def _Key(member_uid, data_uid):
+        return (str(member_uid), str(data_uid))
+
+    def _DiskFilePath(self, key):
+        return os.path.join(self.disk_path, "%s_%s" % key)
+
+    def _LoadDisk(self):
+        if not os.path.isdir(self.disk_path):
+            os.makedirs(self.disk_path)
+            return
+        entries = []
+        for filename in os.listdir(self.disk_path):
+            file_path = os.path.join(self.disk_path, filename)
+            try:
+                (member_uid, data_uid) = filename.split("_")
+                key = MistChunkCache._Key(uuid.UUID(member_uid), uuid.UUID(data_uid))
+            except ValueError:
+                # Leftovers of interrupted writes are not valid keys.
+                os.remove(file_path)
+                continue
+            entries.append((os.path.getmtime(file_path), key, os.path.getsize(file_path)))
+        with self._lock:
+            for (_, key, size) in sorted(entries):
+                self._disk[key] = size
+                self._disk_used += size
+            self._EvictDisk()
+
+    def _EvictMemory(self):
+        while self._memory_used > self.memory_size and self._memory:
+            (_, data) = self._memory.popitem(last=False)
+            self._memory_used -= len(data)
+
+    def _EvictDisk(self):
+        while self._disk_used > self.disk_size and self._disk:
+            (key, size) = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(self._DiskFilePath(key))
+            except OSError as e:
+                logger.warning("Unable to remove cached chunk. Error: %s", e)
+
+    def _PutMemory(self, key, data):
+        if len(data) > self.memory_size:
+            return
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_used += len(data)
+        self._EvictMemory()
+
+    def Get(self, member_uid, data_uid):
+        """Returns the cached chunk, or None if it is not cached."""
+        return self.GetAny([member_uid], data_uid)
+
+    def GetAny(self, member_uids, data_uid):
+        """Returns the chunk cached for any of the members, or None."""
+        keys = [MistChunkCache._Key(member_uid, data_uid) for member_uid in member_uids]
+        on_disk = []
+        with self._lock:
+            for key in keys:
+                data = self._memory.pop(key, None)
+                if data is not None:
+                    self._memory[key] = data
+                    self.hits += 1
+                    return data
+            for key in keys:
+                if key in self._disk:
+                    self._disk[key] = self._disk.pop(key)
+                    on_disk.append(key)
+
+        data = None
+        for key in on_disk:
+            try:
+                with open(self._DiskFilePath(key), "rb") as infile:
+                    data = infile.read()
+                break
+            except IOError:
+                # Evicted while being read.
+                data = None
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._PutMemory(key, data)
+        return data
+
+    def Put(self, member_uid, data_uid, data):
+        key = MistChunkCache._Key(member_uid, data_uid)
+        with self._lock:
+            self._PutMemory(key, data)
+            if self.disk_size <= 0 or len(data) > self.disk_size or key in self._disk:
+                return
+
+        # Written under a temporary name so that a torn write is never
+        # mistaken for a cached chunk.
+        tmp_path = "%s.%s.%s" % (self._DiskFilePath(key), threading.current_thread().ident, MistChunkCache.TMP_EXT)
+        try:
+            with open(tmp_path, "wb") as outfile:
+                outfile.write(data)
+            os.rename(tmp_path, self._DiskFilePath(key))
+        except (IOError, OSError) as e:
+            logger.warning("Unable to cache chunk on disk. Error: %s", e)
+            return
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(data)
+                self._disk_used += len(data)
+                self._EvictDisk()
+
+    def Invalidate(self, member_uid, data_uid):
+        key = MistChunkCache._Key(member_uid, data_uid)
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory_used -= len(data)
+            size = self._disk.pop(key, None)
+            if size is not None:
+                self._disk_used -= size
+                try:
+                    os.remove(self._DiskFilePath(key))
+                except OSError as e:
+                    logger.warning("Unable to remove cached chunk. Error: %s", e)
+
+    def Stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_chunks": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_chunks": len(self._disk),
+                "disk_bytes": self._disk_used,
+            }
+
+
+shared_chunk_cache = MistChunkCache()
@@ -0,0 +1,92 @@
+import random
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _MakeGearTable(seed):
+    generator = random.Random(seed)
+    return tuple(generator.getrandbits(32) for i in range(256))
+
+
+class MistContentChunker(object):
+    """Mist Content Chunker class
+
+    Splits a stream into content defined chunks using a gear rolling hash.
+    A boundary only depends on the bytes just before it, so identical runs
+    of data give identical chunks no matter where they sit in a file.
+    """
+
+    MIN_CHUNK_SIZE = 256 * 1024
+    AVERAGE_CHUNK_BITS = 20
+    HASH_WINDOW_SIZE = 32
+    SCAN_SEGMENT_SIZE = 256 * 1024
+    GEAR_TABLE = _MakeGearTable(0x6d697374)
+
+    def __init__(self, max_chunk_size):
+        self.max_chunk_size = max_chunk_size
+        # Only the high bits of a gear hash depend on the whole window.
+        self._mask = ((1 << MistContentChunker.AVERAGE_CHUNK_BITS) - 1) << (32 - MistContentChunker.AVERAGE_CHUNK_BITS)
+        if numpy is not None:
+            self._gear_table = numpy.array(MistContentChunker.GEAR_TABLE, dtype=numpy.uint32)
+
+    def Chunks(self, infile):
+        buf = ""
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_chunk_size:
+                data = infile.read(self.max_chunk_size)
+                if data:
+                    buf += data
+                else:
+                    eof = True
+            if not buf:
+                return
+
+            boundary = self._FindBoundary(buf)
+            yield buf[:boundary]
+            buf = buf[boundary:]
+
+    def _FindBoundary(self, buf):
+        end = min(len(buf), self.max_chunk_size)
+        if end <= MistContentChunker.MIN_CHUNK_SIZE:
+            return end
+        if numpy is not None:
+            return self._FindBoundaryVectorized(buf, end)
+        return self._FindBoundaryRolling(buf, end)
+
+    def _FindBoundaryRolling(self, buf, end):
+        gear_table = MistContentChunker.GEAR_TABLE
+        mask = self._mask
+        data = bytearray(buffer(buf, 0, end))
+        h = 0
+        for i in xrange(MistContentChunker.MIN_CHUNK_SIZE - MistContentChunker.HASH_WINDOW_SIZE + 1, MistContentChunker.MIN_CHUNK_SIZE):
+            h = ((h << 1) + gear_table[data[i]]) & 0xFFFFFFFF
+        for i in xrange(MistContentChunker.MIN_CHUNK_SIZE, end):
+            h = ((h << 1) + gear_table[data[i]]) & 0xFFFFFFFF
+            if not h & mask:
+                return i + 1
+        return end
+
+    def _FindBoundaryVectorized(self, buf, end):
+        window = MistContentChunker.HASH_WINDOW_SIZE
+        data = numpy.frombuffer(buf, dtype=numpy.uint8, count=end)
+        for start in xrange(MistContentChunker.MIN_CHUNK_SIZE, end, MistContentChunker.SCAN_SEGMENT_SIZE):
+            stop = min(start + MistContentChunker.SCAN_SEGMENT_SIZE, end)
+            count = stop - start
+            gears = self._gear_table[data[start - window + 1:stop]]
+            # Same value as the rolling form: sum of gear[b[i-k]] << k over the window.
+            h = gears[window - 1:].copy()
+            for k in xrange(1, window):
+                h += gears[window - 1 - k:window - 1 - k + count] << numpy.uint32(k)
+            hits = numpy.flatnonzero((h & numpy.uint32(self._mask)) == 0)
+            if len(hits):
+                return start + int(hits[0]) + 1
+        return end
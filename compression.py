@@ -0,0 +1,85 @@
+import zlib
+import logging
+
+import settings
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistCompressionError(Exception):
+    pass
+
+
+class MistCompressor(object):
+    """Mist Compressor class
+
+    Compresses blocks before they are encrypted. A sample of every block is
+    compressed at the fastest level first, and blocks that do not shrink by
+    at least min_saving, like media or archives, are stored as they are.
+    Codec ids are written into block headers, so they must never change.
+    """
+
+    NO_CODEC = 0
+    ZLIB_CODEC = 1
+    LZMA_CODEC = 2
+    CODECS = {
+        "none": NO_CODEC,
+        "zlib": ZLIB_CODEC,
+        "lzma": LZMA_CODEC,
+    }
+
+    def __init__(self, codec=settings.COMPRESSION, level=settings.COMPRESSION_LEVEL, sample_size=settings.COMPRESSION_SAMPLE_SIZE, min_saving=settings.COMPRESSION_MIN_SAVING):
+        if codec not in MistCompressor.CODECS:
+            raise MistCompressionError("Unknown codec: %s" % codec)
+        self.codec = MistCompressor.CODECS[codec]
+        if self.codec == MistCompressor.LZMA_CODEC and lzma is None:
+            logger.warning("lzma is not available, compressing with zlib instead.")
+            self.codec = MistCompressor.ZLIB_CODEC
+        self.level = level
+        self.sample_size = sample_size
+        self.min_saving = min_saving
+
+    def _Shrinks(self, original, compressed):
+        return len(compressed) <= len(original) * (1 - self.min_saving)
+
+    def Compress(self, data):
+        """Returns the codec used and the compressed data."""
+        if self.codec == MistCompressor.NO_CODEC or not data:
+            return (MistCompressor.NO_CODEC, data)
+        sample = data[:self.sample_size]
+        if not self._Shrinks(sample, zlib.compress(sample, 1)):
+            return (MistCompressor.NO_CODEC, data)
+
+        if self.codec == MistCompressor.LZMA_CODEC:
+            compressed = lzma.compress(data, preset=self.level)
+        else:
+            compressed = zlib.compress(data, self.level)
+        if not self._Shrinks(data, compressed):
+            return (MistCompressor.NO_CODEC, data)
+        return (self.codec, compressed)
+
+    @staticmethod
+    def Decompress(codec, data):
+        try:
+            if codec == MistCompressor.NO_CODEC:
+                return data
+            elif codec == MistCompressor.ZLIB_CODEC:
+                return zlib.decompress(data)
+            elif codec == MistCompressor.LZMA_CODEC and lzma is not None:
+                return lzma.decompress(data)
+        except Exception as e:
+            raise MistCompressionError("Unable to decompress block. Codec: %s, Error: %s" % (codec, e))
+        raise MistCompressionError("Unsupported codec: %s" % codec)
+
+
+shared_compressor = MistCompressor()
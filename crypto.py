@@ -0,0 +1,158 @@
+import os
+import hmac
+import struct
+import hashlib
+import binascii
+import threading
+import multiprocessing
+import logging
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+import compression
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistCryptoError(Exception):
+    pass
+
+
+# Block headers pack the payload size with the cipher mode and compression
+# codec above it. Blocks written before either was recorded have zeros
+# there, which read as CBC and uncompressed.
+SIZE_BITS = 48
+MODE_SHIFT = 48
+CODEC_SHIFT = 56
+CBC_MODE = 0
+CTR_MODE = 1
+
+
+def PackHeader(size, mode, codec=compression.MistCompressor.NO_CODEC):
+    return struct.pack("<Q", size | mode << MODE_SHIFT | codec << CODEC_SHIFT)
+
+
+def UnpackHeader(header):
+    """Returns the size, cipher mode and compression codec in a block header."""
+    value = struct.unpack("<Q", header)[0]
+    return (value & ((1 << SIZE_BITS) - 1), (value >> MODE_SHIFT) & 0xFF, value >> CODEC_SHIFT)
+
+
+def _Cipher(mode, iv):
+    if mode == CTR_MODE:
+        return AES.new(settings.ENCRYPTION_KEY, AES.MODE_CTR, counter=Counter.new(128, initial_value=long(binascii.hexlify(iv), 16)))
+    elif mode == CBC_MODE:
+        return AES.new(settings.ENCRYPTION_KEY, AES.MODE_CBC, iv)
+    raise MistCryptoError("Unsupported cipher mode: %s" % mode)
+
+
+def Encrypt(data, iv):
+    """Encrypts data in CTR mode, which needs no padding."""
+    return _Cipher(CTR_MODE, iv).encrypt(data)
+
+
+def Decrypt(data, iv, mode, size):
+    if mode == CBC_MODE:
+        return _Cipher(mode, iv).decrypt(data)[:size]
+    return _Cipher(mode, iv).decrypt(data)
+
+
+def RandomIv():
+    return os.urandom(16)
+
+
+def EncryptBlock(data):
+    """Compresses and encrypts a block of a file.
+
+    The IV is a keyed hash of what is encrypted, so that identical blocks
+    encrypt identically and can be shared between files, and a counter is
+    only ever reused for the same payload.
+    """
+    (codec, payload) = compression.shared_compressor.Compress(data)
+    iv = hmac.new(settings.ENCRYPTION_KEY, payload, hashlib.sha256).digest()[:16]
+    return PackHeader(len(payload), CTR_MODE, codec) + iv + Encrypt(payload, iv)
+
+
+def DecryptBlock(encrypted_data):
+    header_size = struct.calcsize("Q")
+    (size, mode, codec) = UnpackHeader(encrypted_data[:header_size])
+    iv = encrypted_data[header_size:header_size + 16]
+    try:
+        data = Decrypt(encrypted_data[header_size + 16:], iv, mode, size)
+    except ValueError as e:
+        raise MistCryptoError("Corrupted block. Error: %s" % e)
+    if size != len(data):
+        raise MistCryptoError("Corrupted block due to size. Size in header: %s, Actual size: %s" % (size, len(data)))
+    try:
+        return compression.MistCompressor.Decompress(codec, data)
+    except compression.MistCompressionError as e:
+        raise MistCryptoError(str(e))
+
+
+class MistCryptoTask(object):
+    """A block being encrypted or decrypted by a MistCryptoEngine."""
+
+    def __init__(self, async_result=None, result=None, exception=None):
+        self._async_result = async_result
+        self._result = result
+        self._exception = exception
+
+    def Get(self):
+        if self._async_result is not None:
+            return self._async_result.get()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class MistCryptoEngine(object):
+    """Mist Crypto Engine
+
+    Encrypts and decrypts blocks on a pool of worker processes, so that
+    blocks are worked on by as many cores as there are workers. With a
+    single worker the work runs in the calling thread instead.
+
+    The workers are forked, so the pool should be started before any other
+    thread is, as a thread holding a lock while forking leaves it held in
+    the workers. It is otherwise started on first use.
+    """
+
+    def __init__(self, workers=settings.CRYPTO_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def Start(self):
+        if self.workers > 1:
+            self._Pool()
+
+    def _Pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers)
+            return self._pool
+
+    def RunAsync(self, func, *args):
+        """Starts func(*args) and returns a MistCryptoTask for its result."""
+        if self.workers <= 1:
+            try:
+                return MistCryptoTask(result=func(*args))
+            except Exception as e:
+                return MistCryptoTask(exception=e)
+        return MistCryptoTask(async_result=self._Pool().apply_async(func, args))
+
+    def Run(self, func, *args):
+        return self.RunAsync(func, *args).Get()
+
+    def Close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+shared_crypto_engine = MistCryptoEngine()
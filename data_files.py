@@ -1,11 +1,17 @@
-import uuid
+import hashlib
 import threading
 import copy
+import itertools
+import random
 import logging
 
 import network
+import merkle
 import mist_chunk
 import files
+import transfer
+import erasure
+import settings
 
 
 logging.basicConfig(level=logging.INFO)
@@ -14,50 +20,570 @@ logger = logging.getLogger(__name__)
 
 class MistNetworkDataFile(object):
 
-    def __init__(self, data, mist_network_address):
+    # Merkle root of the stored data, for members to prove they hold it.
+    # Data files stored before roots were kept have none.
+    merkle_root = None
+
+    def __init__(self, data, mist_network_address, content_hash=None, store=True):
         self.mist_network_address = mist_network_address
-        self.mist_network_member_uid = None
+        # Members holding a replica of the data.
+        self.mist_network_member_uids = []
         self.data_uid = None
+        self.content_hash = content_hash or hashlib.sha256(data).hexdigest()
+        self.references = 0
         self.size = len(data)
         self._data = data
-        self._creation_thread = threading.Thread(target=self._StoreDataFileOnNetwork, args=(self._data,))
-        self._creation_thread.start()
+        # Data files made with store set to False can be waited on straight
+        # away, but are only stored once the caller calls Store.
+        self._creation_task = transfer.MistTransferTask(self._StoreDataFileOnNetwork, (self._data,), {})
+        if store:
+            self.Store()
+
+    def Store(self):
+        transfer.shared_transfer_executor.SubmitTask(self._creation_task)
 
     def _StoreDataFileOnNetwork(self, data):
         if not self.data_uid:
             mist_network_client = network.MistNetworkClient(self.mist_network_address)
-            (self.mist_network_member_uid, self.data_uid) = mist_network_client.StoreDataOnNetwork(data)
-            self._data = None
+            self._SetStored(*mist_network_client.StoreDataOnNetwork(data))
+
+    def _SetStored(self, mist_network_member_uids, data_uid):
+        self.merkle_root = merkle.MistMerkleTree.FromData(self._data).Root()
+        (self.mist_network_member_uids, self.data_uid) = (mist_network_member_uids, data_uid)
+        self._data = None
+
+    def WaitUntilStored(self, timeout=None):
+        if self._creation_task:
+            return self._creation_task.Wait(timeout)
+        return True
+
+    def StoreFailed(self):
+        """Returns whether storing the data on the network failed."""
+        creation_task = self._creation_task
+        return creation_task is not None and creation_task.Done() and creation_task.exception is not None
+
+    def RetryStore(self):
+        """Stores the data after a failed attempt. Returns whether it is stored now."""
+        try:
+            self._StoreDataFileOnNetwork(self._data)
+        except Exception as e:
+            logger.warning("Unable to store data file. Content hash: %s, Error: %s", self.content_hash, e)
+            return False
+        self._creation_task = None
+        return True
 
     def Read(self):
-        if self._creation_thread:
-            self._creation_thread.join(MistDataFile.DEFAULT_READ_TIMEOUT)
-            if self._creation_thread.isAlive():
-                logger.warning("Network File reading has timed out as file is still being saved. Please try again later.")
-                return None
+        if not self.WaitUntilStored(MistDataFile.DEFAULT_READ_TIMEOUT):
+            logger.warning("Network File reading has timed out as file is still being saved. Please try again later.")
+            return None
         mist_network_client = network.MistNetworkClient(self.mist_network_address)
-        return mist_network_client.RetrieveDataOnNetwork(self.mist_network_member_uid, str(self.data_uid))
+        return mist_network_client.RetrieveDataOnNetwork(self.mist_network_member_uids, str(self.data_uid))
 
-    def Delete(self):
-        if self._creation_thread:
-            self._creation_thread.join(MistDataFile.DEFAULT_READ_TIMEOUT)
-            if self._creation_thread.isAlive():
-                logger.warning("Network File deleting has timed out as file is still being saved. Please try again later.")
+    def _ReadLocation(self):
+        """Returns the (member uids, data uid) to read the data from along with other data files, or None to read it on its own."""
+        if not self.WaitUntilStored(MistDataFile.DEFAULT_READ_TIMEOUT) or not self.mist_network_member_uids:
+            return None
+        return (self.mist_network_member_uids, str(self.data_uid))
+
+    def _StoredLocations(self):
+        """Returns the (member uid, data uid) of everything stored."""
+        return [(member_uid, self.data_uid) for member_uid in self.mist_network_member_uids]
+
+    def _ForgetDeleted(self, deleted):
+        """Forgets the stored locations that were deleted, given whether each one was."""
+        self.mist_network_member_uids = [member_uid for (member_uid, location_deleted) in zip(self.mist_network_member_uids, deleted) if not location_deleted]
+
+    def _ProofLocations(self):
+        """Returns the (member uid, data uid, size, Merkle root) of everything stored."""
+        return [(member_uid, self.data_uid, self.size, self.merkle_root) for member_uid in self.mist_network_member_uids]
+
+    def _MinimumLocations(self):
+        return 1
+
+    def _CanProve(self):
+        return self.merkle_root is not None
+
+    def _Prove(self):
+        """Asks every member holding the data to prove that it still does.
+
+        Only one random block of PROOF_BLOCK_SIZE bytes is sent per member.
+        Returns the uid of every member asked and whether it proved it, or
+        None if the data has no Merkle root.
+        """
+        if not self.WaitUntilStored(MistDataFile.DEFAULT_READ_TIMEOUT) or not self._CanProve():
+            return None
+        mist_network_client = network.MistNetworkClient(self.mist_network_address)
+
+        def Prove(location):
+            (member_uid, data_uid, size, merkle_root) = location
+            leaf_count = merkle.MistMerkleTree.LeafCount(size)
+            index = random.randrange(leaf_count)
+            try:
+                response = mist_network_client.ProveDataOnMember(member_uid, data_uid, index)
+            except Exception as e:
+                logger.warning("Unable to reach member. Member uid: %s, Error: %s", member_uid, e)
+                return False
+            if response is None:
                 return False
+            (block, proof) = response
+            return merkle.MistMerkleTree.Verify(merkle.MistMerkleTree.HashLeaf(block), index, leaf_count, proof, merkle_root)
+
+        locations = self._ProofLocations()
+        return [(location[0], task.result is True) for (location, task) in zip(locations, transfer.RunConcurrently(Prove, locations))]
+
+    def Verify(self):
+        """Returns the number of members that proved they hold the data and
+        whether that is enough to read it, or None if it cannot be proven.
+        """
+        results = self._Prove()
+        if results is None:
+            return None
+        proven_count = sum(proven for (_, proven) in results)
+        if proven_count < len(results):
+            logger.warning("Data not proven by every member. Proven: %s, Stored: %s, Content hash: %s", proven_count, len(results), self.content_hash)
+        return (proven_count, proven_count >= self._MinimumLocations())
+
+    def Scrub(self):
+        """Returns the uids of the members that failed to prove they hold the data, or None if it cannot be proven."""
+        results = self._Prove()
+        if results is None:
+            return None
+        return [member_uid for (member_uid, proven) in results if not proven]
+
+    def _CopyHolders(self):
+        """Returns the uid of the member holding every copy that should exist, or None for the copies that do not."""
+        member_uids = list(self.mist_network_member_uids)
+        return member_uids + [None] * (settings.REPLICATION_FACTOR - len(member_uids))
+
+    def _LostCopies(self, lost_member_uids):
+        lost_member_uids = set(map(str, lost_member_uids))
+        return [index for (index, member_uid) in enumerate(self._CopyHolders()) if member_uid is None or str(member_uid) in lost_member_uids]
+
+    def Holders(self):
+        """Returns the uids of the members holding a copy."""
+        return [member_uid for member_uid in self._CopyHolders() if member_uid is not None]
+
+    def Redundancy(self, lost_member_uids):
+        """Returns how many copies more than needed to read the data are left without lost_member_uids.
+
+        It is negative when the data can no longer be read.
+        """
+        return len(self._CopyHolders()) - len(self._LostCopies(lost_member_uids)) - self._MinimumLocations()
+
+    def IsDegraded(self, lost_member_uids):
+        return bool(self._LostCopies(lost_member_uids))
+
+    def Repair(self, lost_member_uids):
+        """Replaces the copies that are missing or held by lost_member_uids.
+
+        The data is read from any copy and stored on members that hold none.
+        Copies on lost members are released once they are replaced, and kept
+        for as long as they are not. Returns the number of bytes transferred.
+        """
+        lost_member_uids = set(map(str, lost_member_uids))
+        surviving = [member_uid for member_uid in self.mist_network_member_uids if str(member_uid) not in lost_member_uids]
+        dropped = [member_uid for member_uid in self.mist_network_member_uids if str(member_uid) in lost_member_uids]
+        missing_count = settings.REPLICATION_FACTOR - len(surviving)
+        if missing_count <= 0:
+            return 0
         mist_network_client = network.MistNetworkClient(self.mist_network_address)
-        return mist_network_client.DeleteDataOnNetwork(self.mist_network_member_uid, str(self.data_uid))
+        data = mist_network_client.RetrieveDataOnNetwork(self.mist_network_member_uids, str(self.data_uid))
+        if data is None:
+            raise network.MistNetworkError("No copy left to repair from. Content hash: %s" % self.content_hash)
+        added = [member_uid for (member_uid, _) in mist_network_client.StoreDataOnNewMembers(data, missing_count, self.mist_network_member_uids)]
+        replaced = dropped[:len(added)]
+        self.mist_network_member_uids = surviving + added + dropped[len(added):]
+        if replaced and mist_network_client.DeleteDataOnNetwork(replaced, str(self.data_uid)):
+            logger.warning("Unable to release replaced copies. Content hash: %s", self.content_hash)
+        return len(data) * (1 + len(added))
+
+    def Delete(self):
+        return DeleteNetworkDataFiles([self])
 
     def __getstate__(self):
         d = copy.copy(self.__dict__)
-        del d["_creation_thread"]
+        del d["_creation_task"]
         return d
 
     def __setstate__(self, d):
-        d["_creation_thread"] = None
+        d["_creation_task"] = None
+        if "mist_network_member_uid" in d:
+            member_uid = d.pop("mist_network_member_uid")
+            d["mist_network_member_uids"] = [member_uid] if member_uid else []
+        if "content_hash" not in d:
+            # Data files stored before they were shared between files are
+            # keyed by their data uid instead.
+            d["content_hash"] = str(d["data_uid"]) if d["data_uid"] else hashlib.sha256(d["_data"]).hexdigest()
+            d["references"] = 0
         self.__dict__ = d
         if self._data:
-            self._creation_thread = threading.Thread(target=self._StoreDataFileOnNetwork, args=(self._data,))
-            self._creation_thread.start()
+            self._creation_task = transfer.shared_transfer_executor.Submit(self._StoreDataFileOnNetwork, self._data)
+
+
+class MistErasureCodedNetworkDataFile(MistNetworkDataFile):
+    """Network data file stored as erasure coded fragments.
+
+    The data is split into data_fragments pieces plus parity_fragments
+    parity pieces, each put on a different member. Any data_fragments of
+    them are enough to read it back.
+    """
+
+    # Merkle roots of the fragments, in the order of fragment_locations.
+    fragment_merkle_roots = None
+
+    def __init__(self, data, mist_network_address, content_hash=None, store=True, data_fragments=settings.ERASURE_DATA_FRAGMENTS, parity_fragments=settings.ERASURE_PARITY_FRAGMENTS):
+        self.data_fragments = data_fragments
+        self.parity_fragments = parity_fragments
+        # The (member uid, data uid) of every fragment, or None for the
+        # fragments that are not stored.
+        self.fragment_locations = None
+        MistNetworkDataFile.__init__(self, data, mist_network_address, content_hash, store)
+
+    def _Coder(self):
+        return erasure.MistErasureCoder(self.data_fragments, self.parity_fragments)
+
+    def _ForgetFailedStore(self, mist_network_client):
+        """Deletes the fragments left by a failed store. Returns whether none are left.
+
+        Forgetting the fragments once they are deleted lets the data be
+        stored again. The deletes are sent straight away rather than after
+        waiting until stored, as they are sent by the store itself.
+        """
+        self._ForgetDeleted(mist_network_client.DeleteManyDataOnNetwork(self._StoredLocations()))
+        if any(self.fragment_locations):
+            return False
+        self.fragment_locations = None
+        return True
+
+    def _StoreDataFileOnNetwork(self, data):
+        mist_network_client = network.MistNetworkClient(self.mist_network_address)
+        if self.fragment_locations is not None and len(self._StoredLocations()) < self.data_fragments:
+            if not self._ForgetFailedStore(mist_network_client):
+                raise network.MistNetworkError("Unable to delete fragments of a failed store. Content hash: %s" % self.content_hash)
+        if self.fragment_locations is None:
+            fragments = self._Coder().Encode(data)
+            self.fragment_merkle_roots = [merkle.MistMerkleTree.FromData(fragment).Root() for fragment in fragments]
+            fragment_locations = mist_network_client.StoreFragmentsOnNetwork(fragments)
+            stored_count = len(filter(None, fragment_locations))
+            if stored_count < self.data_fragments:
+                self.fragment_locations = fragment_locations
+                self._ForgetFailedStore(mist_network_client)
+                raise network.MistNetworkError("Unable to store enough fragments. Needed: %s, Stored: %s" % (self.data_fragments, stored_count))
+            if stored_count < len(fragment_locations):
+                logger.warning("Stored %s of %s fragments. Content hash: %s", stored_count, len(fragment_locations), self.content_hash)
+            self.fragment_locations = fragment_locations
+            self._data = None
+
+    def Read(self):
+        if not self.WaitUntilStored(MistDataFile.DEFAULT_READ_TIMEOUT):
+            logger.warning("Network File reading has timed out as file is still being saved. Please try again later.")
+            return None
+        if self.fragment_locations is None:
+            logger.error("Fragments were never stored. Content hash: %s", self.content_hash)
+            return None
+        mist_network_client = network.MistNetworkClient(self.mist_network_address)
+
+        def ReadFragment(index):
+            (member_uid, data_uid) = self.fragment_locations[index]
+            return mist_network_client.RetrieveDataOnNetwork([member_uid], str(data_uid))
+
+        # Data fragments come first so that decoding is only needed when
+        # one of them is missing or slow.
+        indices = [index for (index, location) in enumerate(self.fragment_locations) if location]
+        fragments = transfer.HedgeMany(ReadFragment, indices, self.data_fragments, settings.HEDGED_READ_DELAY)
+        if len(fragments) < self.data_fragments:
+            logger.error("Not enough fragments to read data file. Needed: %s, Read: %s", self.data_fragments, len(fragments))
+            return None
+        return self._Coder().Decode(dict((indices[i], fragment) for (i, fragment) in fragments.items()), self.size)
+
+    def _ReadLocation(self):
+        return None
+
+    def _StoredLocations(self):
+        return [tuple(location) for location in self.fragment_locations or [] if location]
+
+    def _ForgetDeleted(self, deleted):
+        deleted = iter(deleted)
+        self.fragment_locations = [None if location is None or next(deleted) else location for location in self.fragment_locations]
+
+    def _ProofLocations(self):
+        if self.fragment_locations is None:
+            return []
+        fragment_size = self._Coder().FragmentSize(self.size)
+        return [(location[0], location[1], fragment_size, merkle_root) for (location, merkle_root) in zip(self.fragment_locations, self.fragment_merkle_roots) if location]
+
+    def _MinimumLocations(self):
+        return self.data_fragments
+
+    def _CanProve(self):
+        return self.fragment_merkle_roots is not None
+
+    def _CopyHolders(self):
+        if self.fragment_locations is None:
+            return []
+        return [location[0] if location else None for location in self.fragment_locations]
+
+    def Repair(self, lost_member_uids):
+        """Re-creates the fragments that are missing or held by lost_member_uids.
+
+        The data is decoded from the surviving fragments and encoded again,
+        which gives the same fragments, and every lost one is stored on a
+        member that holds no other. Returns the number of bytes transferred.
+        """
+        lost_indices = self._LostCopies(lost_member_uids)
+        if not lost_indices:
+            return 0
+        data = self.Read()
+        if data is None:
+            raise network.MistNetworkError("Not enough fragments left to repair from. Content hash: %s" % self.content_hash)
+        fragments = self._Coder().Encode(data)
+        mist_network_client = network.MistNetworkClient(self.mist_network_address)
+        holders = self.Holders()
+        transferred = len(data)
+        for index in lost_indices:
+            stored = mist_network_client.StoreDataOnNewMembers(fragments[index], 1, holders)
+            if not stored:
+                break
+            replaced = self.fragment_locations[index]
+            self.fragment_locations[index] = stored[0]
+            holders.append(stored[0][0])
+            transferred += len(fragments[index])
+            if replaced and mist_network_client.DeleteDataOnNetwork([replaced[0]], str(replaced[1])):
+                logger.warning("Unable to release replaced fragment. Content hash: %s, Index: %s", self.content_hash, index)
+        return transferred
+
+
+def MakeNetworkDataFile(data, mist_network_address, content_hash=None, store=True):
+    """Returns a network data file for data in the storage mode set in settings."""
+    if settings.STORAGE_MODE == settings.ERASURE_CODED_STORAGE:
+        return MistErasureCodedNetworkDataFile(data, mist_network_address, content_hash, store)
+    return MistNetworkDataFile(data, mist_network_address, content_hash, store)
+
+
+class MistNetworkDataFileBatch(object):
+    """Network data files stored together
+
+    Replicated data files are sent to every member with one request for
+    all of its share, and those that could not be stored that way are
+    stored on their own, as are erasure coded ones. Data files made by
+    Make can be waited on straight away, and the ones added are stored
+    once the batch is submitted.
+    """
+
+    def __init__(self, mist_network_address):
+        self.mist_network_address = mist_network_address
+        self.mist_network_data_files = []
+        self.size = 0
+        self._task = transfer.MistTransferTask(self._Store, (), {})
+
+    def Make(self, data, content_hash=None):
+        mist_network_data_file = MakeNetworkDataFile(data, self.mist_network_address, content_hash, store=False)
+        mist_network_data_file._creation_task = self._task
+        return mist_network_data_file
+
+    def Add(self, mist_network_data_file):
+        self.mist_network_data_files.append(mist_network_data_file)
+        self.size += mist_network_data_file.size
+
+    def __len__(self):
+        return len(self.mist_network_data_files)
+
+    def Submit(self):
+        transfer.shared_transfer_executor.SubmitTask(self._task)
+
+    def _Store(self):
+        alone = [mist_network_data_file for mist_network_data_file in self.mist_network_data_files if isinstance(mist_network_data_file, MistErasureCodedNetworkDataFile)]
+        together = [mist_network_data_file for mist_network_data_file in self.mist_network_data_files if not isinstance(mist_network_data_file, MistErasureCodedNetworkDataFile)]
+        if together:
+            try:
+                results = network.MistNetworkClient(self.mist_network_address).StoreManyDataOnNetwork([mist_network_data_file._data for mist_network_data_file in together])
+            except Exception as e:
+                logger.warning("Unable to store data files together. Error: %s", e)
+                results = [None] * len(together)
+            for (mist_network_data_file, result) in zip(together, results):
+                if result is None:
+                    alone.append(mist_network_data_file)
+                else:
+                    mist_network_data_file._SetStored(*result)
+                    mist_network_data_file._creation_task = None
+
+        tasks = transfer.RunConcurrently(lambda mist_network_data_file: mist_network_data_file._StoreDataFileOnNetwork(mist_network_data_file._data), alone, settings.TRANSFER_WORKERS)
+        # Only the data files that failed are left to show it, so that a
+        # retry does not go to the others.
+        failed_count = 0
+        for (mist_network_data_file, task) in zip(alone, tasks):
+            if task.exception is None:
+                mist_network_data_file._creation_task = None
+            else:
+                failed_count += 1
+        if failed_count:
+            raise network.MistNetworkError("Unable to store %s of %s data files." % (failed_count, len(self)))
+
+
+def MakeNetworkDataFiles(datas, mist_network_address):
+    """Returns a network data file for each of datas, stored together."""
+    mist_network_data_file_batch = MistNetworkDataFileBatch(mist_network_address)
+    for data in datas:
+        mist_network_data_file_batch.Add(mist_network_data_file_batch.Make(data))
+    mist_network_data_file_batch.Submit()
+    return mist_network_data_file_batch.mist_network_data_files
+
+
+def ReadNetworkDataFiles(mist_network_data_files):
+    """Returns the data of every network data file, or None for those that cannot be read.
+
+    Replicated data is read together, with one request to every member
+    for all the data read from it. Other data is read on its own.
+    """
+    datas = [None] * len(mist_network_data_files)
+    if not mist_network_data_files:
+        return datas
+    locations = [mist_network_data_file._ReadLocation() for mist_network_data_file in mist_network_data_files]
+    together = [index for (index, location) in enumerate(locations) if location]
+    if together:
+        mist_network_client = network.MistNetworkClient(mist_network_data_files[0].mist_network_address)
+        for (index, data) in zip(together, mist_network_client.RetrieveManyDataOnNetwork([locations[index] for index in together])):
+            datas[index] = data
+
+    alone = [index for (index, location) in enumerate(locations) if not location]
+    tasks = transfer.RunConcurrently(lambda index: mist_network_data_files[index].Read(), alone, settings.READ_AHEAD_WINDOW)
+    for (index, task) in zip(alone, tasks):
+        datas[index] = task.result
+    return datas
+
+
+def DeleteNetworkDataFiles(mist_network_data_files):
+    """Deletes network data files with one request to every member holding any of them.
+
+    Locations that were deleted are forgotten so that a retry only goes to
+    the members that still hold them. Returns whether all were deleted.
+    """
+    if not all(mist_network_data_file.WaitUntilStored(MistDataFile.DEFAULT_READ_TIMEOUT) for mist_network_data_file in mist_network_data_files):
+        logger.warning("Network File deleting has timed out as file is still being saved. Please try again later.")
+        return False
+    stored_locations = [mist_network_data_file._StoredLocations() for mist_network_data_file in mist_network_data_files]
+    locations = [location for file_locations in stored_locations for location in file_locations]
+    if not locations:
+        return True
+    deleted = network.MistNetworkClient(mist_network_data_files[0].mist_network_address).DeleteManyDataOnNetwork(locations)
+    offset = 0
+    for (mist_network_data_file, file_locations) in zip(mist_network_data_files, stored_locations):
+        mist_network_data_file._ForgetDeleted(deleted[offset:offset + len(file_locations)])
+        offset += len(file_locations)
+    return all(deleted)
+
+
+class MistNetworkDataFileStore(object):
+    """Content addressed store of the data files put on the network.
+
+    Data files are shared between every file that contains the same content
+    and are only deleted from the network once the last reference is released.
+    """
+
+    def __init__(self):
+        self.mist_network_data_files = {}
+        # Data files that could not be deleted after their content was
+        # stored again, which are deleted again on the next release.
+        self.undeleted_mist_network_data_files = []
+        self._lock = threading.Lock()
+
+    def Reference(self, content_hash, make_data_file):
+        """References the data file of content_hash, made by make_data_file if there is none.
+
+        Making a data file can be slow, so it is done outside the lock and
+        thrown away if another one was added meanwhile. make_data_file must
+        not store it: the caller stores the data file when it was created.
+        Returns the data file and whether it was created.
+        """
+        with self._lock:
+            mist_network_data_file = self.mist_network_data_files.get(content_hash)
+            if mist_network_data_file is not None:
+                mist_network_data_file.references += 1
+                return (mist_network_data_file, False)
+        new_mist_network_data_file = make_data_file()
+        with self._lock:
+            mist_network_data_file = self.mist_network_data_files.setdefault(content_hash, new_mist_network_data_file)
+            mist_network_data_file.references += 1
+        return (mist_network_data_file, mist_network_data_file is new_mist_network_data_file)
+
+    def TryReference(self, content_hash):
+        """References the data file of content_hash if there is one. Returns whether there was."""
+        with self._lock:
+            mist_network_data_file = self.mist_network_data_files.get(content_hash)
+            if mist_network_data_file is None:
+                return False
+            mist_network_data_file.references += 1
+            return True
+
+    def Get(self, content_hash):
+        return self.mist_network_data_files.get(content_hash)
+
+    def Release(self, content_hash):
+        return not self.ReleaseMany([content_hash])
+
+    def ReleaseMany(self, content_hashes):
+        """Releases a reference to the data file of every content hash.
+
+        Data files left without references are deleted from the network
+        together. Returns the content hashes whose reference is still held
+        because their data file could not be deleted.
+        """
+        released = []
+        with self._lock:
+            undeleted_mist_network_data_files = self.undeleted_mist_network_data_files
+            self.undeleted_mist_network_data_files = []
+            for content_hash in content_hashes:
+                mist_network_data_file = self.mist_network_data_files.get(content_hash)
+                if mist_network_data_file is None:
+                    logger.warning("Releasing unknown data file. Content hash: %s", content_hash)
+                    continue
+                mist_network_data_file.references -= 1
+                if mist_network_data_file.references <= 0:
+                    del self.mist_network_data_files[content_hash]
+                    released.append((content_hash, mist_network_data_file))
+        mist_network_data_files = [mist_network_data_file for (_, mist_network_data_file) in released] + undeleted_mist_network_data_files
+        if not mist_network_data_files or DeleteNetworkDataFiles(mist_network_data_files):
+            return []
+
+        held_content_hashes = []
+        with self._lock:
+            for mist_network_data_file in undeleted_mist_network_data_files:
+                if mist_network_data_file._StoredLocations() or not mist_network_data_file.WaitUntilStored(0):
+                    self.undeleted_mist_network_data_files.append(mist_network_data_file)
+            for (content_hash, mist_network_data_file) in released:
+                if not mist_network_data_file._StoredLocations() and mist_network_data_file.WaitUntilStored(0):
+                    continue
+                current_mist_network_data_file = self.mist_network_data_files.setdefault(content_hash, mist_network_data_file)
+                if current_mist_network_data_file is mist_network_data_file:
+                    mist_network_data_file.references += 1
+                    held_content_hashes.append(content_hash)
+                else:
+                    # The content was stored again meanwhile, so the copies
+                    # left of the released data file are deleted later.
+                    self.undeleted_mist_network_data_files.append(mist_network_data_file)
+        return held_content_hashes
+
+    def RecountReferences(self, mist_files):
+        with self._lock:
+            for mist_network_data_file in self.mist_network_data_files.values():
+                mist_network_data_file.references = 0
+            for mist_file in mist_files:
+                for content_hash in mist_file.content_hashes:
+                    if content_hash in self.mist_network_data_files:
+                        self.mist_network_data_files[content_hash].references += 1
+
+    def __len__(self):
+        return len(self.mist_network_data_files)
+
+    def __getstate__(self):
+        d = copy.copy(self.__dict__)
+        del d["_lock"]
+        return d
+
+    def __setstate__(self, d):
+        d["_lock"] = threading.Lock()
+        d.setdefault("undeleted_mist_network_data_files", [])
+        self.__dict__ = d
 
 
 class MistDataFile(mist_chunk.MistChunk):
@@ -68,9 +594,10 @@ class MistDataFile(mist_chunk.MistChunk):
     DEFAULT_READ_TIMEOUT = 10 * 60
 
     def __init__(self, data, mist_network_address, root_path):
-        self.uid = uuid.uuid4()
+        self.uid = MistDataFile.ContentUid(data)
         self.root_path = root_path
         self.size = len(data)
+        self.references = 1
         self.mist_network_address = mist_network_address
         self.mist_chunks = []
         if len(data)/mist_chunk.MistChunk.CHUNK_SIZE > MistDataFile.MAX_DATA_FILE_SPLIT_NUM:
@@ -78,19 +605,21 @@ class MistDataFile(mist_chunk.MistChunk):
         else:
             self._data_file_size = mist_chunk.MistChunk.CHUNK_SIZE
         self._data = data
-        self._creation_thread = threading.Thread(target=self._SplitFileIntoChunks, args=(self._data,))
-        self._creation_thread.start()
+        self._creation_thread = None
+        if self.size > mist_chunk.MistChunk.CHUNK_SIZE:
+            self._creation_thread = threading.Thread(target=self._SplitFileIntoChunks, args=(self._data,))
+            self._creation_thread.start()
+        else:
+            # Small data is written straight to a local chunk. Doing it here
+            # keeps member requests off the shared transfer workers.
+            self._SplitFileIntoChunks(self._data)
 
     def _SplitFileIntoChunks(self, data):
         if self.size > mist_chunk.MistChunk.CHUNK_SIZE:
-            data = self._data
-            tmp_size = 0
-            for i in xrange(0, self.size, self._data_file_size):
-                data_part = data[i:i+self._data_file_size]
-                self._data = self._data[self._data_file_size:]
-                chunk = MistNetworkDataFile(data_part, self.mist_network_address)
-                self.mist_chunks.append(chunk)
-                tmp_size += chunk.size
+            # The parts are stored together, with one request per member.
+            data_parts = [data[i:i+self._data_file_size] for i in xrange(0, self.size, self._data_file_size)]
+            self.mist_chunks = MakeNetworkDataFiles(data_parts, self.mist_network_address)
+            self._data = None
         else:
             chunk = mist_chunk.MistChunk(self.uid, files.MistFile.STORAGE_FOLDER_PATH, data, self.root_path)
             self.mist_chunks.append(chunk)
@@ -103,18 +632,27 @@ class MistDataFile(mist_chunk.MistChunk):
                 if self._creation_thread.isAlive():
                     logger.warning("Data File reading has timed out as file is still being saved. Please try again later. Uid: %s", self.uid)
                     return None
-            data = ""
-            for chunk in self.mist_chunks:
-                data_chunk = chunk.Read()
+            if self.size > mist_chunk.MistChunk.CHUNK_SIZE:
+                # Chunks split out onto the network are fetched together.
+                data_chunks = ReadNetworkDataFiles(self.mist_chunks)
+            else:
+                data_chunks = [self.mist_chunks[0].Read()]
+            data = bytearray(self.size)
+            offset = 0
+            for (chunk, data_chunk) in itertools.izip(self.mist_chunks, data_chunks):
                 if data_chunk is None or len(data_chunk) != chunk.size:
                     logger.error("Unable to read data file. Uid: %s", self.uid)
                     return
-                data += data_chunk
-            if self.size != len(data):
-                logger.error("Corrupted data file due to size. Size on record: %s, Actual size: %s", self.size, len(data))
+                data[offset:offset+len(data_chunk)] = data_chunk
+                offset += len(data_chunk)
+            if self.size != offset:
+                logger.error("Corrupted data file due to size. Size on record: %s, Actual size: %s", self.size, offset)
                 return None
-            else:
-                return data
+            data = str(data)
+            if MistDataFile.ContentUid(data) != self.uid:
+                logger.error("Corrupted data file due to content hash. Uid: %s", self.uid)
+                return None
+            return data
         else:
             logger.error("File is invalid.")
 
@@ -124,11 +662,13 @@ class MistDataFile(mist_chunk.MistChunk):
             if self._creation_thread.isAlive():
                 logger.warning("Data File deleting has timed out as file is still being saved. Please try again later. Uid: %s", self.uid)
                 return False
-        for chunk in self.mist_chunks:
-            if chunk.Delete():
-                del chunk
-            else:
+        if self.size > mist_chunk.MistChunk.CHUNK_SIZE:
+            if not DeleteNetworkDataFiles(self.mist_chunks):
                 return False
+        else:
+            for chunk in self.mist_chunks:
+                if not chunk.Delete():
+                    return False
         self.uid = None
         self.mist_network_address = None
         self.mist_chunks = None
@@ -0,0 +1,126 @@
+import binascii
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistErasureError(Exception):
+    pass
+
+
+def _MakeFieldTables(polynomial):
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for power in xrange(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= polynomial
+    for power in xrange(255, 512):
+        exp[power] = exp[power - 255]
+    return (tuple(exp), tuple(log))
+
+
+class MistErasureCoder(object):
+    """Mist Erasure Coder class
+
+    Systematic Reed-Solomon code over GF(256). Data is split into k data
+    fragments followed by m parity fragments, and any k of the k + m
+    fragments rebuild it. Parity rows come from a Cauchy matrix, which
+    keeps every k by k submatrix of the code invertible.
+    """
+
+    FIELD_POLYNOMIAL = 0x11d
+    (EXP_TABLE, LOG_TABLE) = _MakeFieldTables(FIELD_POLYNOMIAL)
+
+    def __init__(self, data_fragments, parity_fragments):
+        if data_fragments < 1 or parity_fragments < 0 or data_fragments + parity_fragments > 256:
+            raise MistErasureError("Invalid fragment counts. Data: %s, Parity: %s" % (data_fragments, parity_fragments))
+        self.data_fragments = data_fragments
+        self.parity_fragments = parity_fragments
+        self._matrix = [[int(row == column) for column in xrange(data_fragments)] for row in xrange(data_fragments)]
+        for row in xrange(parity_fragments):
+            self._matrix.append([MistErasureCoder._Inverse((data_fragments + row) ^ column) for column in xrange(data_fragments)])
+        # Multiplying by a constant maps every byte to another byte, so each
+        # constant gets a lookup table that is applied to whole fragments.
+        if numpy is not None:
+            self._multiply_table = numpy.array([[MistErasureCoder._Multiply(a, b) for b in xrange(256)] for a in xrange(256)], dtype=numpy.uint8)
+        else:
+            self._multiply_table = ["".join(chr(MistErasureCoder._Multiply(a, b)) for b in xrange(256)) for a in xrange(256)]
+
+    @staticmethod
+    def _Multiply(a, b):
+        if a == 0 or b == 0:
+            return 0
+        return MistErasureCoder.EXP_TABLE[MistErasureCoder.LOG_TABLE[a] + MistErasureCoder.LOG_TABLE[b]]
+
+    @staticmethod
+    def _Inverse(a):
+        if a == 0:
+            raise MistErasureError("Zero has no inverse.")
+        return MistErasureCoder.EXP_TABLE[255 - MistErasureCoder.LOG_TABLE[a]]
+
+    @staticmethod
+    def _InvertMatrix(matrix):
+        size = len(matrix)
+        rows = [list(row) + [int(i == j) for j in xrange(size)] for (i, row) in enumerate(matrix)]
+        for column in xrange(size):
+            pivot = next((row for row in xrange(column, size) if rows[row][column]), None)
+            if pivot is None:
+                raise MistErasureError("Fragments do not form an invertible matrix.")
+            (rows[column], rows[pivot]) = (rows[pivot], rows[column])
+            scale = MistErasureCoder._Inverse(rows[column][column])
+            rows[column] = [MistErasureCoder._Multiply(scale, value) for value in rows[column]]
+            for row in xrange(size):
+                factor = rows[row][column]
+                if row != column and factor:
+                    rows[row] = [value ^ MistErasureCoder._Multiply(factor, pivot_value) for (value, pivot_value) in zip(rows[row], rows[column])]
+        return [row[size:] for row in rows]
+
+    def FragmentSize(self, size):
+        return max(1, -(-size // self.data_fragments))
+
+    def _Combine(self, coefficients, fragments):
+        """Returns the sum of coefficient * fragment over GF(256)."""
+        if numpy is not None:
+            result = numpy.zeros(len(fragments[0]), dtype=numpy.uint8)
+            for (coefficient, fragment) in zip(coefficients, fragments):
+                if coefficient:
+                    result ^= self._multiply_table[coefficient][numpy.frombuffer(fragment, dtype=numpy.uint8)]
+            return result.tostring()
+
+        # Without NumPy the XOR is done on fragments read as big integers.
+        result = 0
+        for (coefficient, fragment) in zip(coefficients, fragments):
+            if coefficient:
+                result ^= int(binascii.hexlify(fragment.translate(self._multiply_table[coefficient])), 16)
+        return binascii.unhexlify("%0*x" % (2 * len(fragments[0]), result))
+
+    def Encode(self, data):
+        """Returns the k data fragments followed by the m parity fragments of data."""
+        fragment_size = self.FragmentSize(len(data))
+        data += "\0" * (fragment_size * self.data_fragments - len(data))
+        fragments = [data[i:i+fragment_size] for i in xrange(0, len(data), fragment_size)]
+        for row in self._matrix[self.data_fragments:]:
+            fragments.append(self._Combine(row, fragments[:self.data_fragments]))
+        return fragments
+
+    def Decode(self, fragments, size):
+        """Rebuilds data of the given size from a dict of fragment index to fragment."""
+        if len(fragments) < self.data_fragments:
+            raise MistErasureError("Not enough fragments. Needed: %s, Available: %s" % (self.data_fragments, len(fragments)))
+        indices = sorted(fragments)[:self.data_fragments]
+        if indices != range(self.data_fragments):
+            decode_matrix = MistErasureCoder._InvertMatrix([self._matrix[index] for index in indices])
+            available = [fragments[index] for index in indices]
+            fragments = dict((row, self._Combine(decode_matrix[row], available)) for row in xrange(self.data_fragments))
+        return "".join(fragments[index] for index in xrange(self.data_fragments))[:size]
@@ -1,11 +1,17 @@
+import os
 import uuid
+import copy
+import hashlib
 import ntpath
-import random
-import struct
 import logging
-from Crypto.Cipher import AES
+import collections
 
+import chunking
+import crypto
 import data_files
+import merkle
+import mist_chunk
+import transfer
 import settings
 
 
@@ -13,69 +19,231 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class MistFileError(Exception):
+    pass
+
+
 class MistFile(object):
     """Mist File class"""
 
     STORAGE_FOLDER_PATH = "chunks"
+    # Leave room for the block header and padding so that an encrypted block
+    # always fits in a single chunk on the receiving member.
+    BLOCK_SIZE = mist_chunk.MistChunk.CHUNK_SIZE - 64
 
-    def __init__(self, file_path, mist_network_address):
+    # Size, mtime and inode of the file when it was stored, and the hash of
+    # its content. Files stored before these were kept have neither.
+    fingerprint = None
+    content_hash = None
+    # Merkle root over the hashes of the blocks, which commits to the whole
+    # manifest.
+    merkle_root = None
+    # Files stored before they were split into blocks have the uid of their
+    # one data file as their only content hash, which is not a hash of the
+    # decrypted data. They are split into blocks on the next reconcile.
+    legacy = False
+
+    def __init__(self, file_path, mist_network_address, mist_network_data_file_store):
         self.uid = uuid.uuid4()
         self.mist_network_address = mist_network_address
+        self.mist_network_data_file_store = mist_network_data_file_store
         self.filename = ntpath.basename(file_path)
         self.size = None
-        self.mist_network_data_file = None
-        self._MakeDataFile(file_path)
-
-    def _MakeDataFile(self, file_path):
-        with open(file_path, "r") as infile:
-            data = infile.read()
-            iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
-            encryptor = AES.new(settings.ENCRYPTION_KEY, AES.MODE_CBC, iv)
-            self.size = len(data)
-
-            encrypted_data = struct.pack("<Q", self.size)
-            encrypted_data += iv
-            if len(data) % 16 != 0:
-                    data += " " * (16 - len(data) % 16)
-            encrypted_data += encryptor.encrypt(data)
-            mist_data_file = data_files.MistNetworkDataFile(encrypted_data, self.mist_network_address)
-            self.mist_network_data_file = mist_data_file
+        self.content_hashes = []
+        self._MakeDataFiles(file_path)
+
+    def _MakeDataFiles(self, file_path):
+        self.size = 0
+        stored_count = 0
+        chunker = chunking.MistContentChunker(MistFile.BLOCK_SIZE)
+        file_hash = hashlib.sha256()
+        # New blocks are stored in batches, with one request to every member
+        # for all of its share. A batch is submitted even if reading fails,
+        # as its data files may already be referenced by other files.
+        batch = data_files.MistNetworkDataFileBatch(self.mist_network_address)
+        try:
+            with open(file_path, "rb") as infile:
+                # Taken before reading, so a change made while reading shows
+                # up as a different fingerprint later.
+                self.fingerprint = MistFile.Fingerprint(os.fstat(infile.fileno()))
+                # Blocks the store already has are only referenced. New ones
+                # are encrypted on the crypto engine while the next ones are
+                # read, and stored in order once encrypted.
+                blocks = collections.deque()
+                for data in chunker.Chunks(infile):
+                    self.size += len(data)
+                    file_hash.update(data)
+                    content_hash = hashlib.sha256(data).hexdigest()
+                    if self.mist_network_data_file_store.TryReference(content_hash):
+                        encryption = None
+                    else:
+                        encryption = crypto.shared_crypto_engine.RunAsync(crypto.EncryptBlock, data)
+                    blocks.append((content_hash, encryption))
+                    if len(blocks) > crypto.shared_crypto_engine.workers:
+                        stored_count += self._StoreBlock(blocks.popleft(), batch)
+                        batch = self._SubmitFullBatch(batch)
+                while blocks:
+                    stored_count += self._StoreBlock(blocks.popleft(), batch)
+                    batch = self._SubmitFullBatch(batch)
+        finally:
+            if batch:
+                batch.Submit()
+        self.content_hash = file_hash.hexdigest()
+        self.merkle_root = self._ManifestMerkleRoot()
+
+        logger.info("Stored %s: %s of %s chunks uploaded.", self.filename, stored_count, len(self.content_hashes))
+
+    def _StoreBlock(self, block, batch):
+        """Adds a block to the file, and its data file to batch if it is new. Returns whether it was.
+
+        Blocks without an encryption were already referenced when read.
+        """
+        (content_hash, encryption) = block
+        created = False
+        if encryption is not None:
+            encrypted_data = encryption.Get()
+            (mist_data_file, created) = self.mist_network_data_file_store.Reference(content_hash, lambda: batch.Make(encrypted_data, content_hash))
+            if created:
+                batch.Add(mist_data_file)
+        self.content_hashes.append(content_hash)
+        return created
+
+    def _SubmitFullBatch(self, batch):
+        """Submits batch once it is full. Returns the batch to add the next blocks to."""
+        if batch.size < settings.STORE_BATCH_SIZE:
+            return batch
+        # Uploads run on the shared transfer executor, which blocks here once
+        # its queue is full and so bounds memory use.
+        batch.Submit()
+        return data_files.MistNetworkDataFileBatch(self.mist_network_address)
+
+    def _ManifestMerkleRoot(self):
+        return merkle.MistMerkleTree([content_hash.decode("hex") for content_hash in self.content_hashes]).Root()
+
+    def VerifyManifest(self):
+        """Returns whether the block hashes still match the Merkle root, if there is one."""
+        return self.merkle_root is None or self._ManifestMerkleRoot() == self.merkle_root
+
+    @staticmethod
+    def Fingerprint(stat_result):
+        return (stat_result.st_size, stat_result.st_mtime, stat_result.st_ino)
+
+    def Matches(self, file_path, stat_result):
+        """Returns whether the file at file_path still has the stored content.
+
+        The file is only read if its fingerprint changed but not its size.
+        """
+        if self.fingerprint == MistFile.Fingerprint(stat_result):
+            return True
+        if self.size != stat_result.st_size:
+            return False
+        if self.content_hash is None:
+            with open(file_path, "rb") as infile:
+                chunker = chunking.MistContentChunker(MistFile.BLOCK_SIZE)
+                return [hashlib.sha256(data).hexdigest() for data in chunker.Chunks(infile)] == self.content_hashes
+        return MistFile.HashFile(file_path) == self.content_hash
+
+    @staticmethod
+    def HashFile(file_path):
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as infile:
+            for data in iter(lambda: infile.read(MistFile.BLOCK_SIZE), ""):
+                file_hash.update(data)
+        return file_hash.hexdigest()
+
+    def WaitUntilStored(self, timeout=None):
+        for content_hash in set(self.content_hashes):
+            mist_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_data_file and not mist_data_file.WaitUntilStored(timeout):
+                return False
+        return True
+
+    def _ReadBlocks(self, content_hashes):
+        """Returns the decrypted blocks of content_hashes, retrieved with one request to every member holding any."""
+        mist_data_files = []
+        for content_hash in content_hashes:
+            mist_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_data_file is None:
+                raise MistFileError("Missing chunk of file %s. Content hash: %s" % (self.filename, content_hash))
+            mist_data_files.append(mist_data_file)
+        encrypted_datas = data_files.ReadNetworkDataFiles(mist_data_files)
+        if None in encrypted_datas:
+            raise MistFileError("Unable to read file %s" % self.filename)
+        decryptions = [crypto.shared_crypto_engine.RunAsync(crypto.DecryptBlock, encrypted_data) for encrypted_data in encrypted_datas]
+        datas = []
+        for (content_hash, decryption) in zip(content_hashes, decryptions):
+            try:
+                data = decryption.Get()
+            except crypto.MistCryptoError as e:
+                raise MistFileError("Unable to read file %s. Error: %s" % (self.filename, e))
+            if not self.legacy and hashlib.sha256(data).hexdigest() != content_hash:
+                raise MistFileError("Corrupted chunk of file %s. Content hash: %s" % (self.filename, content_hash))
+            datas.append(data)
+        return datas
+
+    def ReadIter(self):
+        """Yields the decrypted blocks of the file as they are retrieved.
+
+        Blocks are retrieved READ_AHEAD_WINDOW at a time, and the next ones
+        are fetched ahead on the transfer executor while the current ones
+        are being consumed.
+        """
+        if not self.uid:
+            raise MistFileError("File is invalid.")
+
+        size = 0
+        windows = [self.content_hashes[i:i + settings.READ_AHEAD_WINDOW] for i in xrange(0, len(self.content_hashes), settings.READ_AHEAD_WINDOW)]
+        for datas in transfer.shared_transfer_executor.Prefetch(self._ReadBlocks, windows, 1):
+            for data in datas:
+                size += len(data)
+                yield data
+
+        if self.size != size:
+            raise MistFileError("Corrupted file due to size. Size on record: %s, Actual size: %s" % (self.size, size))
 
     def Read(self):
-        if self.uid:
-            encrypted_data = self.mist_network_data_file.Read()
-            if encrypted_data is None:
-                logger.error("Unable to read file %s", self.filename)
-                return None
-            original_size = struct.unpack("<Q", encrypted_data[:struct.calcsize("Q")])[0]
-            encrypted_data = encrypted_data[struct.calcsize("Q"):]
-            if self.size != original_size:
-                logger.error("Corrupted file due to size. Size on record: %s, Size in header: %s", self.size, original_size)
-                return None
-            iv = encrypted_data[:16]
-            encrypted_data = encrypted_data[16:]
-            decryptor = AES.new(settings.ENCRYPTION_KEY, AES.MODE_CBC, iv)
-
-            data = decryptor.decrypt(encrypted_data)[:original_size]
-            if self.size != len(data):
-                logger.error("Corrupted file due to size. Size on record: %s, Actual size: %s", self.size, len(data))
-                return None
-            else:
-                return data
-        else:
-            logger.error("File is invalid.")
+        try:
+            return "".join(self.ReadIter())
+        except MistFileError as e:
+            logger.error(str(e))
             return None
 
     def Delete(self):
         if self.uid:
-            if self.mist_network_data_file.Delete():
-                self.uid = None
-                self.mist_network = None
-                self.filename = None
-                self.mist_network_data_file = None
-            else:
+            # Chunks are released together so that deleting them takes a
+            # request per member rather than one per chunk.
+            self.content_hashes = self.mist_network_data_file_store.ReleaseMany(self.content_hashes)
+            if self.content_hashes:
                 return False
+            self.uid = None
+            self.mist_network = None
+            self.mist_network_data_file_store = None
+            self.filename = None
+            self.content_hashes = None
         return True
 
     def __str__(self):
         return self.filename
+
+    def __getstate__(self):
+        # The data file store is saved once by the owning Mist, which puts it
+        # back after loading.
+        d = copy.copy(self.__dict__)
+        del d["mist_network_data_file_store"]
+        return d
+
+    def __setstate__(self, d):
+        d["mist_network_data_file_store"] = None
+        if "mist_network_data_file" in d:
+            mist_network_data_file = d.pop("mist_network_data_file")
+            d["content_hashes"] = [mist_network_data_file.content_hash]
+            d["legacy"] = True
+            d["_legacy_mist_network_data_file"] = mist_network_data_file
+        self.__dict__ = d
+
+    def SetDataFileStore(self, mist_network_data_file_store):
+        """Puts back the data file store after loading, adding the data file of a legacy file to it."""
+        self.mist_network_data_file_store = mist_network_data_file_store
+        mist_network_data_file = self.__dict__.pop("_legacy_mist_network_data_file", None)
+        if mist_network_data_file is not None:
+            mist_network_data_file_store.mist_network_data_files.setdefault(mist_network_data_file.content_hash, mist_network_data_file)
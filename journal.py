@@ -0,0 +1,169 @@
+import os
+import zlib
+import struct
+import pickle
+import threading
+import contextlib
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistJournal(object):
+    """Mist Journal class
+
+    Keeps a pickled snapshot of some state next to an append-only log of
+    the changes made since. Every record is framed with its length and a
+    CRC so that a write torn by a crash is detected and dropped on replay.
+    """
+
+    RECORD_HEADER = "<II"
+    JOURNAL_EXT = "journal"
+    OLD_JOURNAL_EXT = "old"
+    SNAPSHOT_TMP_EXT = "tmp"
+    DEFAULT_COMPACTION_RECORD_COUNT = 1000
+
+    def __init__(self, snapshot_path, sync=True, compaction_record_count=DEFAULT_COMPACTION_RECORD_COUNT):
+        self.snapshot_path = snapshot_path
+        self.journal_path = "%s.%s" % (snapshot_path, MistJournal.JOURNAL_EXT)
+        self.old_journal_path = "%s.%s" % (self.journal_path, MistJournal.OLD_JOURNAL_EXT)
+        self.sync = sync
+        self.compaction_record_count = compaction_record_count
+        self.record_count = 0
+        # The batch every thread appending in one is taking part in.
+        self._thread_batches = {}
+        self._outfile = None
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+
+    def Load(self):
+        """Returns the snapshot, or None if there is none, and the records logged after it."""
+        snapshot = None
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as infile:
+                snapshot = pickle.load(infile)
+        # A journal rotated out by an unfinished compaction is older than the
+        # current one. Replaying both is safe as records are idempotent.
+        records = self._Replay(self.old_journal_path) + self._Replay(self.journal_path)
+        self.record_count = len(records)
+        return (snapshot, records)
+
+    def _Replay(self, journal_path):
+        records = []
+        valid_length = 0
+        if os.path.isfile(journal_path):
+            header_size = struct.calcsize(MistJournal.RECORD_HEADER)
+            with open(journal_path, "rb") as infile:
+                while True:
+                    header = infile.read(header_size)
+                    if len(header) < header_size:
+                        break
+                    (length, crc) = struct.unpack(MistJournal.RECORD_HEADER, header)
+                    payload = infile.read(length)
+                    if len(payload) < length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+                        logger.warning("Dropping torn journal record. Journal: %s, Offset: %s", journal_path, valid_length)
+                        break
+                    records.append(pickle.loads(payload))
+                    valid_length += header_size + length
+
+            # Cut off any torn tail so that new records follow valid ones.
+            with open(journal_path, "r+b") as outfile:
+                outfile.truncate(valid_length)
+        return records
+
+    def _Open(self):
+        if self._outfile is None:
+            self._outfile = open(self.journal_path, "ab")
+        return self._outfile
+
+    def _Flush(self):
+        self._outfile.flush()
+        if self.sync:
+            os.fsync(self._outfile.fileno())
+
+    def Append(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            outfile = self._Open()
+            outfile.write(struct.pack(MistJournal.RECORD_HEADER, len(payload), zlib.crc32(payload) & 0xFFFFFFFF))
+            outfile.write(payload)
+            if threading.current_thread().ident not in self._thread_batches:
+                self._Flush()
+            self.record_count += 1
+
+    @contextlib.contextmanager
+    def Batch(self, batch=None):
+        """Commits the records appended in the block with a single sync when it ends.
+
+        Only the records of the thread that started the batch wait for the
+        sync, and other threads still sync theirs before Append returns.
+        Threads working for the batch take part in it by passing batch, as
+        yielded by the block that started it, and their records are then
+        committed when that block ends.
+        """
+        ident = threading.current_thread().ident
+        with self._lock:
+            outer_batch = self._thread_batches.get(ident)
+            starts = batch is None and outer_batch is None
+            batch = batch or outer_batch or object()
+            self._thread_batches[ident] = batch
+        try:
+            yield batch
+        finally:
+            with self._lock:
+                if outer_batch is None:
+                    del self._thread_batches[ident]
+                else:
+                    self._thread_batches[ident] = outer_batch
+                if starts and self._outfile is not None:
+                    self._Flush()
+
+    def InBatch(self):
+        return bool(self._thread_batches)
+
+    def NeedsCompaction(self):
+        return self.record_count >= self.compaction_record_count
+
+    def Compact(self, get_snapshot, state_lock=None):
+        """Replaces the snapshot with get_snapshot() and empties the journal.
+
+        Only the pickling runs under state_lock, which must keep the state
+        from changing. The snapshot is written to disk after it is released.
+        """
+        with self._compaction_lock:
+            if state_lock:
+                state_lock.acquire()
+            try:
+                payload = pickle.dumps(get_snapshot(), pickle.HIGHEST_PROTOCOL)
+                self._Rotate()
+            finally:
+                if state_lock:
+                    state_lock.release()
+            self._WriteSnapshot(payload)
+
+    def _Rotate(self):
+        with self._lock:
+            if self._outfile is not None:
+                self._outfile.close()
+                self._outfile = None
+            if os.path.isfile(self.journal_path):
+                os.rename(self.journal_path, self.old_journal_path)
+            self.record_count = 0
+
+    def _WriteSnapshot(self, payload):
+        tmp_path = "%s.%s" % (self.snapshot_path, MistJournal.SNAPSHOT_TMP_EXT)
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(payload)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        if os.path.isfile(self.old_journal_path):
+            os.remove(self.old_journal_path)
+
+    def Close(self):
+        with self._lock:
+            if self._outfile is not None:
+                self._outfile.close()
+                self._outfile = None
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistMerkleTree(object):
+    """Mist Merkle Tree class
+
+    Binary hash tree over a list of leaf hashes. The root commits to every
+    leaf, and a single leaf is proven to be under a root by the hashes of
+    its siblings on the way up, so a proof only grows with the log of the
+    number of leaves. A node without a sibling is carried up as it is.
+    """
+
+    LEAF_PREFIX = "\x00"
+    NODE_PREFIX = "\x01"
+
+    def __init__(self, leaf_hashes):
+        self.leaf_count = len(leaf_hashes)
+        self._levels = [list(leaf_hashes) or [hashlib.sha256("").digest()]]
+        while len(self._levels[-1]) > 1:
+            level = self._levels[-1]
+            self._levels.append([MistMerkleTree._HashNode(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in xrange(0, len(level), 2)])
+
+    @staticmethod
+    def HashLeaf(data):
+        return hashlib.sha256(MistMerkleTree.LEAF_PREFIX + data).digest()
+
+    @staticmethod
+    def _HashNode(left, right):
+        return hashlib.sha256(MistMerkleTree.NODE_PREFIX + left + right).digest()
+
+    @staticmethod
+    def FromData(data, block_size=settings.PROOF_BLOCK_SIZE):
+        """Returns the tree over data split into blocks of block_size."""
+        return MistMerkleTree([MistMerkleTree.HashLeaf(data[i:i + block_size]) for i in xrange(0, len(data), block_size)])
+
+    @staticmethod
+    def LeafCount(size, block_size=settings.PROOF_BLOCK_SIZE):
+        return (size + block_size - 1) // block_size
+
+    def Root(self):
+        return self._levels[-1][0].encode("hex")
+
+    def Proof(self, index):
+        """Returns the sibling hashes that prove the leaf at index, from the bottom up."""
+        proof = []
+        for level in self._levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                proof.append(level[sibling].encode("hex"))
+            index //= 2
+        return proof
+
+    @staticmethod
+    def Verify(leaf_hash, index, leaf_count, proof, root):
+        """Returns whether proof shows the leaf at index to be under root."""
+        node = leaf_hash
+        proof = iter(proof)
+        width = leaf_count
+        try:
+            while width > 1:
+                if index ^ 1 < width:
+                    sibling = next(proof).decode("hex")
+                    node = MistMerkleTree._HashNode(node, sibling) if index % 2 == 0 else MistMerkleTree._HashNode(sibling, node)
+                index //= 2
+                width = (width + 1) // 2
+        except (StopIteration, TypeError):
+            return False
+        return next(proof, None) is None and node.encode("hex") == root
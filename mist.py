@@ -1,14 +1,22 @@
 import uuid
-import pickle
 import os
 import threading
+import contextlib
 import logging
 
 import network
 import network_member
 import mist_watchdog
 import files
+import crypto
 import data_files
+import journal
+import merkle
+import rebalance
+import repair
+import retry
+import transfer
+import settings
 
 
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +31,7 @@ class Mist(object):
     """Main Mist class"""
 
     DEFAULT_INDEX_FILENAME = "index"
+    DEFAULT_RETRIES_FILENAME = "retries"
 
     def __init__(self, root_path, autostart=False):
         self.uid = uuid.uuid4()
@@ -34,9 +43,20 @@ class Mist(object):
         self.root_path = root_path
         self.mist_files = {}
         self.mist_data_files = {}
+        # Data files handed off to their owners on the hash ring, as a dict
+        # of member uid to the references moved there, for forwarding.
+        self.moved_data_files = {}
+        self.mist_network_data_file_store = data_files.MistNetworkDataFileStore()
         self.event_handler = None
         self.observer = None
+        self.rebalancer = None
+        self.repairer = None
         self._lock = threading.Lock()
+        self._index_journal = journal.MistJournal(os.path.join(self.root_path, Mist.DEFAULT_INDEX_FILENAME))
+        self.retry_queue = retry.MistRetryQueue(os.path.join(self.root_path, Mist.DEFAULT_RETRIES_FILENAME), {
+            "store": self._RetryStores,
+            "repair": self._RetryRepairs,
+        })
 
         if autostart:
             self.Start()
@@ -50,70 +70,216 @@ class Mist(object):
         return Mist(root_path)
 
     def Start(self, network=None):
+        # Loading the index already starts storing data files on threads.
+        crypto.shared_crypto_engine.Start()
         self._LoadMistFiles()
+        self.retry_queue.Start()
         self._StartWatchdogObserver()
         if network:
             self.JoinNetwork(network)
+        self.Reconcile()
 
     def Stop(self):
         if self.observer:
             self.observer.stop()
             self.observer.join()
-        self._RewriteMistIndexFile()
+            self.event_handler.Stop()
+        self.retry_queue.Stop()
+        self._CompactMistIndex()
+        self._index_journal.Close()
         if self.mist_network_address:
             self.LeaveNetwork()
 
     def _StartWatchdogObserver(self):
         self.event_handler = mist_watchdog.MistWatchdogEventHandler(self)
+        self.event_handler.Start()
         self.observer = mist_watchdog.MistWatchdogObserver()
         self.observer.schedule(self.event_handler, self.root_path, recursive=True)
         self.observer.start()
 
     def _LoadMistFiles(self):
-        if os.path.isfile(os.path.join(self.root_path, Mist.DEFAULT_INDEX_FILENAME)):
-            with open(os.path.join(self.root_path, Mist.DEFAULT_INDEX_FILENAME), "r") as infile:
-                (self.mist_network_member_uid, self.mist_files, self.mist_data_files) = self._PerformWithLock(pickle.load, infile)
+        with self._lock:
+            (snapshot, records) = self._index_journal.Load()
+            if snapshot:
+                # Indexes saved before files were split into blocks have
+                # neither a data file store nor moved data files.
+                (self.mist_network_member_uid, self.mist_files, self.mist_data_files) = snapshot[:3]
+                if len(snapshot) > 3:
+                    self.mist_network_data_file_store = snapshot[3]
+                self.moved_data_files = snapshot[4] if len(snapshot) > 4 else {}
+            for record in records:
+                self._ApplyIndexRecord(record)
+
+            # Files share the one data file store, whose reference counts are
+            # rebuilt from the files rather than saved.
+            for mist_file in self.mist_files.values():
+                mist_file.SetDataFileStore(self.mist_network_data_file_store)
+            self.mist_network_data_file_store.RecountReferences(self.mist_files.values())
+        if snapshot is None or records or len(snapshot) < len(self._MistIndexSnapshot()):
+            self._CompactMistIndex()
+
+    def _IndexCollection(self, name):
+        if name == "mist_network_data_files":
+            return self.mist_network_data_file_store.mist_network_data_files
+        return getattr(self, name)
+
+    def _ApplyIndexRecord(self, record):
+        (operation, name, key, value) = record
+        if name is None:
+            setattr(self, key, value)
+        elif operation == "set":
+            self._IndexCollection(name)[key] = value
         else:
-            self._RewriteMistIndexFile()
+            self._IndexCollection(name).pop(key, None)
 
-    def _RewriteMistIndexFile(self):
-        with self._lock:
-            with open(os.path.join(self.root_path, Mist.DEFAULT_INDEX_FILENAME), "wb") as outfile:
-                pickle.dump((self.mist_network_member_uid, self.mist_files, self.mist_data_files), outfile)
+    def _JournalSet(self, name, key, value):
+        self._index_journal.Append(("set", name, key, value))
+
+    def _JournalDelete(self, name, key):
+        self._index_journal.Append(("delete", name, key, None))
+
+    def _JournalNetworkDataFiles(self, content_hashes):
+        for content_hash in set(content_hashes):
+            mist_network_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_network_data_file:
+                self._JournalSet("mist_network_data_files", content_hash, mist_network_data_file)
+            else:
+                self._JournalDelete("mist_network_data_files", content_hash)
+
+    def _MistIndexSnapshot(self):
+        return (self.mist_network_member_uid, self.mist_files, self.mist_data_files, self.mist_network_data_file_store, self.moved_data_files)
+
+    def _CompactMistIndex(self):
+        self._index_journal.Compact(self._MistIndexSnapshot, self._lock)
+
+    def _CompactMistIndexIfNeeded(self):
+        if self._index_journal.NeedsCompaction() and not self._index_journal.InBatch():
+            self._CompactMistIndex()
+
+    @contextlib.contextmanager
+    def IndexBatch(self, batch=None):
+        """Commits the index changes made in the block together, see MistJournal.Batch."""
+        with self._index_journal.Batch(batch) as batch:
+            yield batch
+        self._CompactMistIndexIfNeeded()
 
     def _PerformWithLock(self, func, *args, **kwargs):
         with self._lock:
             return func(*args, **kwargs)
 
-    def _SetDictKeyValueWithLock(self, dictionary, key, value):
-        def Set():
-            dictionary[key] = value
-        self._PerformWithLock(Set)
-
-    def _DeleteDictKeyWithLock(self, dictionary, key):
-        def Delete():
-            del dictionary[key]
-        self._PerformWithLock(Delete)
+    def Reconcile(self):
+        """Syncs the changes made to the account folder while Mist was stopped.
+
+        Files whose size, mtime and inode have not changed are not read.
+        Changed files are queued on the event handler like watched changes.
+        """
+        operations = []
+        found_paths = set()
+        with self.IndexBatch():
+            for (root, dirnames, filenames) in os.walk(self.root_path):
+                dirnames[:] = [dirname for dirname in dirnames if not self.event_handler.IsIgnored(os.path.join(root, dirname))]
+                for filename in filenames:
+                    file_path = os.path.join(root, filename)
+                    if self.event_handler.IsIgnored(file_path):
+                        continue
+                    try:
+                        stat_result = os.stat(file_path)
+                    except OSError:
+                        continue
+                    found_paths.add(file_path)
+                    mist_file = self.mist_files.get(file_path)
+                    if mist_file is None:
+                        operations.append(("create", file_path))
+                    elif not mist_file.Matches(file_path, stat_result):
+                        operations.append(("modify", file_path))
+                    elif mist_file.fingerprint != files.MistFile.Fingerprint(stat_result):
+                        self._UpdateFingerprint(file_path, mist_file, stat_result)
+            # Files added from outside the account folder are left alone.
+            folder_path = os.path.join(self.root_path, "")
+            for file_path in self.mist_files.keys():
+                if file_path.startswith(folder_path) and file_path not in found_paths:
+                    operations.append(("delete", file_path))
+        if operations:
+            logger.info("Reconciled account folder. Changed files: %s", len(operations))
+        self.event_handler.QueueOperations(operations)
+
+    def _UpdateFingerprint(self, file_path, mist_file, stat_result):
+        # Content matched, so only the record of it needs updating.
+        if mist_file.content_hash is None:
+            mist_file.content_hash = files.MistFile.HashFile(file_path)
+        mist_file.fingerprint = files.MistFile.Fingerprint(stat_result)
+        self._PerformWithLock(self._JournalSet, "mist_files", file_path, mist_file)
 
     def RefreshIndex(self):
-        self._RewriteMistIndexFile()
+        self._CompactMistIndexIfNeeded()
 
     def AddFile(self, file_path, overwrite=True):
         if file_path in self.mist_files:
             if overwrite:
-                self.DeleteFile(file_path)
+                self.ModifyFile(file_path)
             else:
                 logger.error("File already exists. File path: %s", file_path)
-                return
+            return
+
+        mist_file = files.MistFile(file_path, self.mist_network_address, self.mist_network_data_file_store)
+        mist_file.WaitUntilStored(data_files.MistDataFile.DEFAULT_READ_TIMEOUT)
+        self._RetryFailedStores(mist_file.content_hashes)
+
+        def Add():
+            self.mist_files[file_path] = mist_file
+            self._JournalNetworkDataFiles(mist_file.content_hashes)
+            self._JournalSet("mist_files", file_path, mist_file)
+        self._PerformWithLock(Add)
+        self._CompactMistIndexIfNeeded()
+
+    def _RetryFailedStores(self, content_hashes):
+        for content_hash in set(content_hashes):
+            mist_network_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_network_data_file and mist_network_data_file.StoreFailed():
+                self.retry_queue.Add("store", None, content_hash)
+
+    def _RetryStores(self, member_uid, content_hashes):
+        results = []
+        for content_hash in content_hashes:
+            mist_network_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_network_data_file is None:
+                results.append(True)
+            elif mist_network_data_file.RetryStore():
+                self._PerformWithLock(self._JournalNetworkDataFiles, [content_hash])
+                results.append(True)
+            else:
+                results.append(False)
+        self._CompactMistIndexIfNeeded()
+        return results
 
-        self._SetDictKeyValueWithLock(self.mist_files, file_path, files.MistFile(file_path, self.mist_network_address))
-        self._RewriteMistIndexFile()
+    def _RetryRepairs(self, member_uid, content_hashes):
+        if self.repairer is None:
+            return [False] * len(content_hashes)
+        member_uids = self.mist_network_client.GetMembers()
+        return [self.repairer.RepairChunk(content_hash, member_uids) for content_hash in content_hashes]
 
     def ModifyFile(self, file_path, overwrite=True):
         if file_path in self.mist_files:
-            self.DeleteFile(file_path)
-            self._SetDictKeyValueWithLock(self.mist_files, file_path, files.MistFile(file_path, self.mist_network_address))
-            self._RewriteMistIndexFile()
+            # Unchanged chunks are already in the data file store, so building
+            # the new version only uploads the chunks that differ.
+            mist_file = files.MistFile(file_path, self.mist_network_address, self.mist_network_data_file_store)
+            mist_file.WaitUntilStored(data_files.MistDataFile.DEFAULT_READ_TIMEOUT)
+            self._RetryFailedStores(mist_file.content_hashes)
+
+            def Swap():
+                old_mist_file = self.mist_files.get(file_path)
+                self.mist_files[file_path] = mist_file
+                self._JournalNetworkDataFiles(mist_file.content_hashes)
+                self._JournalSet("mist_files", file_path, mist_file)
+                return old_mist_file
+            old_mist_file = self._PerformWithLock(Swap)
+
+            if old_mist_file:
+                content_hashes = list(old_mist_file.content_hashes)
+                if not old_mist_file.Delete():
+                    logger.warning("Unable to release previous version of file. File path: %s", file_path)
+                self._PerformWithLock(self._JournalNetworkDataFiles, content_hashes)
+            self._CompactMistIndexIfNeeded()
         else:
             logger.error("File does not exist. File path: %s", file_path)
 
@@ -128,21 +294,96 @@ class Mist(object):
         else:
             logger.warning("File not found. File path: %s", file_path)
             return None
-        self._RewriteMistIndexFile()
+
+    def ReadFileIter(self, file_path):
+        if file_path in self.mist_files:
+            for data in self.mist_files[file_path].ReadIter():
+                yield data
+        else:
+            logger.warning("File not found. File path: %s", file_path)
 
     def DeleteFile(self, file_path):
         if file_path in self.mist_files:
-            if self.mist_files[file_path].Delete():
-                self._DeleteDictKeyWithLock(self.mist_files, file_path)
-                self._RewriteMistIndexFile()
-            else:
-                return False
+            mist_file = self.mist_files[file_path]
+            content_hashes = list(mist_file.content_hashes)
+            deleted = mist_file.Delete()
+
+            def Delete():
+                if deleted:
+                    del self.mist_files[file_path]
+                    self._JournalDelete("mist_files", file_path)
+                else:
+                    self._JournalSet("mist_files", file_path, mist_file)
+                self._JournalNetworkDataFiles(content_hashes)
+            self._PerformWithLock(Delete)
+            self._CompactMistIndexIfNeeded()
+            return deleted
         return True
 
+    def VerifyFiles(self):
+        """Checks that the network still holds every file, without reading them.
+
+        Every member holding a chunk is asked to prove it. Returns the paths
+        of the files that could not be read back.
+        """
+        failed_paths = set(file_path for (file_path, mist_file) in self.mist_files.items() if not mist_file.VerifyManifest())
+        for file_path in failed_paths:
+            logger.error("Corrupted file manifest. File path: %s", file_path)
+
+        content_hashes = set()
+        for mist_file in self.mist_files.values():
+            content_hashes.update(mist_file.content_hashes)
+
+        def Verify(content_hash):
+            mist_network_data_file = self.mist_network_data_file_store.Get(content_hash)
+            if mist_network_data_file is None:
+                return (0, False)
+            return mist_network_data_file.Verify()
+
+        content_hashes = list(content_hashes)
+        tasks = transfer.RunConcurrently(Verify, content_hashes, settings.TRANSFER_WORKERS)
+        lost_hashes = set(content_hash for (content_hash, task) in zip(content_hashes, tasks) if task.result is not None and not task.result[1])
+        unproven_count = sum(task.result is None for task in tasks)
+        for (file_path, mist_file) in self.mist_files.items():
+            if lost_hashes.intersection(mist_file.content_hashes):
+                logger.error("File can no longer be read. File path: %s", file_path)
+                failed_paths.add(file_path)
+        logger.info("Verified files. Files: %s, Chunks: %s, Lost chunks: %s, Chunks stored without proofs: %s", len(self.mist_files), len(content_hashes), len(lost_hashes), unproven_count)
+        return sorted(failed_paths)
+
+    def RepairDataFile(self, content_hash, lost_member_uids):
+        """Replaces the copies of a chunk held by lost_member_uids. Returns the number of bytes transferred."""
+        mist_network_data_file = self.mist_network_data_file_store.Get(content_hash)
+        if mist_network_data_file is None:
+            return 0
+        transferred = mist_network_data_file.Repair(lost_member_uids)
+
+        def Journal():
+            if self.mist_network_data_file_store.Get(content_hash) is not mist_network_data_file:
+                return False
+            self._JournalSet("mist_network_data_files", content_hash, mist_network_data_file)
+            return True
+        if not self._PerformWithLock(Journal):
+            # The chunk was released while it was being repaired, so the
+            # copies just made are released too.
+            mist_network_data_file.Delete()
+        self._CompactMistIndexIfNeeded()
+        return transferred
+
     def ExportFile(self, file_path, export_path):
-        data = self.ReadFile(file_path)
-        with open(export_path, "wb") as outfile:
-            outfile.write(data)
+        if file_path not in self.mist_files:
+            logger.warning("File not found. File path: %s", file_path)
+            return False
+
+        try:
+            with open(export_path, "wb") as outfile:
+                for data in self.ReadFileIter(file_path):
+                    outfile.write(data)
+        except files.MistFileError as e:
+            logger.error("Unable to export file path: %s, Error: %s", file_path, e)
+            os.remove(export_path)
+            return False
+        return True
 
     def List(self):
         return map(str, self.mist_files)
@@ -155,12 +396,25 @@ class Mist(object):
         self.mist_local_address = "http://%s:%d" % self.mist_local_server.server_address
         uid = self.mist_network_client.JoinNetwork(self.mist_local_address, self.mist_network_member_uid)
         if uid:
-            self.mist_network_member_uid = uid
-            self._RewriteMistIndexFile()
+            def SetMemberUid():
+                self.mist_network_member_uid = uid
+                self._JournalSet(None, "mist_network_member_uid", uid)
+            self._PerformWithLock(SetMemberUid)
+            self.mist_local_server.StartReporting(self.mist_network_client, uid)
+            self.rebalancer = rebalance.MistRebalancer(self)
+            self.rebalancer.Start()
+            self.repairer = repair.MistRepairer(self)
+            self.repairer.Start()
         else:
             self.mist_local_server.Stop()
 
     def LeaveNetwork(self, local=False):
+        if self.rebalancer:
+            self.rebalancer.Stop()
+            self.rebalancer = None
+        if self.repairer:
+            self.repairer.Stop()
+            self.repairer = None
         if not local:
             self.mist_network_client.LeaveNetwork(self.mist_network_member_uid)
         self.mist_local_server.Stop()
@@ -169,11 +423,27 @@ class Mist(object):
         self.mist_network_client = None
         self.mist_network_address = None
 
-    def StoreDataFile(self, data):
-        data_file = data_files.MistDataFile(data, self.mist_network_address, self.root_path)
-        self._SetDictKeyValueWithLock(self.mist_data_files, data_file.uid, data_file)
-        self._RewriteMistIndexFile()
-        return data_file.uid
+    def StoreDataFile(self, data, references=1):
+        data_uid = data_files.MistDataFile.ContentUid(data)
+        # Chunks are written outside of the lock, each to its own path. A
+        # data file that loses the race to another store is deleted.
+        data_file = None
+        if data_uid not in self.mist_data_files:
+            data_file = data_files.MistDataFile(data, self.mist_network_address, self.root_path)
+
+        def Store():
+            if data_uid in self.mist_data_files:
+                self.mist_data_files[data_uid].references += references
+                self._JournalSet("mist_data_files", data_uid, self.mist_data_files[data_uid])
+                return data_file
+            self.mist_data_files[data_uid] = data_file or data_files.MistDataFile(data, self.mist_network_address, self.root_path)
+            self.mist_data_files[data_uid].references = references
+            self._JournalSet("mist_data_files", data_uid, self.mist_data_files[data_uid])
+        unused_data_file = self._PerformWithLock(Store)
+        self._CompactMistIndexIfNeeded()
+        if unused_data_file and not unused_data_file.Delete():
+            logger.warning("Unable to delete unused data file. Uid: %s", data_uid)
+        return data_uid
 
     def RetrieveDataFile(self, data_uid):
         if data_uid in self.mist_data_files:
@@ -183,17 +453,133 @@ class Mist(object):
                 return None
             else:
                 return data
+        elif data_uid in self.moved_data_files and self.mist_network_client:
+            # Readers with an old location are served from the new owners.
+            for member_uid in self.moved_data_files.get(data_uid, {}).keys():
+                data = self.mist_network_client.RetrieveDataFromMember(member_uid, str(data_uid))
+                if data is not None:
+                    return data
+            return None
         else:
             logger.error("Error, invalid data file uid: %s", data_uid)
             return None
 
+    def ProveDataFile(self, data_uid, index):
+        """Returns the block at index of a data file and its Merkle proof, or None."""
+        if data_uid not in self.mist_data_files and data_uid in self.moved_data_files and self.mist_network_client:
+            for member_uid in self.moved_data_files.get(data_uid, {}).keys():
+                response = self.mist_network_client.ProveDataOnMember(member_uid, data_uid, index)
+                if response is not None:
+                    return response
+            return None
+        data = self.RetrieveDataFile(data_uid)
+        if data is None or not 0 <= index < merkle.MistMerkleTree.LeafCount(len(data)):
+            return None
+        block = data[index * settings.PROOF_BLOCK_SIZE:(index + 1) * settings.PROOF_BLOCK_SIZE]
+        return (block, merkle.MistMerkleTree.FromData(data).Proof(index))
+
     def DeleteDataFile(self, data_uid):
-        if data_uid in self.mist_data_files:
-            if self.mist_data_files[data_uid].Delete():
-                self._DeleteDictKeyWithLock(self.mist_data_files, data_uid)
-                self._RewriteMistIndexFile()
-            else:
+        def Release():
+            # The reference is released and the last one removed together,
+            # so that a concurrent store either adds to the data file or
+            # makes a new one.
+            data_file = self.mist_data_files.get(data_uid)
+            if data_file is None:
+                return (False, None)
+            data_file.references -= 1
+            if data_file.references > 0:
+                self._JournalSet("mist_data_files", data_uid, data_file)
+                return (True, None)
+            del self.mist_data_files[data_uid]
+            self._JournalDelete("mist_data_files", data_uid)
+            return (True, data_file)
+        (released, data_file) = self._PerformWithLock(Release)
+        if not released:
+            if data_uid in self.moved_data_files:
+                return self._ForwardDeleteDataFile(data_uid)
+            return True
+        self._CompactMistIndexIfNeeded()
+        # Nothing refers to the data file any more, so it is deleted outside
+        # the lock. The reference is released either way, so that the
+        # delete is not sent again.
+        try:
+            if data_file and not data_file.Delete():
+                logger.warning("Unable to delete unreferenced data file. Uid: %s", data_uid)
+        except Exception as e:
+            logger.warning("Unable to delete unreferenced data file. Uid: %s, Error: %s", data_uid, e)
+        return True
+
+    def _AddMovedReferences(self, data_uid, member_uid, references):
+        moved = dict(self.moved_data_files.get(data_uid, {}))
+        moved[member_uid] = moved.get(member_uid, 0) + references
+        if moved[member_uid] <= 0:
+            del moved[member_uid]
+        if moved:
+            self.moved_data_files[data_uid] = moved
+            self._JournalSet("moved_data_files", data_uid, moved)
+        elif data_uid in self.moved_data_files:
+            del self.moved_data_files[data_uid]
+            self._JournalDelete("moved_data_files", data_uid)
+
+    def _ForwardDeleteDataFile(self, data_uid):
+        def Release():
+            moved = self.moved_data_files.get(data_uid)
+            if not moved:
+                return None
+            member_uid = next(iter(moved))
+            self._AddMovedReferences(data_uid, member_uid, -1)
+            return member_uid
+        member_uid = self._PerformWithLock(Release)
+        if member_uid is None:
+            return True
+        if self.mist_network_client and not self.mist_network_client.DeleteDataOnNetwork([member_uid], str(data_uid)):
+            return True
+        self._PerformWithLock(self._AddMovedReferences, data_uid, member_uid, 1)
+        return False
+
+    def HandOffDataFile(self, data_uid, member_uid):
+        """Moves a data file and its references to another member.
+
+        Deletes that reach this member afterwards are forwarded there.
+        """
+        data = self.RetrieveDataFile(data_uid) if data_uid in self.mist_data_files else None
+        if data is None:
+            return False
+
+        # References can change while the data is being sent, so the new
+        # owner is brought up to date until both agree under the lock.
+        sent = 0
+        while True:
+            with self._lock:
+                data_file = self.mist_data_files.get(data_uid)
+                references = data_file.references if data_file else 0
+                if references == sent:
+                    if data_file:
+                        del self.mist_data_files[data_uid]
+                        self._JournalDelete("mist_data_files", data_uid)
+                    self._AddMovedReferences(data_uid, member_uid, sent)
+                    break
+            try:
+                if references > sent:
+                    self.mist_network_client.StoreDataOnMember(member_uid, data, references - sent)
+                else:
+                    for i in xrange(sent - references):
+                        if self.mist_network_client.DeleteDataOnNetwork([member_uid], str(data_uid)):
+                            raise network.MistNetworkError("Unable to release moved reference.")
+            except Exception as e:
+                logger.warning("Unable to hand off data file. Uid: %s, Member uid: %s, Error: %s", data_uid, member_uid, e)
+                # Take back the references already handed over, as this
+                # member keeps serving them.
+                for i in xrange(sent):
+                    if self.mist_network_client.DeleteDataOnNetwork([member_uid], str(data_uid)):
+                        logger.error("Unable to take back moved references. Uid: %s, Member uid: %s", data_uid, member_uid)
+                        break
                 return False
+            sent = references
+
+        if data_file and not data_file.Delete():
+            logger.warning("Unable to remove handed off data file. Uid: %s", data_uid)
+        self._CompactMistIndexIfNeeded()
         return True
 
 
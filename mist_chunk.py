@@ -1,11 +1,10 @@
 import uuid
-import random
+import hashlib
 import struct
 import os
 import logging
-from Crypto.Cipher import AES
 
-import settings
+import crypto
 
 
 logging.basicConfig(level=logging.INFO)
@@ -24,25 +23,29 @@ class MistChunk(object):
 
     def __init__(self, file_uid, folder_path, data, root_path):
         self.file_uid = file_uid
-        self.uid = uuid.uuid4()
+        self.uid = MistChunk.ContentUid(data)
         self.size = None
-        self.chunk_path = "%s/%s/%s.%s" % (root_path, folder_path, self.uid, MistChunk.DEFAULT_EXT)
+        # Chunks of the same content are written to paths of their own, so
+        # that concurrent writes never interleave and deleting one chunk
+        # never removes another.
+        self.chunk_path = "%s/%s/%s.%s" % (root_path, folder_path, uuid.uuid4(), MistChunk.DEFAULT_EXT)
         self._WriteToPath(data)
 
+    @staticmethod
+    def ContentUid(data):
+        return uuid.UUID(bytes=hashlib.sha256(data).digest()[:16])
+
     def _WriteToPath(self, data):
-        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
-        encryptor = AES.new(settings.ENCRYPTION_KEY, AES.MODE_CBC, iv)
+        iv = crypto.RandomIv()
         self.size = len(data)
+        encrypted_data = crypto.Encrypt(data, iv)
 
         with open(self.chunk_path, "wb") as outfile:
             outfile.write(self.file_uid.bytes_le)
             outfile.write(self.uid.bytes_le)
-            outfile.write(struct.pack("<Q", self.size))
+            outfile.write(crypto.PackHeader(self.size, crypto.CTR_MODE))
             outfile.write(iv)
-
-            if len(data) % 16 != 0:
-                data += " " * (16 - len(data) % 16)
-            outfile.write(encryptor.encrypt(data))
+            outfile.write(encrypted_data)
 
     def Read(self):
         if os.path.isfile(self.chunk_path):
@@ -57,15 +60,20 @@ class MistChunk(object):
                     logger.error("UID: %s", uuid)
                     return
 
-                original_size = struct.unpack("<Q", infile.read(struct.calcsize("Q")))[0]
+                (original_size, mode, codec) = crypto.UnpackHeader(infile.read(struct.calcsize("Q")))
                 if self.size != original_size:
                     logger.error("Corrupted file due to filesize. UID: %s", uuid)
                     return
                 iv = infile.read(16)
-                decryptor = AES.new(settings.ENCRYPTION_KEY, AES.MODE_CBC, iv)
                 encrypted_data = infile.read(MistChunk.CHUNK_SIZE)
 
-            return decryptor.decrypt(encrypted_data)[:original_size]
+            data = crypto.Decrypt(encrypted_data, iv, mode, original_size)
+            # The uid is a hash of the content, which catches corruption that
+            # keeps the size.
+            if MistChunk.ContentUid(data) != self.uid:
+                logger.error("Corrupted chunk due to content hash. UID: %s", self.uid)
+                return
+            return data
         else:
             logger.error("Chunk is invalid.")
 
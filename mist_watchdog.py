@@ -1,9 +1,18 @@
 from __future__ import with_statement
 import mist
 import files
+import journal
 import os
+import fnmatch
 import logging
 import collections
+import select
+import time
+import Queue
+import threading
+import settings
+import transfer
+from watchdog.utils import UnsupportedLibc
 from watchdog.utils.dirsnapshot import DirectorySnapshotDiff
 from watchdog.observers.polling import PollingEmitter
 from watchdog.observers.api import (
@@ -23,12 +32,25 @@ from watchdog.events import (
 )
 from watchdog.events import PatternMatchingEventHandler
 
+try:
+    from watchdog.observers.inotify_c import Inotify
+except (ImportError, OSError, UnsupportedLibc):
+    # Not on Linux, changes are found by polling.
+    Inotify = None
+
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
 class MistWatchdogPollingEmitter(PollingEmitter):
+    """Mist Watchdog Polling Emitter
+
+    Diffs a snapshot of the whole tree on every tick. A file only becomes
+    an event once it has not changed for MODIFYING_DELAY_COUNT ticks, so
+    that files still being written are not synced half way.
+    """
+
     MODIFYING_DELAY_COUNT = 10
 
     def __init__(self, *args, **kwargs):
@@ -53,41 +75,18 @@ class MistWatchdogPollingEmitter(PollingEmitter):
 
             # Files.
             for src_path in events.files_deleted:
-                self._modifying_files[None][src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
-                # self.queue_event(FileDeletedEvent(src_path))
+                self._FileDeleted(src_path)
 
             for src_path in events.files_modified:
-                self._modifying_files[src_path][src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+                self._FileModified(src_path)
 
             for src_path in events.files_created:
-                self._modifying_files[src_path][None] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
-                # self.queue_event(FileCreatedEvent(src_path))
+                self._FileCreated(src_path)
 
             for src_path, dest_path in events.files_moved:
-                self._modifying_files[dest_path] = self._modifying_files[src_path]
-                del self._modifying_files[src_path]
-                for modifying_src_path in self._modifying_files[dest_path]:
-                    self._modifying_files[dest_path][modifying_src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
-                # self.queue_event(FileMovedEvent(src_path, dest_path))
-
-            deletion_list = []
-
-            for modifying_dest_path in self._modifying_files:
-                for modifying_src_path in self._modifying_files[modifying_dest_path]:
-                    self._modifying_files[modifying_dest_path][modifying_src_path] -= 1
-                    if self._modifying_files[modifying_dest_path][modifying_src_path] == 0:
-                        logging.debug("New Event: Src: %s, Dest: %s", (modifying_src_path, modifying_dest_path))
-                        if modifying_dest_path is not None and modifying_src_path is not None:
-                            self.queue_event(FileDeletedEvent(modifying_src_path))
-                            self.queue_event(FileCreatedEvent(modifying_dest_path))
-                        elif modifying_dest_path is not None:
-                            self.queue_event(FileCreatedEvent(modifying_dest_path))
-                        elif modifying_src_path is not None:
-                            self.queue_event(FileDeletedEvent(modifying_src_path))
-                        deletion_list.append((modifying_dest_path, modifying_src_path))
-
-            for (dest_path, src_path) in deletion_list:
-                del self._modifying_files[dest_path][src_path]
+                self._FileMoved(src_path, dest_path)
+
+            self._QueueSettledFiles()
 
             # Directories.
             for src_path in events.dirs_deleted:
@@ -99,10 +98,188 @@ class MistWatchdogPollingEmitter(PollingEmitter):
             for src_path, dest_path in events.dirs_moved:
                 self.queue_event(DirMovedEvent(src_path, dest_path))
 
+    def _FileDeleted(self, src_path):
+        self._modifying_files[None][src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+
+    def _FileModified(self, src_path):
+        # A file that is still being created only needs its creation delayed.
+        if None in self._modifying_files[src_path]:
+            self._modifying_files[src_path][None] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+        else:
+            self._modifying_files[src_path][src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+
+    def _FileCreated(self, src_path):
+        # A file deleted and created again before the deletion was queued
+        # has been replaced, which is queued as a modification.
+        if self._modifying_files[None].pop(src_path, None) is not None:
+            self._modifying_files[src_path][src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+        else:
+            self._modifying_files[src_path][None] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+
+    def _FileMoved(self, src_path, dest_path):
+        self._modifying_files[dest_path] = self._modifying_files[src_path]
+        del self._modifying_files[src_path]
+        for modifying_src_path in self._modifying_files[dest_path]:
+            self._modifying_files[dest_path][modifying_src_path] = MistWatchdogPollingEmitter.MODIFYING_DELAY_COUNT
+
+    def _QueueSettledFiles(self):
+        deletion_list = []
+
+        for modifying_dest_path in self._modifying_files:
+            for modifying_src_path in self._modifying_files[modifying_dest_path]:
+                self._modifying_files[modifying_dest_path][modifying_src_path] -= 1
+                if self._modifying_files[modifying_dest_path][modifying_src_path] == 0:
+                    logger.debug("New Event: Src: %s, Dest: %s", modifying_src_path, modifying_dest_path)
+                    if modifying_dest_path is not None and modifying_src_path == modifying_dest_path:
+                        # Modified files are synced with their unchanged
+                        # chunks kept, rather than deleted and created again.
+                        self.queue_event(FileModifiedEvent(modifying_dest_path))
+                    elif modifying_dest_path is not None and modifying_src_path is not None:
+                        self.queue_event(FileDeletedEvent(modifying_src_path))
+                        self.queue_event(FileCreatedEvent(modifying_dest_path))
+                    elif modifying_dest_path is not None:
+                        self.queue_event(FileCreatedEvent(modifying_dest_path))
+                    elif modifying_src_path is not None:
+                        self.queue_event(FileDeletedEvent(modifying_src_path))
+                    deletion_list.append((modifying_dest_path, modifying_src_path))
+
+        for (dest_path, src_path) in deletion_list:
+            del self._modifying_files[dest_path][src_path]
+
+
+class MistWatchdogInotifyEmitter(MistWatchdogPollingEmitter):
+    """Mist Watchdog Inotify Emitter
+
+    Feeds inotify events into the same delay as the polling emitter, one
+    tick every timeout, so the tree is never walked. Falls back to polling
+    when inotify runs out of watches.
+    """
+
+    INOTIFY_LIMIT_ERRORS = [
+        "inotify watch limit reached",
+        "inotify instance limit reached",
+    ]
+
+    def __init__(self, *args, **kwargs):
+        MistWatchdogPollingEmitter.__init__(self, *args, **kwargs)
+        self._inotify = None
+        self._next_tick = None
+        # Move sources waiting for their destination, by cookie.
+        self._moved_from_paths = {}
+        self._moved_from_directories = {}
+
+    def on_thread_start(self):
+        try:
+            self._inotify = Inotify(self.watch.path, self.watch.is_recursive)
+        except OSError as e:
+            self._FallBackToPolling(e)
+            return
+        self._next_tick = time.time() + self.timeout
+
+    def on_thread_stop(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _FallBackToPolling(self, error):
+        if str(error) not in MistWatchdogInotifyEmitter.INOTIFY_LIMIT_ERRORS:
+            raise error
+        logger.warning("Falling back to polling. Path: %s, Error: %s", self.watch.path, error)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._snapshot = self._take_snapshot()
+
+    def queue_events(self, timeout):
+        if self._inotify is None:
+            return MistWatchdogPollingEmitter.queue_events(self, timeout)
+
+        remaining = self._next_tick - time.time()
+        if remaining > 0:
+            (readable, _, _) = select.select([self._inotify.fd], [], [], remaining)
+            if readable and self.should_keep_running():
+                inotify_events = self._inotify.read_events()
+                with self._lock:
+                    for inotify_event in inotify_events:
+                        try:
+                            self._QueueInotifyEvent(inotify_event)
+                        except OSError as e:
+                            self._FallBackToPolling(e)
+                            return
+            if time.time() < self._next_tick:
+                return
+
+        with self._lock:
+            if not self.should_keep_running():
+                return
+            # Sources whose destination did not turn up moved out of the tree.
+            for src_path in self._moved_from_paths.values():
+                self._FileDeleted(src_path)
+            self._moved_from_paths.clear()
+            for src_path in self._moved_from_directories.values():
+                self.queue_event(DirDeletedEvent(src_path))
+            self._moved_from_directories.clear()
+            self._QueueSettledFiles()
+        self._next_tick = time.time() + self.timeout
+
+    def _QueueInotifyEvent(self, inotify_event):
+        src_path = inotify_event.src_path
+        if inotify_event.is_directory:
+            if inotify_event.is_create:
+                # Make sure the directory is watched, as the inotify wrapper
+                # ignores the watch limit here.
+                self._inotify.add_watch(src_path)
+                self.queue_event(DirCreatedEvent(src_path))
+            elif inotify_event.is_moved_to:
+                move_src_path = self._moved_from_directories.pop(inotify_event.cookie, None)
+                if move_src_path is not None:
+                    self._DirectoryMoved(move_src_path, src_path)
+                else:
+                    self._DirectoryCreated(src_path)
+            elif inotify_event.is_moved_from:
+                # Files in a directory moved out of the tree are not reported
+                # one by one and are only picked up by a full scan.
+                self._moved_from_directories[inotify_event.cookie] = src_path
+            elif inotify_event.is_delete:
+                self.queue_event(DirDeletedEvent(src_path))
+            elif inotify_event.is_modify or inotify_event.is_attrib:
+                self.queue_event(DirModifiedEvent(src_path))
+            return
+
+        if inotify_event.is_create:
+            self._FileCreated(src_path)
+        elif inotify_event.is_modify or inotify_event.is_attrib:
+            self._FileModified(src_path)
+        elif inotify_event.is_delete:
+            self._FileDeleted(src_path)
+        elif inotify_event.is_moved_from:
+            self._moved_from_paths[inotify_event.cookie] = src_path
+        elif inotify_event.is_moved_to:
+            move_src_path = self._moved_from_paths.pop(inotify_event.cookie, None)
+            if move_src_path is not None:
+                self._FileMoved(move_src_path, src_path)
+            else:
+                self._FileCreated(src_path)
+
+    def _DirectoryCreated(self, path):
+        self.queue_event(DirCreatedEvent(path))
+        for (root, dirnames, filenames) in os.walk(path):
+            for dirname in dirnames:
+                self._inotify.add_watch(os.path.join(root, dirname))
+            for filename in filenames:
+                self._FileCreated(os.path.join(root, filename))
+
+    def _DirectoryMoved(self, src_path, dest_path):
+        self.queue_event(DirMovedEvent(src_path, dest_path))
+        for (root, dirnames, filenames) in os.walk(dest_path):
+            for filename in filenames:
+                moved_path = os.path.join(root, filename)
+                self._FileMoved(os.path.join(src_path, os.path.relpath(moved_path, dest_path)), moved_path)
+
 
 class MistWatchdogObserver(BaseObserver):
     def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
-        BaseObserver.__init__(self, emitter_class=MistWatchdogPollingEmitter, timeout=timeout)
+        emitter_class = MistWatchdogPollingEmitter if Inotify is None else MistWatchdogInotifyEmitter
+        BaseObserver.__init__(self, emitter_class=emitter_class, timeout=timeout)
 
 
 class MistWatchdogEventHandler(PatternMatchingEventHandler):
@@ -115,6 +292,13 @@ class MistWatchdogEventHandler(PatternMatchingEventHandler):
     IGNORED_MIST_ROOT_PATHS = [
         (files.MistFile.STORAGE_FOLDER_PATH, "folder"),
         (mist.Mist.DEFAULT_INDEX_FILENAME, "file"),
+        ("%s.%s" % (mist.Mist.DEFAULT_INDEX_FILENAME, journal.MistJournal.JOURNAL_EXT), "file"),
+        ("%s.%s.%s" % (mist.Mist.DEFAULT_INDEX_FILENAME, journal.MistJournal.JOURNAL_EXT, journal.MistJournal.OLD_JOURNAL_EXT), "file"),
+        ("%s.%s" % (mist.Mist.DEFAULT_INDEX_FILENAME, journal.MistJournal.SNAPSHOT_TMP_EXT), "file"),
+        (mist.Mist.DEFAULT_RETRIES_FILENAME, "file"),
+        ("%s.%s" % (mist.Mist.DEFAULT_RETRIES_FILENAME, journal.MistJournal.JOURNAL_EXT), "file"),
+        ("%s.%s.%s" % (mist.Mist.DEFAULT_RETRIES_FILENAME, journal.MistJournal.JOURNAL_EXT, journal.MistJournal.OLD_JOURNAL_EXT), "file"),
+        ("%s.%s" % (mist.Mist.DEFAULT_RETRIES_FILENAME, journal.MistJournal.SNAPSHOT_TMP_EXT), "file"),
     ]
 
     IGNORED_PATTERNS = [
@@ -122,22 +306,47 @@ class MistWatchdogEventHandler(PatternMatchingEventHandler):
 
     ]
 
-    def __init__(self, mist_parent):
+    def __init__(self, mist_parent, batch_window=settings.WATCHDOG_BATCH_WINDOW, batch_size=settings.WATCHDOG_BATCH_SIZE, batch_workers=settings.WATCHDOG_BATCH_WORKERS):
         super(MistWatchdogEventHandler, self).__init__(ignore_patterns=MistWatchdogEventHandler.IGNORED_PATTERNS)
         self.mist_parent = mist_parent
-
-    def dispatch(self, event):
-        for (path, path_type) in MistWatchdogEventHandler.IGNORED_MIST_ROOT_PATHS:
-            full_path = os.path.join(self.mist_parent.root_path, path)
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batch_workers = batch_workers
+        self._operations = Queue.Queue()
+        self._thread = None
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._Work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        """Syncs the events already handled and stops."""
+        self._operations.put(None)
+        self._thread.join()
+
+    def IsIgnored(self, path):
+        for (ignored_path, path_type) in MistWatchdogEventHandler.IGNORED_MIST_ROOT_PATHS:
+            full_path = os.path.join(self.mist_parent.root_path, ignored_path)
             if path_type == "folder":
-                if os.path.commonprefix([event.src_path, full_path]) == full_path:
-                    return
+                if os.path.commonprefix([path, full_path]) == full_path:
+                    return True
             elif path_type == "file":
-                if event.src_path == full_path:
-                    return
+                if path == full_path:
+                    return True
+        return any(fnmatch.fnmatch(path, pattern) for pattern in MistWatchdogEventHandler.IGNORED_PATTERNS)
+
+    def dispatch(self, event):
+        if self.IsIgnored(event.src_path):
+            return
 
         super(MistWatchdogEventHandler, self).dispatch(event)
 
+    def QueueOperations(self, operations):
+        """Queues (operation, path) pairs to be synced like handled events."""
+        for operation in operations:
+            self._operations.put(operation)
+
     def on_moved(self, event):
         super(MistWatchdogEventHandler, self).on_moved(event)
 
@@ -145,21 +354,17 @@ class MistWatchdogEventHandler(PatternMatchingEventHandler):
         logging.debug("Moved %s: from %s to %s", what, event.src_path, event.dest_path)
 
         if not event.is_directory:
-            self.mist_parent.DeleteFile(event.src_path)
-            self.mist_parent.AddFile(event.dest_path)
-
-        logging.debug("%s: %s", self.mist_parent.root_path, self.mist_parent.List())
+            self._operations.put(("delete", event.src_path))
+            self._operations.put(("add", event.dest_path))
 
     def on_created(self, event):
         super(MistWatchdogEventHandler, self).on_created(event)
 
         what = 'directory' if event.is_directory else 'file'
-        logging.debug("Created %s: %s", (what, event.src_path))
+        logging.debug("Created %s: %s", what, event.src_path)
 
         if not event.is_directory:
-            self.mist_parent.AddFile(event.src_path, False)
-
-        logging.debug("%s: %s", self.mist_parent.root_path, self.mist_parent.List())
+            self._operations.put(("create", event.src_path))
 
     def on_deleted(self, event):
         super(MistWatchdogEventHandler, self).on_deleted(event)
@@ -168,9 +373,7 @@ class MistWatchdogEventHandler(PatternMatchingEventHandler):
         logging.debug("Deleted %s: %s", what, event.src_path)
 
         if not event.is_directory:
-            self.mist_parent.DeleteFile(event.src_path)
-
-        logging.debug("%s: %s", self.mist_parent.root_path, self.mist_parent.List())
+            self._operations.put(("delete", event.src_path))
 
     def on_modified(self, event):
         super(MistWatchdogEventHandler, self).on_modified(event)
@@ -179,6 +382,68 @@ class MistWatchdogEventHandler(PatternMatchingEventHandler):
         logging.debug("Modified %s: %s", what, event.src_path)
 
         if not event.is_directory:
-            self.mist_parent.ModifyFile(event.src_path)
-
+            self._operations.put(("modify", event.src_path))
+
+    def _Work(self):
+        running = True
+        while running:
+            batch = [self._operations.get()]
+            deadline = time.time() + self.batch_window
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._operations.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if batch:
+                try:
+                    self.ProcessBatch(batch)
+                except Exception:
+                    logger.exception("Unable to sync batch.")
+
+    def ProcessBatch(self, operations):
+        """Syncs a batch of file operations and commits the index once.
+
+        Operations on one path run in order, and different paths are synced
+        concurrently. A path that is deleted and then created again is
+        synced as a modification, so that its unchanged chunks are kept.
+        """
+        path_operations = collections.OrderedDict()
+        for (operation, path) in operations:
+            pending = path_operations.setdefault(path, [])
+            if pending and pending[-1] == "delete" and operation in ("create", "add"):
+                # Adding with overwrite modifies the file if it is stored.
+                pending.pop()
+                operation = "add"
+            if not pending or pending[-1] != operation:
+                pending.append(operation)
+
+        with self.mist_parent.IndexBatch() as batch:
+            def ProcessPath(path_operations):
+                with self.mist_parent.IndexBatch(batch):
+                    self._ProcessPath(path_operations)
+
+            transfer.RunConcurrently(ProcessPath, path_operations.items(), self.batch_workers)
+
+        logger.info("Synced batch. Operations: %s, Paths: %s", len(operations), len(path_operations))
         logging.debug("%s: %s", self.mist_parent.root_path, self.mist_parent.List())
+
+    def _ProcessPath(self, path_operations):
+        (path, operations) = path_operations
+        for operation in operations:
+            try:
+                if operation == "add":
+                    self.mist_parent.AddFile(path)
+                elif operation == "create":
+                    self.mist_parent.AddFile(path, False)
+                elif operation == "modify":
+                    self.mist_parent.ModifyFile(path)
+                elif operation == "delete":
+                    self.mist_parent.DeleteFile(path)
+            except Exception:
+                logger.exception("Unable to sync file. Operation: %s, Path: %s", operation, path)
@@ -1,13 +1,22 @@
 import uuid
-import random
-import pickle
-import os
 import pyjsonrpc
+import urlparse
+from pyjsonrpc import rpcrequest, rpcresponse, rpcerror
 import threading
 import logging
 import time
+import collections
 from gevent import pool
 import network_member
+import transport
+import transfer
+import journal
+import retry
+import cache
+import placement
+import ring
+import mist_chunk
+import settings
 
 
 logging.basicConfig(level=logging.INFO)
@@ -19,12 +28,41 @@ class MistNetworkError(Exception):
 
 
 class MistNetworkClient(pyjsonrpc.HttpClient):
+    # Weight of the newest sample in the smoothed latency of a peer.
+    LATENCY_SMOOTHING = 0.2
+
+    _peer_addresses = {}
+    _peer_latencies = {}
+    _rings = {}
+    _peer_addresses_lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        if not isinstance(method, basestring):
+            return pyjsonrpc.HttpClient.call(self, method, *args, **kwargs)
+
+        # Send requests over pooled keep-alive connections instead of opening
+        # a new connection for every call.
+        request_json = rpcrequest.create_request_json(method, *args, **kwargs)
+        (status, response_json) = transport.shared_connection_pool.Request(
+            self.url, "POST", urlparse.urlparse(self.url).path or "/", request_json, {"Content-Type": "application/json"})
+        if status != 200:
+            raise MistNetworkError("Request failed. Address: %s, Method: %s, Status: %s" % (self.url, method, status))
+        if not response_json:
+            return
+
+        response = rpcresponse.parse_response_json(response_json)
+        if response.error:
+            if response.error.code in rpcerror.jsonrpcerrors:
+                raise rpcerror.jsonrpcerrors[response.error.code](message=response.error.message, data=response.error.data)
+            raise rpcerror.JsonRpcError(message=response.error.message, data=response.error.data, code=response.error.code)
+        return response.result
+
     def JoinNetwork(self, member_address, member_uid=None):
         try:
-            if self.mist_network_member_uid:
+            if member_uid:
                 response = self.join(member_address, str(member_uid))
             else:
-                response = self.join(self.mist_local_address)
+                response = self.join(member_address)
             return uuid.UUID(response["network_member_uid"])
         except:
             logger.error("Could not join network. Network address: %s", self.url)
@@ -33,31 +71,386 @@ class MistNetworkClient(pyjsonrpc.HttpClient):
     def LeaveNetwork(self, member_uid):
         self.leave(str(member_uid))
 
-    def StoreDataOnNetwork(self, data):
-        encoding = "base64"
-        data_base64 = data.encode(encoding, "strict")
-        response = self.store(data_base64, encoding)
-        mist_network_member_uid = response["network_member_uid"]
-        data_uid = uuid.UUID(response["data_uid"])
-        return (mist_network_member_uid, data_uid)
+    def ReportLoad(self, member_uid, load):
+        response = self.report(str(member_uid), load)
+        if response and "error_message" in response:
+            logger.warning("Load report rejected. Error: %s", response["error_message"])
+
+    def _GetPeerAddress(self, member_uid):
+        key = (self.url, str(member_uid))
+        with MistNetworkClient._peer_addresses_lock:
+            if key in MistNetworkClient._peer_addresses:
+                return MistNetworkClient._peer_addresses[key]
 
-    def RetrieveDataOnNetwork(self, member_uid, data_uid):
-        response = self.retrieve(member_uid, str(data_uid))
+        response = self.get_member(str(member_uid))
         if "error_message" in response:
-            logger.error("Unable to read data file. Error: %s", response["error_message"])
+            logger.error("Unable to find peer. Error: %s", response["error_message"])
             return None
+        self._SetPeerAddress(member_uid, response["peer_address"])
+        return response["peer_address"]
+
+    def _SetPeerAddress(self, member_uid, peer_address):
+        with MistNetworkClient._peer_addresses_lock:
+            MistNetworkClient._peer_addresses[(self.url, str(member_uid))] = peer_address
+
+    def _ForgetPeerAddress(self, member_uid):
+        with MistNetworkClient._peer_addresses_lock:
+            MistNetworkClient._peer_addresses.pop((self.url, str(member_uid)), None)
+
+    def GetRing(self, max_age=settings.RING_REFRESH_INTERVAL):
+        """Returns the membership version of the network and its hash ring.
+
+        The ring is None unless the network places data with consistent
+        hashing. A copy fetched less than max_age seconds ago is reused.
+        """
+        with MistNetworkClient._peer_addresses_lock:
+            entry = MistNetworkClient._rings.get(self.url)
+        if entry and time.time() - entry[0] < max_age:
+            return entry[1]
+
+        response = self.get_ring()
+        hash_ring = None
+        if response["placement_policy"] == placement.CONSISTENT_HASH_PLACEMENT:
+            hash_ring = ring.MistHashRing([member_uid for (member_uid, _) in response["members"]])
+        for (member_uid, peer_address) in response["members"]:
+            self._SetPeerAddress(member_uid, peer_address)
+        with MistNetworkClient._peer_addresses_lock:
+            MistNetworkClient._rings[self.url] = (time.time(), (response["version"], hash_ring))
+        return (response["version"], hash_ring)
+
+    def _RingOwners(self, data_uid):
+        try:
+            (_, hash_ring) = self.GetRing()
+        except Exception as e:
+            logger.warning("Unable to get hash ring. Error: %s", e)
+            return []
+        if hash_ring is None:
+            return []
+        return [uuid.UUID(member_uid) for member_uid in hash_ring.Owners(data_uid, settings.REPLICATION_FACTOR)]
+
+    def _ObserveLatency(self, member_uid, latency):
+        key = (self.url, str(member_uid))
+        with MistNetworkClient._peer_addresses_lock:
+            previous = MistNetworkClient._peer_latencies.get(key)
+            if previous is None:
+                MistNetworkClient._peer_latencies[key] = latency
+            else:
+                MistNetworkClient._peer_latencies[key] = previous + MistNetworkClient.LATENCY_SMOOTHING * (latency - previous)
+
+    def _ExpectedLatency(self, member_uid):
+        with MistNetworkClient._peer_addresses_lock:
+            return MistNetworkClient._peer_latencies.get((self.url, str(member_uid)), 0)
+
+    def _StoreDataOnPeer(self, peer, data):
+        member_uid = uuid.UUID(peer["peer_network_uid"])
+        if settings.DIRECT_PEER_TRANSFER:
+            self._SetPeerAddress(member_uid, peer["peer_address"])
+            with transfer.shared_transfer_executor.PeerSlot(peer["peer_address"]):
+                response = transport.MistDataTransportClient(peer["peer_address"]).StoreData(data)
         else:
-            return response["data"].decode(response["encoding"])
+            response = transport.MistDataTransportClient(self.url).StoreData(data, member_uid)
+        return (member_uid, uuid.UUID(response["data_uid"]))
+
+    def StoreDataOnNetwork(self, data, replicas=settings.REPLICATION_FACTOR):
+        """Stores data on up to replicas members and returns their uids and the data uid."""
+        if settings.DIRECT_PEER_TRANSFER:
+            # Members name data by its content, which is also its placement key.
+            key = str(mist_chunk.MistChunk.ContentUid(data))
+            tasks = transfer.RunConcurrently(lambda peer: self._StoreDataOnPeer(peer, data), self.get_peers(replicas, key))
+            stored = [task.result for task in tasks if task.exception is None]
+            if len(stored) < len(tasks):
+                logger.warning("Stored %s of %s replicas.", len(stored), len(tasks))
+            if not stored:
+                raise MistNetworkError("Unable to store data on any peer.")
+            mist_network_member_uids = [member_uid for (member_uid, _) in stored]
+            data_uid = stored[0][1]
+        else:
+            response = transport.MistDataTransportClient(self.url).StoreData(data)
+            mist_network_member_uids = map(uuid.UUID, response["network_member_uids"])
+            data_uid = uuid.UUID(response["data_uid"])
+        return (mist_network_member_uids, data_uid)
+
+    def _StoreManyDataOnPeer(self, peer, datas):
+        """Returns the (member uid, data uid) of every data stored on a peer, or None for the data that was not."""
+        member_uid = uuid.UUID(peer["peer_network_uid"])
+        if settings.DIRECT_PEER_TRANSFER:
+            self._SetPeerAddress(member_uid, peer["peer_address"])
+            with transfer.shared_transfer_executor.PeerSlot(peer["peer_address"]):
+                responses = transport.MistDataTransportClient(peer["peer_address"]).StoreManyData(datas)
+        else:
+            responses = transport.MistDataTransportClient(self.url).StoreManyData(datas, member_uid)
+        return [(member_uid, uuid.UUID(response["data_uid"])) if "data_uid" in response else None for response in responses]
+
+    def _StoreShares(self, shares, datas):
+        """Stores the data of every (peer, indices) share with one request per peer.
+
+        Returns the (member uid, data uid) of every copy stored of each data.
+        """
+        def StoreShare(share):
+            (peer, indices) = share
+            return self._StoreManyDataOnPeer(peer, [datas[index] for index in indices])
+
+        stored = [[] for data in datas]
+        for ((peer, indices), task) in zip(shares, transfer.RunConcurrently(StoreShare, shares)):
+            if task.exception is not None:
+                continue
+            for (index, location) in zip(indices, task.result):
+                if location is not None:
+                    stored[index].append(location)
+        return stored
+
+    def StoreManyDataOnNetwork(self, datas, replicas=settings.REPLICATION_FACTOR):
+        """Stores every data on up to replicas members, sending each member its share in one request.
+
+        Returns the member uids and data uid of every data, or None for the
+        data that could not be stored on any member.
+        """
+        if settings.DIRECT_PEER_TRANSFER:
+            shares = collections.OrderedDict()
+            keys = [str(mist_chunk.MistChunk.ContentUid(data)) for data in datas]
+            for (index, peers) in enumerate(self.get_peers_many(replicas, keys)):
+                for peer in peers:
+                    shares.setdefault(peer["peer_network_uid"], (peer, []))[1].append(index)
+            results = [([member_uid for (member_uid, _) in stored], stored[0][1]) if stored else None for stored in self._StoreShares(shares.values(), datas)]
+        else:
+            responses = transport.MistDataTransportClient(self.url).StoreManyData(datas)
+            results = [(map(uuid.UUID, response["network_member_uids"]), uuid.UUID(response["data_uid"])) if "data_uid" in response else None for response in responses]
+        failed_count = results.count(None)
+        if failed_count:
+            logger.warning("Unable to store %s of %s data files on any peer.", failed_count, len(datas))
+        return results
+
+    def StoreDataOnMember(self, member_uid, data, references=1):
+        """Stores data straight on a member and gives it references to the data."""
+        peer_address = self._GetPeerAddress(member_uid)
+        if peer_address is None:
+            raise MistNetworkError("Unable to find peer. Member uid: %s" % member_uid)
+        with transfer.shared_transfer_executor.PeerSlot(peer_address):
+            response = transport.MistDataTransportClient(peer_address).StoreData(data, references)
+        return uuid.UUID(response["data_uid"])
+
+    def StoreDataOnNewMembers(self, data, count, exclude_member_uids):
+        """Stores data on up to count members that are not in exclude_member_uids.
+
+        Returns the (member uid, data uid) of every copy stored.
+        """
+        exclude_member_uids = set(map(str, exclude_member_uids))
+        key = str(mist_chunk.MistChunk.ContentUid(data))
+        peers = [peer for peer in self.get_peers(count + len(exclude_member_uids), key) if peer["peer_network_uid"] not in exclude_member_uids][:count]
+        tasks = transfer.RunConcurrently(lambda peer: self._StoreDataOnPeer(peer, data), peers)
+        return [task.result for task in tasks if task.exception is None]
+
+    def GetMembers(self):
+        """Returns the uids of the members connected to the network."""
+        members = self.get_ring()["members"]
+        for (member_uid, peer_address) in members:
+            self._SetPeerAddress(member_uid, peer_address)
+        return [uuid.UUID(member_uid) for (member_uid, _) in members]
+
+    def HasDataOnMember(self, member_uid, data_uid):
+        peer_address = self._GetPeerAddress(member_uid)
+        if peer_address is None:
+            raise MistNetworkError("Unable to find peer. Member uid: %s" % member_uid)
+        return MistNetworkClient(peer_address).has(str(data_uid))
+
+    def ProveDataOnMember(self, member_uid, data_uid, index):
+        """Returns the block at index of data on a member and its Merkle proof, or None."""
+        peer_address = self._GetPeerAddress(member_uid)
+        if peer_address is None:
+            raise MistNetworkError("Unable to find peer. Member uid: %s" % member_uid)
+        response = MistNetworkClient(peer_address).prove(str(data_uid), index)
+        if response is None:
+            return None
+        return (response["block"].decode("base64"), response["proof"])
+
+    def StoreFragmentsOnNetwork(self, fragments):
+        """Stores every fragment on a different member where there are enough.
+
+        With consistent hash placement every fragment goes to the owner of
+        its own key instead, which may be shared between fragments.
+
+        Returns the (member uid, data uid) of each fragment, or None for
+        the fragments that could not be stored.
+        """
+        peers = self.get_peers_for_keys([str(mist_chunk.MistChunk.ContentUid(fragment)) for fragment in fragments])
+        if not peers:
+            raise MistNetworkError("Unable to store fragments. No members available.")
+        if len(peers) < len(fragments):
+            logger.warning("Fewer members than fragments. Members: %s, Fragments: %s", len(peers), len(fragments))
+        # Fragments that share a member are sent to it in one request.
+        shares = collections.OrderedDict()
+        for index in xrange(len(fragments)):
+            peer = peers[index % len(peers)]
+            shares.setdefault(peer["peer_network_uid"], (peer, []))[1].append(index)
+        return [stored[0] if stored else None for stored in self._StoreShares(shares.values(), fragments)]
+
+    def RetrieveDataFromMember(self, member_uid, data_uid):
+        start_time = time.time()
+        if settings.DIRECT_PEER_TRANSFER:
+            peer_address = self._GetPeerAddress(member_uid)
+            if peer_address is None:
+                return None
+            try:
+                with transfer.shared_transfer_executor.PeerSlot(peer_address):
+                    data = transport.MistDataTransportClient(peer_address).RetrieveData(data_uid)
+            except Exception as e:
+                logger.warning("Unable to reach peer. Address: %s, Error: %s", peer_address, e)
+                data = None
+            if data is None:
+                self._ForgetPeerAddress(member_uid)
+        else:
+            data = transport.MistDataTransportClient(self.url).RetrieveData(member_uid, data_uid)
+        if data is not None and str(mist_chunk.MistChunk.ContentUid(data)) != str(data_uid):
+            logger.error("Corrupted replica. Member uid: %s, Data uid: %s", member_uid, data_uid)
+            data = None
+        elif data is None:
+            logger.warning("Unable to read replica. Member uid: %s, Data uid: %s", member_uid, data_uid)
+        else:
+            self._ObserveLatency(member_uid, time.time() - start_time)
+            cache.shared_chunk_cache.Put(member_uid, data_uid, data)
+        return data
+
+    def RetrieveManyDataFromMember(self, member_uid, data_uids):
+        """Returns the data of every data uid on a member, read in one request, or None for the data that could not be read."""
+        if settings.DIRECT_PEER_TRANSFER:
+            peer_address = self._GetPeerAddress(member_uid)
+            if peer_address is None:
+                return [None] * len(data_uids)
+            try:
+                with transfer.shared_transfer_executor.PeerSlot(peer_address):
+                    datas = transport.MistDataTransportClient(peer_address).RetrieveManyData(data_uids)
+            except Exception as e:
+                logger.warning("Unable to reach peer. Address: %s, Error: %s", peer_address, e)
+                datas = [None] * len(data_uids)
+            if not any(data is not None for data in datas):
+                self._ForgetPeerAddress(member_uid)
+        else:
+            datas = transport.MistDataTransportClient(self.url).RetrieveManyData(data_uids, member_uid)
+        results = []
+        for (data_uid, data) in zip(data_uids, datas):
+            if data is not None and str(mist_chunk.MistChunk.ContentUid(data)) != str(data_uid):
+                logger.error("Corrupted replica. Member uid: %s, Data uid: %s", member_uid, data_uid)
+                data = None
+            elif data is not None:
+                cache.shared_chunk_cache.Put(member_uid, data_uid, data)
+            results.append(data)
+        return results
+
+    def RetrieveDataOnNetwork(self, member_uids, data_uid):
+        data = cache.shared_chunk_cache.GetAny(member_uids, data_uid)
+        if data is not None:
+            return data
+        return self._RetrieveDataFromReplicas(member_uids, data_uid)
+
+    def _RetrieveDataFromReplicas(self, member_uids, data_uid):
+        # Replicas are tried fastest first. Another replica is asked as well
+        # if the first takes much longer than it usually does. The current
+        # owners on the hash ring come last, in case the data was moved.
+        member_uids = sorted(member_uids, key=self._ExpectedLatency)
+        member_uids += [member_uid for member_uid in self._RingOwners(data_uid) if str(member_uid) not in map(str, member_uids)]
+        if not member_uids:
+            data = None
+        elif len(member_uids) == 1:
+            data = self.RetrieveDataFromMember(member_uids[0], data_uid)
+        else:
+            delay = max(settings.HEDGED_READ_DELAY, 2 * self._ExpectedLatency(member_uids[0]))
+            data = transfer.Hedge(lambda member_uid: self.RetrieveDataFromMember(member_uid, data_uid), member_uids, delay)
+        if data is None:
+            logger.error("Unable to read data file. Member uids: %s, Data uid: %s", map(str, member_uids), data_uid)
+        return data
+
+    def RetrieveManyDataOnNetwork(self, locations):
+        """Returns the data at every (member uids, data uid) location, or None for the data that could not be read.
+
+        Data that is not cached is retrieved with one request to every
+        member that is the fastest to hold any of it. Data that is not
+        retrieved that way is read on its own, from any replica.
+        """
+        datas = [cache.shared_chunk_cache.GetAny(member_uids, data_uid) for (member_uids, data_uid) in locations]
+        shares = collections.OrderedDict()
+        for (index, (member_uids, data_uid)) in enumerate(locations):
+            if datas[index] is None and member_uids:
+                member_uid = min(member_uids, key=self._ExpectedLatency)
+                shares.setdefault(str(member_uid), (member_uid, []))[1].append(index)
+
+        def RetrieveShare(share):
+            (member_uid, indices) = share
+            return self.RetrieveManyDataFromMember(member_uid, [locations[index][1] for index in indices])
+
+        for ((member_uid, indices), task) in zip(shares.values(), transfer.RunConcurrently(RetrieveShare, shares.values())):
+            if task.exception is None:
+                for (index, data) in zip(indices, task.result):
+                    datas[index] = data
+
+        missing_indices = [index for (index, data) in enumerate(datas) if data is None]
+        tasks = transfer.RunConcurrently(lambda index: self._RetrieveDataFromReplicas(*locations[index]), missing_indices, settings.READ_AHEAD_WINDOW)
+        for (index, task) in zip(missing_indices, tasks):
+            datas[index] = task.result
+        return datas
+
+    def _DeleteManyDataFromMember(self, member_uid, data_uids):
+        """Deletes every data uid from a member in one request. Returns whether each was deleted.
+
+        Every delete releases a reference on the member, so deletes that may
+        have been applied are never sent again. They count as deleted, at
+        worst leaving the data behind.
+        """
+        for data_uid in data_uids:
+            cache.shared_chunk_cache.Invalidate(member_uid, data_uid)
+        deleted = [False] * len(data_uids)
+        if settings.DIRECT_PEER_TRANSFER:
+            peer_address = self._GetPeerAddress(member_uid)
+            if peer_address is not None:
+                try:
+                    deleted = map(bool, MistNetworkClient(peer_address).delete_many(map(str, data_uids)))
+                except transport.MistRequestSentError as e:
+                    logger.warning("Data files may not have been deleted on peer. Member uid: %s, Error: %s", member_uid, e)
+                    return [True] * len(data_uids)
+                except Exception as e:
+                    logger.warning("Unable to delete data files on peer. Error: %s", e)
+                if not all(deleted):
+                    self._ForgetPeerAddress(member_uid)
+        remaining_data_uids = [data_uid for (data_uid, data_deleted) in zip(data_uids, deleted) if not data_deleted]
+        if remaining_data_uids:
+            # Fall back on the network, which retries deletes for offline members.
+            try:
+                response = self.delete_many(str(member_uid), map(str, remaining_data_uids))
+            except transport.MistRequestSentError as e:
+                logger.warning("Data files may not have been deleted on network. Member uid: %s, Error: %s", member_uid, e)
+                return [True] * len(data_uids)
+            if response and "error_message" in response:
+                logger.error("Unable to delete data files. Error: %s", response["error_message"])
+            else:
+                deleted = [True] * len(data_uids)
+        return deleted
 
-    def DeleteDataOnNetwork(self, member_uid, data_uid):
-        response = self.delete(member_uid, str(data_uid))
-        if response and "error_message" in response:
-            logger.error("Unable to delete data file. Error: %s", response["error_message"])
-            return False
-        return True
+    def DeleteManyDataOnNetwork(self, locations):
+        """Deletes the data at every (member uid, data uid) location with one request per member.
 
+        Returns whether each location was deleted.
+        """
+        shares = collections.OrderedDict()
+        for (index, (member_uid, _)) in enumerate(locations):
+            shares.setdefault(str(member_uid), (member_uid, []))[1].append(index)
 
-class MistNetworkServerHTTPRequestHandler(pyjsonrpc.HttpRequestHandler):
+        def DeleteShare(share):
+            (member_uid, indices) = share
+            return self._DeleteManyDataFromMember(member_uid, [locations[index][1] for index in indices])
+
+        deleted = [False] * len(locations)
+        for ((member_uid, indices), task) in zip(shares.values(), transfer.RunConcurrently(DeleteShare, shares.values())):
+            if task.exception is None:
+                for (index, data_deleted) in zip(indices, task.result):
+                    deleted[index] = data_deleted
+        return deleted
+
+    def DeleteDataOnNetwork(self, member_uids, data_uid):
+        """Deletes every replica and returns the uids of the members it could not delete from."""
+        deleted = self.DeleteManyDataOnNetwork([(member_uid, data_uid) for member_uid in member_uids])
+        return [member_uid for (member_uid, data_deleted) in zip(member_uids, deleted) if not data_deleted]
+
+
+class MistNetworkServerHTTPRequestHandler(transport.MistDataTransportRequestHandlerMixin, pyjsonrpc.HttpRequestHandler):
     def log_message(self, format, *args):
         logger.debug("%s - - [%s] %s\n",
                      (self.client_address[0],
@@ -78,25 +471,66 @@ class MistNetworkServerHTTPRequestHandler(pyjsonrpc.HttpRequestHandler):
         return True
 
     @pyjsonrpc.rpcmethod
-    def get_peer(self, member_uid):
-        peer = self.server.GetRandomMember()
+    def report(self, member_uid, load):
+        try:
+            self.server.UpdateMemberLoad(uuid.UUID(member_uid), load)
+        except MistNetworkError as e:
+            return {"error_message": str(e)}
+
+    @pyjsonrpc.rpcmethod
+    def get_peer(self, member_uid=None):
+        peer = self.server.ChooseMember()
         return {"peer_network_uid": str(peer.uid), "peer_address": peer.mist_address}
 
     @pyjsonrpc.rpcmethod
-    def store(self, data, encoding="ascii"):
-        (member_uid, data_uid) = self.server.ProcessStoreRequest(data.decode(encoding))
-        return {"network_member_uid": str(member_uid), "data_uid": str(data_uid)}
+    def get_peers(self, count, key=None):
+        return [{"peer_network_uid": str(peer.uid), "peer_address": peer.mist_address} for peer in self.server.ChooseMembers(count, key)]
 
     @pyjsonrpc.rpcmethod
-    def retrieve(self, member_uid, data_uid):
-        try:
-            data = self.server.ProcessRetrieveRequest(uuid.UUID(member_uid), uuid.UUID(data_uid))
-            if data:
-                return {"data": data.encode("base64"), "encoding": "base64"}
+    def get_peers_many(self, count, keys):
+        return [[{"peer_network_uid": str(peer.uid), "peer_address": peer.mist_address} for peer in self.server.ChooseMembers(count, key)] for key in keys]
+
+    @pyjsonrpc.rpcmethod
+    def get_peers_for_keys(self, keys):
+        return [{"peer_network_uid": str(peer.uid), "peer_address": peer.mist_address} for peer in self.server.ChooseMembersForKeys(keys)]
+
+    @pyjsonrpc.rpcmethod
+    def get_ring(self):
+        (version, members) = self.server.GetMembership()
+        return {
+            "version": version,
+            "placement_policy": settings.PLACEMENT_POLICY,
+            "members": [[str(member.uid), member.mist_address] for member in members],
+        }
+
+    @pyjsonrpc.rpcmethod
+    def get_member(self, member_uid):
+        member = self.server.GetMember(uuid.UUID(member_uid))
+        if member is None:
+            return {"error_message": "Network member is not connected. Member uid: %s" % member_uid}
+        return {"peer_network_uid": str(member.uid), "peer_address": member.mist_address}
+
+    def StoreDataRequest(self, data, member_uid=None):
+        if member_uid:
+            (member_uids, data_uid) = self.server.ProcessStoreOnMemberRequest(uuid.UUID(member_uid), data)
+        else:
+            (member_uids, data_uid) = self.server.ProcessStoreRequest(data)
+        return {"network_member_uids": map(str, member_uids), "data_uid": str(data_uid)}
+
+    def RetrieveDataRequest(self, member_uid, data_uid):
+        return self.server.ProcessRetrieveRequest(uuid.UUID(member_uid), uuid.UUID(data_uid))
+
+    def StoreManyDataRequest(self, datas, member_uid=None):
+        responses = []
+        for (member_uids, data_uid) in self.server.ProcessStoreManyRequest(datas, uuid.UUID(member_uid) if member_uid else None):
+            if member_uids:
+                responses.append({"network_member_uids": map(str, member_uids), "data_uid": str(data_uid)})
             else:
-                return {"error_message": "Unable to retrieve data."}
-        except MistNetworkError as e:
-            return {"error_message": str(e)}
+                responses.append({"error_message": "Unable to store data on any member."})
+        return responses
+
+    def RetrieveManyDataRequest(self, data_uids, member_uid):
+        return self.server.ProcessRetrieveManyRequest(uuid.UUID(member_uid), map(uuid.UUID, data_uids))
 
     @pyjsonrpc.rpcmethod
     def delete(self, member_uid, data_uid):
@@ -105,41 +539,101 @@ class MistNetworkServerHTTPRequestHandler(pyjsonrpc.HttpRequestHandler):
         except MistNetworkError as e:
             return {"error_message": str(e)}
 
+    @pyjsonrpc.rpcmethod
+    def delete_many(self, member_uid, data_uids):
+        try:
+            self.server.ProcessDeleteManyRequest(uuid.UUID(member_uid), map(uuid.UUID, data_uids))
+        except MistNetworkError as e:
+            return {"error_message": str(e)}
+
 
 class MistNetworkServer(pyjsonrpc.ThreadingHttpServer):
     """Mist Network Class"""
 
     DEFAULT_NETWORK_STATE_FILENAME = "network_state"
+    RETRIES_EXT = "retries"
     DEFAULT_SERVER_HANDLER = MistNetworkServerHTTPRequestHandler
-    SCHEDULE_REQUEST_DELAY = 5 * 60
     DEFAULTGREENLET_POOL_SIZE = 100
+    COMPACTION_INTERVAL = 30
+
+    # Pooled client connections keep handler threads alive between requests.
+    daemon_threads = True
 
-    def __init__(self, name, server_address):
+    def __init__(self, name, server_address, placement_policy=None):
         pyjsonrpc.ThreadingHttpServer.__init__(self, server_address=server_address, RequestHandlerClass=MistNetworkServer.DEFAULT_SERVER_HANDLER)
         self.name = name
+        self.placement_policy = placement_policy or placement.PLACEMENT_POLICIES[settings.PLACEMENT_POLICY](settings.PLACEMENT_MIN_FREE_SPACE)
         self.network_members = {}
         self.inactive_network_members = {}
         self.greenlet_pool = pool.Pool(size=MistNetworkServer.DEFAULTGREENLET_POOL_SIZE)
+        self.membership_version = 0
+        self._lock = threading.Lock()
+        self._state_journal = journal.MistJournal("%s_%s" % (self.name, MistNetworkServer.DEFAULT_NETWORK_STATE_FILENAME))
+        self._stop_compaction = threading.Event()
+        self._compaction_thread = None
+        self.retry_queue = retry.MistRetryQueue("%s_%s.%s" % (self.name, MistNetworkServer.DEFAULT_NETWORK_STATE_FILENAME, MistNetworkServer.RETRIES_EXT), {
+            "delete": self._RetryDeletes,
+        })
 
     def _LoadMistNetworkState(self):
-        if os.path.isfile("%s_%s" % (self.name, MistNetworkServer.DEFAULT_NETWORK_STATE_FILENAME)):
-            with open("%s_%s" % (self.name, MistNetworkServer.DEFAULT_NETWORK_STATE_FILENAME), "r") as infile:
-                (self.network_members, self.inactive_network_members) = pickle.load(infile)
+        with self._lock:
+            (snapshot, records) = self._state_journal.Load()
+            if snapshot:
+                (self.network_members, self.inactive_network_members) = snapshot
+            for record in records:
+                self._ApplyStateRecord(record)
+            for member in self.network_members.values():
+                self.placement_policy.AddMember(member)
+        if snapshot is None or records:
+            self._CompactNetworkState()
+
+    def _ApplyStateRecord(self, record):
+        (operation, name, key, value) = record
+        if operation == "set":
+            getattr(self, name)[key] = value
         else:
-            self._RewriteNetworkStateFile()
+            getattr(self, name).pop(key, None)
+
+    def _JournalSet(self, name, key, value):
+        self._state_journal.Append(("set", name, key, value))
+
+    def _JournalDelete(self, name, key):
+        self._state_journal.Append(("delete", name, key, None))
+
+    def _NetworkStateSnapshot(self):
+        return (self.network_members, self.inactive_network_members)
+
+    def _CompactNetworkState(self):
+        self._state_journal.Compact(self._NetworkStateSnapshot, self._lock)
 
-    def _RewriteNetworkStateFile(self):
-        with open("%s_%s" % (self.name, MistNetworkServer.DEFAULT_NETWORK_STATE_FILENAME), "wb") as outfile:
-            pickle.dump((self.network_members, self.inactive_network_members), outfile)
+    def _CompactionWorker(self):
+        # Compaction runs here rather than on the join and leave paths so
+        # that they only ever pay for appending a record.
+        while not self._stop_compaction.wait(MistNetworkServer.COMPACTION_INTERVAL):
+            if self._state_journal.NeedsCompaction():
+                try:
+                    self._CompactNetworkState()
+                except (IOError, OSError) as e:
+                    logger.error("Unable to compact network state. Error: %s", e)
 
     def Start(self):
         self._LoadMistNetworkState()
+        self._stop_compaction.clear()
+        self._compaction_thread = threading.Thread(target=self._CompactionWorker)
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+        self.retry_queue.Start()
         threading.Thread(target=self.serve_forever).start()
 
     def Stop(self):
         self.DisconnectAllMembers()
         self.shutdown()
-        self._RewriteNetworkStateFile()
+        self.server_close()
+        self._stop_compaction.set()
+        self._compaction_thread.join()
+        self._CompactNetworkState()
+        self._state_journal.Close()
+        self.retry_queue.Stop()
 
     def DisconnectAllMembers(self):
         logger.info("Disconnecting all members. Count: %s", len(self.network_members))
@@ -149,39 +643,116 @@ class MistNetworkServer(pyjsonrpc.ThreadingHttpServer):
             self.DeleteMember(member_uid)
 
     def AddMember(self, member_address, member_uid=None):
-        if member_uid and member_uid in self.inactive_network_members:
-            member = self.inactive_network_members[member_uid]
-            member.Activate(member_address)
-            self.network_members[member_uid] = member
-            del self.inactive_network_members[member_uid]
-        else:
-            member = network_member.MistNetworkMember(member_address)
-            self.network_members[member.uid] = member
-        self._RewriteNetworkStateFile()
+        with self._lock:
+            if member_uid and member_uid in self.inactive_network_members:
+                member = self.inactive_network_members[member_uid]
+                member.Activate(member_address)
+                self.network_members[member_uid] = member
+                del self.inactive_network_members[member_uid]
+                self._JournalDelete("inactive_network_members", member_uid)
+            else:
+                member = network_member.MistNetworkMember(member_address)
+                self.network_members[member.uid] = member
+            self._JournalSet("network_members", member.uid, member)
+            self.placement_policy.AddMember(member)
+            self.membership_version += 1
         logger.info("%s just joined.", str(member))
+        self.retry_queue.Wake(member.uid)
         return member.uid
 
     def DeleteMember(self, member_uid):
-        if member_uid in self.network_members:
-            logger.info("%s just left.", str(self.network_members[member_uid]))
-            self.inactive_network_members[member_uid] = self.network_members[member_uid]
-            self.inactive_network_members[member_uid].Deactivate()
-            del self.network_members[member_uid]
-            self._RewriteNetworkStateFile()
-
-    def GetRandomMember(self):
-        return random.choice(self.network_members.values())
+        with self._lock:
+            member = self.network_members.pop(member_uid, None)
+            if member:
+                logger.info("%s just left.", str(member))
+                member.Deactivate()
+                self.inactive_network_members[member_uid] = member
+                self._JournalDelete("network_members", member_uid)
+                self._JournalSet("inactive_network_members", member_uid, member)
+                self.placement_policy.RemoveMember(member)
+                self.membership_version += 1
+
+    def GetMember(self, member_uid):
+        return self.network_members.get(member_uid)
+
+    def UpdateMemberLoad(self, member_uid, load):
+        member = self.network_members.get(member_uid)
+        if member is None:
+            raise MistNetworkError("Network member is not connected. Member uid: %s" % member_uid)
+        member.UpdateLoad(load["free_space"], load["capacity"], load["outstanding_requests"])
+
+    def GetMembership(self):
+        """Returns the membership version and the active members."""
+        with self._lock:
+            return (self.membership_version, self.network_members.values())
+
+    def ChooseMember(self):
+        return self.ChooseMembers(1)[0]
+
+    def ChooseMembers(self, count, key=None):
+        """Returns up to count distinct members to place new data with key on."""
+        with self._lock:
+            chosen_members = self.placement_policy.Choose(self.network_members.values(), count, key)
+            for member in chosen_members:
+                member.Assign()
+        return chosen_members
+
+    def ChooseMembersForKeys(self, keys):
+        """Returns a member to place the data of every key on."""
+        with self._lock:
+            chosen_members = self.placement_policy.ChooseForKeys(self.network_members.values(), keys)
+            for member in chosen_members:
+                member.Assign()
+        return chosen_members
 
     def ListMembers(self):
         return map(str, self.network_members.values())
 
-    def ProcessStoreRequest(self, data):
-        chosen_member = self.GetRandomMember()
-        # greenlet = self.greenlet_pool.spawn(chosen_member.SendStoreRequest, data)
-        # greenlet.join()
-        # data_uid = greenlet.value
-        data_uid = chosen_member.SendStoreRequest(data)
-        return (chosen_member.uid, data_uid)
+    def ProcessStoreRequest(self, data, replicas=settings.REPLICATION_FACTOR):
+        chosen_members = self.ChooseMembers(replicas, str(mist_chunk.MistChunk.ContentUid(data)))
+        tasks = transfer.RunConcurrently(lambda member: member.SendStoreRequest(data), chosen_members)
+        stored = [(member.uid, task.result) for (member, task) in zip(chosen_members, tasks) if task.exception is None]
+        if not stored:
+            raise MistNetworkError("Unable to store data on any member.")
+        return ([member_uid for (member_uid, _) in stored], stored[0][1])
+
+    def ProcessStoreManyRequest(self, datas, member_uid=None, replicas=settings.REPLICATION_FACTOR):
+        """Stores every data, sending each member all of its share in one request.
+
+        Returns the member uids and data uid of every data. The member uids
+        are empty for the data that could not be stored.
+        """
+        if member_uid:
+            if member_uid not in self.network_members:
+                raise MistNetworkError("Network member is not connected. Member uid: %s" % member_uid)
+            placements = [[self.network_members[member_uid]]] * len(datas)
+        else:
+            placements = [self.ChooseMembers(replicas, str(mist_chunk.MistChunk.ContentUid(data))) for data in datas]
+        shares = collections.OrderedDict()
+        for (index, members) in enumerate(placements):
+            for member in members:
+                shares.setdefault(member.uid, (member, []))[1].append(index)
+
+        def StoreShare(share):
+            (member, indices) = share
+            return member.SendStoreManyRequest([datas[index] for index in indices])
+
+        member_uids = [[] for data in datas]
+        data_uids = [None] * len(datas)
+        for ((member, indices), task) in zip(shares.values(), transfer.RunConcurrently(StoreShare, shares.values())):
+            if task.exception is not None:
+                continue
+            for (index, response) in zip(indices, task.result):
+                if "data_uid" in response:
+                    member_uids[index].append(member.uid)
+                    data_uids[index] = uuid.UUID(response["data_uid"])
+        return zip(member_uids, data_uids)
+
+    def ProcessStoreOnMemberRequest(self, member_uid, data):
+        if member_uid in self.network_members:
+            return ([member_uid], self.network_members[member_uid].SendStoreRequest(data))
+        else:
+            raise MistNetworkError("Network member is not connected. Member uid: %s" % member_uid)
 
     def ProcessRetrieveRequest(self, member_uid, data_uid):
         if member_uid in self.network_members:
@@ -193,22 +764,44 @@ class MistNetworkServer(pyjsonrpc.ThreadingHttpServer):
         else:
             raise MistNetworkError("Network member is not connected. Member uid: %s" % member_uid)
 
-    def ProcessDeleteRequest(self, member_uid, data_uid):
+    def ProcessRetrieveManyRequest(self, member_uid, data_uids):
         if member_uid in self.network_members:
-            # greenlet = self.greenlet_pool.spawn(self.network_members[member_uid].SendDeleteRequest, data_uid)
-            # greenlet.join()
-            # if not greenlet.value:
-            if not self.network_members[member_uid].SendDeleteRequest(data_uid):
-                self.ScheduleRequest(self.ProcessDeleteRequest, member_uid, data_uid)
+            return self.network_members[member_uid].SendRetrieveManyRequest(data_uids)
         else:
             raise MistNetworkError("Network member is not connected. Member uid: %s" % member_uid)
 
-    def ScheduleRequest(self, process_request_func, *args, **kwargs):
-        threading.Thread(target=self._ScheduledRequestWorker, args=(process_request_func,)+args, kwargs=kwargs)
-
-    def _ScheduledRequestWorker(self, process_request_func, *args, **kwargs):
-        time.sleep(MistNetworkServer.SCHEDULE_REQUEST_DELAY)
-        process_request_func(*args, **kwargs)
+    def ProcessDeleteRequest(self, member_uid, data_uid):
+        self.ProcessDeleteManyRequest(member_uid, [data_uid])
+
+    def ProcessDeleteManyRequest(self, member_uid, data_uids):
+        member = self.network_members.get(member_uid)
+        if member is None and member_uid not in self.inactive_network_members:
+            raise MistNetworkError("Network member is unknown. Member uid: %s" % member_uid)
+        # Members that are offline or fail to delete are sent the deletes
+        # again later, and as soon as they rejoin. Deletes the member may
+        # have applied are not, as each one releases a reference.
+        deleted = [False] * len(data_uids)
+        if member is not None:
+            try:
+                deleted = member.SendDeleteManyRequest(data_uids)
+            except transport.MistRequestSentError as e:
+                logger.warning("Data files may not have been deleted on member. Member uid: %s, Error: %s", member_uid, e)
+                return
+            except Exception as e:
+                logger.warning("Unable to delete data files on member. Member uid: %s, Error: %s", member_uid, e)
+        for (data_uid, data_deleted) in zip(data_uids, deleted):
+            if not data_deleted:
+                self.retry_queue.Add("delete", member_uid, data_uid)
+
+    def _RetryDeletes(self, member_uid, data_uids):
+        member = self.network_members.get(member_uid)
+        if member is None:
+            return [False] * len(data_uids)
+        try:
+            return member.SendDeleteManyRequest(data_uids)
+        except transport.MistRequestSentError as e:
+            logger.warning("Data files may not have been deleted on member. Member uid: %s, Error: %s", member_uid, e)
+            return [True] * len(data_uids)
 
 
 def main():
@@ -223,10 +816,10 @@ def main():
                 print "network:", network.ListMembers()
                 print "Active Members:"
                 for member in network.network_members.values():
-                    print "  %s: %s" % (str(member), member._history[-5:])
+                    print "  %s: %s" % (str(member), member.RecentHistory(5))
                 print "Inactive Members:"
                 for member in network.inactive_network_members.values():
-                    print "  %s: %s" % (str(member), member._history[-5:])
+                    print "  %s: %s" % (str(member), member.RecentHistory(5))
                 else:
                     print "  None"
         except KeyboardInterrupt:
@@ -1,7 +1,11 @@
 import uuid
+import os
 import pyjsonrpc
 import threading
+import collections
 import network
+import transport
+import settings
 import logging
 
 
@@ -16,10 +20,22 @@ class MistNetworkMemberError(Exception):
 class MistNetworkMember(object):
     """Mist Network Member Class"""
 
+    # Members are written to the network state log, so only the most
+    # recent history is kept.
+    MAX_HISTORY_LENGTH = 100
+
+    # Last load reported by the member. Class level defaults also cover
+    # members saved before they reported load.
+    free_space = None
+    capacity = None
+    outstanding_requests = 0
+    # Placements handed out since the last report, which it cannot count.
+    assigned_requests = 0
+
     def __init__(self, mist_address):
         self.uid = uuid.uuid4()
         self.mist_address = None
-        self._history = []
+        self._history = collections.deque(maxlen=MistNetworkMember.MAX_HISTORY_LENGTH)
         self.active = False
         self.Activate(mist_address)
 
@@ -33,62 +49,101 @@ class MistNetworkMember(object):
         self.active = False
         self._history.append("Deactivated")
 
+    def UpdateLoad(self, free_space, capacity, outstanding_requests):
+        self.free_space = free_space
+        self.capacity = capacity
+        self.outstanding_requests = outstanding_requests
+        self.assigned_requests = 0
+
+    def Assign(self):
+        self.assigned_requests += 1
+
+    def Load(self):
+        return self.outstanding_requests + self.assigned_requests
+
     def SendStoreRequest(self, data):
         self._history.append("store: size: %s" % len(data))
-        mist_member_client = network.MistNetworkClient(self.mist_address)
-        response = mist_member_client.store(data.encode("base64"), encoding="base64")
+        response = transport.MistDataTransportClient(self.mist_address).StoreData(data)
         return uuid.UUID(response["data_uid"])
 
     def SendRetrieveRequest(self, data_uid):
         self._history.append("retrieve: %s" % data_uid)
-        mist_member_client = network.MistNetworkClient(self.mist_address)
-        response = mist_member_client.retrieve(str(data_uid))
-        if "error_message" in response:
-            logger.error("Unable to retrieve data. data_uid: %s, Error: %s", data_uid, response["error_message"])
-            return None
-        else:
-            return response["data"].decode(response["encoding"])
+        data = transport.MistDataTransportClient(self.mist_address).RetrieveData(data_uid)
+        if data is None:
+            logger.error("Unable to retrieve data. data_uid: %s", data_uid)
+        return data
 
     def SendDeleteRequest(self, data_uid):
         self._history.append("delete: %s" % data_uid)
         mist_member_client = network.MistNetworkClient(self.mist_address)
         return mist_member_client.delete(str(data_uid))
 
+    def SendStoreManyRequest(self, datas):
+        self._history.append("store many: count: %s" % len(datas))
+        return transport.MistDataTransportClient(self.mist_address).StoreManyData(datas)
+
+    def SendRetrieveManyRequest(self, data_uids):
+        self._history.append("retrieve many: count: %s" % len(data_uids))
+        return transport.MistDataTransportClient(self.mist_address).RetrieveManyData(data_uids)
+
+    def SendDeleteManyRequest(self, data_uids):
+        self._history.append("delete many: count: %s" % len(data_uids))
+        mist_member_client = network.MistNetworkClient(self.mist_address)
+        return mist_member_client.delete_many(map(str, data_uids))
+
     def SendDisconnectRequest(self):
         self._history.append("disconnect request")
         mist_member_client = network.MistNetworkClient(self.mist_address)
         mist_member_client.disconnect()
 
+    def RecentHistory(self, count):
+        return list(self._history)[-count:]
+
     def __str__(self):
         if self.active:
             return "%s@%s" % (self.uid, self.mist_address)
         else:
             return "%s" % self.uid
 
+    def __setstate__(self, d):
+        # Members saved before the history was bounded kept it as a list.
+        d["_history"] = collections.deque(d["_history"], maxlen=MistNetworkMember.MAX_HISTORY_LENGTH)
+        self.__dict__ = d
+
 
-class MistNetworkMemberServerHTTPRequestHandler(pyjsonrpc.HttpRequestHandler):
+class MistNetworkMemberServerHTTPRequestHandler(transport.MistDataTransportRequestHandlerMixin, pyjsonrpc.HttpRequestHandler):
     def log_message(self, format, *args):
         logger.debug("%s - - [%s] %s\n",
                      (self.client_address[0],
                       self.log_date_time_string(),
                       format % args))
 
-    @pyjsonrpc.rpcmethod
-    def store(self, data, encoding="ascii"):
-        data_uid = self.server.StoreData(data.decode(encoding))
+    def StoreDataRequest(self, data, references=1):
+        data_uid = self.server.TrackRequest(self.server.StoreData, data, int(references))
         return {"data_uid": str(data_uid)}
 
-    @pyjsonrpc.rpcmethod
-    def retrieve(self, data_uid):
-        data = self.server.RetrieveData(uuid.UUID(data_uid))
-        if data is None:
-            return {"error_message": "Unable to retrieve data."}
-        else:
-            return {"data": data.encode("base64"), "encoding": "base64"}
+    def RetrieveDataRequest(self, data_uid):
+        return self.server.TrackRequest(self.server.RetrieveData, uuid.UUID(data_uid))
 
     @pyjsonrpc.rpcmethod
     def delete(self, data_uid):
-        return self.server.DeleteData(uuid.UUID(data_uid))
+        return self.server.TrackRequest(self.server.DeleteData, uuid.UUID(data_uid))
+
+    @pyjsonrpc.rpcmethod
+    def delete_many(self, data_uids):
+        return self.server.TrackRequest(self.server.DeleteManyData, map(uuid.UUID, data_uids))
+
+    @pyjsonrpc.rpcmethod
+    def has(self, data_uid):
+        return self.server.HasData(uuid.UUID(data_uid))
+
+    @pyjsonrpc.rpcmethod
+    def prove(self, data_uid, index):
+        response = self.server.TrackRequest(self.server.ProveData, uuid.UUID(data_uid), int(index))
+        if response is None:
+            return None
+        (block, proof) = response
+        return {"block": block.encode("base64"), "proof": proof}
 
     @pyjsonrpc.rpcmethod
     def disconnect(self):
@@ -98,25 +153,74 @@ class MistNetworkMemberServerHTTPRequestHandler(pyjsonrpc.HttpRequestHandler):
 class MistNetworkMemberServer(pyjsonrpc.ThreadingHttpServer):
     DEFAULT_SERVER_HANDLER = MistNetworkMemberServerHTTPRequestHandler
 
+    # Pooled client connections keep handler threads alive between requests.
+    daemon_threads = True
+
     def __init__(self, mist, host):
         pyjsonrpc.ThreadingHttpServer.__init__(self, server_address=(host, 0), RequestHandlerClass=MistNetworkMemberServer.DEFAULT_SERVER_HANDLER)
         self.server_address = self.socket.getsockname()
         self.mist = mist
+        self.outstanding_requests = 0
+        self._lock = threading.Lock()
+        self._stop_reporting = threading.Event()
 
     def Start(self):
         threading.Thread(target=self.serve_forever).start()
 
     def Stop(self):
+        self._stop_reporting.set()
         self.shutdown()
-
-    def StoreData(self, data):
-        return self.mist.StoreDataFile(data)
+        self.server_close()
+
+    def TrackRequest(self, func, *args):
+        with self._lock:
+            self.outstanding_requests += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.outstanding_requests -= 1
+
+    def Load(self):
+        stats = os.statvfs(self.mist.root_path)
+        return {
+            "free_space": stats.f_bavail * stats.f_frsize,
+            "capacity": stats.f_blocks * stats.f_frsize,
+            "outstanding_requests": self.outstanding_requests,
+        }
+
+    def StartReporting(self, mist_network_client, member_uid):
+        """Reports the load of this member to the network until stopped."""
+        self._stop_reporting.clear()
+        thread = threading.Thread(target=self._ReportWorker, args=(mist_network_client, member_uid))
+        thread.daemon = True
+        thread.start()
+
+    def _ReportWorker(self, mist_network_client, member_uid):
+        while not self._stop_reporting.is_set():
+            try:
+                mist_network_client.ReportLoad(member_uid, self.Load())
+            except Exception as e:
+                logger.warning("Unable to report load. Error: %s", e)
+            self._stop_reporting.wait(settings.LOAD_REPORT_INTERVAL)
+
+    def StoreData(self, data, references=1):
+        return self.mist.StoreDataFile(data, references)
+
+    def HasData(self, data_uid):
+        return data_uid in self.mist.mist_data_files
 
     def RetrieveData(self, data_uid):
         return self.mist.RetrieveDataFile(data_uid)
 
+    def ProveData(self, data_uid, index):
+        return self.mist.ProveDataFile(data_uid, index)
+
     def DeleteData(self, data_uid):
         return self.mist.DeleteDataFile(data_uid)
 
+    def DeleteManyData(self, data_uids):
+        return [self.mist.DeleteDataFile(data_uid) for data_uid in data_uids]
+
     def LeaveNetwork(self):
         self.mist.LeaveNetwork(local=True)
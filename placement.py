@@ -0,0 +1,136 @@
+import random
+import logging
+
+import ring
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistPlacementPolicy(object):
+    """Chooses the members that new data is placed on."""
+
+    def __init__(self, min_free_space=0):
+        self.min_free_space = min_free_space
+
+    def AddMember(self, member):
+        pass
+
+    def RemoveMember(self, member):
+        pass
+
+    def Choose(self, members, count, key=None):
+        """Returns up to count distinct members out of members for data with key."""
+        raise NotImplementedError
+
+    def ChooseForKeys(self, members, keys):
+        """Returns a member for every key, distinct while there are enough."""
+        chosen = self.Choose(members, len(keys))
+        return [chosen[i % len(chosen)] for i in xrange(len(keys))] if chosen else []
+
+
+class MistRandomPlacementPolicy(MistPlacementPolicy):
+    """Places data on members picked uniformly at random."""
+
+    def Choose(self, members, count, key=None):
+        return random.sample(members, min(count, len(members)))
+
+
+class MistLoadAwarePlacementPolicy(MistPlacementPolicy):
+    """Mist Load Aware Placement Policy
+
+    Power of two choices. Every pick samples two members, weighted by the
+    free space they report, and keeps the one with fewer outstanding
+    requests. Members too full to take a chunk are only used when no
+    other member is left.
+    """
+
+    CHOICES = 2
+
+    def _Weights(self, members):
+        known = [member.free_space for member in members if member.free_space is not None]
+        # Members that have not reported yet are assumed to be average.
+        default = float(sum(known)) / len(known) if known else 1.0
+        weights = []
+        for member in members:
+            free_space = default if member.free_space is None else member.free_space
+            weights.append(free_space if free_space > self.min_free_space else 0.0)
+        if not any(weights):
+            return [1.0] * len(members)
+        return weights
+
+    @staticmethod
+    def _WeightedSample(members, weights, count):
+        members = list(members)
+        weights = list(weights)
+        sample = []
+        while members and len(sample) < count:
+            point = random.uniform(0, sum(weights))
+            for (index, weight) in enumerate(weights):
+                point -= weight
+                if point <= 0 and weight > 0:
+                    break
+            else:
+                index = max(xrange(len(weights)), key=weights.__getitem__)
+            sample.append(members.pop(index))
+            weights.pop(index)
+            if not any(weights):
+                weights = [1.0] * len(weights)
+        return sample
+
+    def Choose(self, members, count, key=None):
+        candidates = list(members)
+        weights = self._Weights(candidates)
+        chosen = []
+        while candidates and len(chosen) < count:
+            sample = MistLoadAwarePlacementPolicy._WeightedSample(candidates, weights, MistLoadAwarePlacementPolicy.CHOICES)
+            best = min(sample, key=lambda member: (member.Load(), -(member.free_space or 0)))
+            index = candidates.index(best)
+            chosen.append(candidates.pop(index))
+            weights.pop(index)
+        return chosen
+
+
+class MistConsistentHashPlacementPolicy(MistLoadAwarePlacementPolicy):
+    """Mist Consistent Hash Placement Policy
+
+    Places data with a key on the members that own the key on a hash ring
+    of the active members, so that anyone can work out where it lives.
+    Data without a key is placed by load.
+    """
+
+    def __init__(self, min_free_space=0):
+        MistLoadAwarePlacementPolicy.__init__(self, min_free_space)
+        self.hash_ring = ring.MistHashRing()
+
+    def AddMember(self, member):
+        self.hash_ring.Add(member.uid)
+
+    def RemoveMember(self, member):
+        self.hash_ring.Remove(member.uid)
+
+    def Choose(self, members, count, key=None):
+        if key is None:
+            return MistLoadAwarePlacementPolicy.Choose(self, members, count)
+        members_by_uid = dict((str(member.uid), member) for member in members)
+        return [members_by_uid[uid] for uid in self.hash_ring.Owners(key, count) if uid in members_by_uid]
+
+    def ChooseForKeys(self, members, keys):
+        members_by_uid = dict((str(member.uid), member) for member in members)
+        chosen = []
+        for key in keys:
+            owners = [uid for uid in self.hash_ring.Owners(key, 1) if uid in members_by_uid]
+            if not owners:
+                return []
+            chosen.append(members_by_uid[owners[0]])
+        return chosen
+
+
+CONSISTENT_HASH_PLACEMENT = "consistent_hash"
+
+PLACEMENT_POLICIES = {
+    "random": MistRandomPlacementPolicy,
+    "load_aware": MistLoadAwarePlacementPolicy,
+    CONSISTENT_HASH_PLACEMENT: MistConsistentHashPlacementPolicy,
+}
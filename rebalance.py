@@ -0,0 +1,83 @@
+import threading
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistRebalancer(object):
+    """Mist Rebalancer class
+
+    Watches the hash ring of the network a Mist is a member of. Whenever the
+    membership changes, the data files the member no longer owns are handed
+    off to their owners. Only data whose owners changed is moved, which is
+    about 1/N of it when one of N members joins or leaves.
+    """
+
+    def __init__(self, mist, interval=settings.REBALANCE_INTERVAL):
+        self.mist = mist
+        self.interval = interval
+        self._version = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def Start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._Work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+
+    def _Work(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.RebalanceIfNeeded()
+            except Exception as e:
+                logger.warning("Unable to rebalance. Error: %s", e)
+
+    def RebalanceIfNeeded(self):
+        mist_network_client = self.mist.mist_network_client
+        if mist_network_client is None:
+            return
+        (version, hash_ring) = mist_network_client.GetRing(max_age=0)
+        if hash_ring is None or version == self._version:
+            return
+        if self.mist.mist_network_member_uid not in hash_ring:
+            return
+        if self.Rebalance(hash_ring):
+            self._version = version
+
+    def Rebalance(self, hash_ring):
+        """Hands off every data file this member does not own. Returns whether all were moved."""
+        mist_network_client = self.mist.mist_network_client
+        member_uid = str(self.mist.mist_network_member_uid)
+        moved_count = 0
+        failed_count = 0
+        for data_uid in self.mist.mist_data_files.keys():
+            owners = hash_ring.Owners(str(data_uid), settings.REPLICATION_FACTOR)
+            if member_uid in owners or self._stop.is_set():
+                continue
+            if self.mist.HandOffDataFile(data_uid, self._ChooseOwner(mist_network_client, owners, data_uid)):
+                moved_count += 1
+            else:
+                failed_count += 1
+        if moved_count or failed_count:
+            logger.info("Rebalanced data files. Moved: %s, Failed: %s", moved_count, failed_count)
+        return failed_count == 0
+
+    @staticmethod
+    def _ChooseOwner(mist_network_client, owners, data_uid):
+        # Prefer an owner that does not hold a copy yet, so that the data
+        # keeps as many copies as it had.
+        for owner in owners:
+            try:
+                if not mist_network_client.HasDataOnMember(owner, data_uid):
+                    return owner
+            except Exception as e:
+                logger.warning("Unable to reach owner. Member uid: %s, Error: %s", owner, e)
+        return owners[0]
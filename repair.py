@@ -0,0 +1,165 @@
+import time
+import heapq
+import threading
+import collections
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistRepairer(object):
+    """Mist Repairer class
+
+    Keeps the chunks of the files of a Mist on as many members as they
+    should be. A copy is lost when its member leaves the network, or fails
+    to prove it still holds the copy when the chunk is scrubbed. Chunks with
+    lost copies are repaired fewest surviving copies first, by making new
+    copies on members that hold none.
+
+    Scrubbing proves at most scrub_rate chunks a second and repairs
+    transfer at most bandwidth bytes a second, so that neither gets in the
+    way of reads and writes.
+    """
+
+    def __init__(self, mist, interval=settings.REPAIR_INTERVAL, scrub_rate=settings.SCRUB_RATE, bandwidth=settings.REPAIR_BANDWIDTH):
+        self.mist = mist
+        self.interval = interval
+        self.scrub_rate = scrub_rate
+        self.bandwidth = bandwidth
+        # Members that failed to prove a chunk when it was last scrubbed, by
+        # content hash.
+        self.failed_scrubs = {}
+        self._scrub_queue = collections.deque()
+        self._send_time = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def Start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._Work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+
+    def _Work(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.RepairIfNeeded()
+            except Exception as e:
+                logger.warning("Unable to repair. Error: %s", e)
+
+    def RepairIfNeeded(self):
+        mist_network_client = self.mist.mist_network_client
+        if mist_network_client is None:
+            return
+        self.Scrub(int(self.scrub_rate * self.interval))
+        self.Repair(mist_network_client.GetMembers())
+
+    def Scrub(self, count):
+        """Proves up to count chunks, carrying on from where the last scrub stopped."""
+        if self.scrub_rate <= 0:
+            return
+        store = self.mist.mist_network_data_file_store
+        if not self._scrub_queue:
+            self._scrub_queue.extend(store.mist_network_data_files.keys())
+        for i in xrange(min(count, len(self._scrub_queue))):
+            if self._stop.wait(1.0 / self.scrub_rate):
+                return
+            content_hash = self._scrub_queue.popleft()
+            mist_network_data_file = store.Get(content_hash)
+            if mist_network_data_file is None or not mist_network_data_file.WaitUntilStored(0):
+                continue
+            failed_member_uids = mist_network_data_file.Scrub()
+            if failed_member_uids:
+                self.failed_scrubs[content_hash] = set(map(str, failed_member_uids))
+            else:
+                self.failed_scrubs.pop(content_hash, None)
+
+    def UnderReplicated(self, member_uids):
+        """Returns the chunks with lost copies, given the uids of the members on the network.
+
+        Every chunk is a (redundancy, content hash, lost member uids) tuple,
+        and the list is a heap with the chunks closest to being lost first.
+        """
+        member_uids = set(map(str, member_uids))
+        under_replicated = []
+        for (content_hash, mist_network_data_file) in self.mist.mist_network_data_file_store.mist_network_data_files.items():
+            if not mist_network_data_file.WaitUntilStored(0):
+                continue
+            if mist_network_data_file.StoreFailed():
+                self.mist.retry_queue.Add("store", None, content_hash)
+                continue
+            # Chunks that failed to be repaired are tried again by the retry
+            # queue once they are due.
+            if self.mist.retry_queue.IsPending("repair", None, content_hash):
+                continue
+            lost_member_uids = self._LostMemberUids(content_hash, mist_network_data_file, member_uids)
+            if mist_network_data_file.IsDegraded(lost_member_uids):
+                heapq.heappush(under_replicated, (mist_network_data_file.Redundancy(lost_member_uids), content_hash, lost_member_uids))
+        return under_replicated
+
+    def _LostMemberUids(self, content_hash, mist_network_data_file, member_uids):
+        failed_member_uids = self.failed_scrubs.get(content_hash, set())
+        return set(str(member_uid) for member_uid in mist_network_data_file.Holders() if str(member_uid) not in member_uids or str(member_uid) in failed_member_uids)
+
+    def Repair(self, member_uids):
+        """Repairs every chunk with lost copies. Returns whether all were repaired.
+
+        Chunks that fail to be repaired are handed to the retry queue.
+        """
+        under_replicated = self.UnderReplicated(member_uids)
+        repaired_count = 0
+        failed_count = 0
+        while under_replicated and not self._stop.is_set():
+            (redundancy, content_hash, lost_member_uids) = heapq.heappop(under_replicated)
+            if redundancy < 0:
+                logger.error("Chunk has too few copies left to be read. Content hash: %s", content_hash)
+            if self.RepairChunk(content_hash, member_uids):
+                repaired_count += 1
+            else:
+                self.mist.retry_queue.Add("repair", None, content_hash)
+                failed_count += 1
+        if repaired_count or failed_count:
+            logger.info("Repaired chunks. Repaired: %s, Failed: %s", repaired_count, failed_count)
+        return failed_count == 0
+
+    def RepairChunk(self, content_hash, member_uids):
+        """Replaces the lost copies of a chunk, given the uids of the members on the network.
+
+        Returns False if the repair failed. Chunks whose copies cannot be
+        put anywhere else for now are left as they are.
+        """
+        member_uids = set(map(str, member_uids))
+        mist_network_data_file = self.mist.mist_network_data_file_store.Get(content_hash)
+        if mist_network_data_file is None:
+            return True
+        lost_member_uids = self._LostMemberUids(content_hash, mist_network_data_file, member_uids)
+        if not mist_network_data_file.IsDegraded(lost_member_uids):
+            return True
+        # Copies can only be made on members that hold none yet.
+        if not member_uids - set(map(str, mist_network_data_file.Holders())):
+            return True
+        try:
+            transferred = self.mist.RepairDataFile(content_hash, lost_member_uids)
+        except Exception as e:
+            logger.warning("Unable to repair chunk. Content hash: %s, Error: %s", content_hash, e)
+            return False
+        # Failed copies that were not replaced are still lost.
+        failed_member_uids = self.failed_scrubs.pop(content_hash, set()) & set(map(str, mist_network_data_file.Holders()))
+        if failed_member_uids:
+            self.failed_scrubs[content_hash] = failed_member_uids
+        self._Throttle(transferred)
+        return True
+
+    def _Throttle(self, size):
+        """Waits until size more bytes keep repairs within their bandwidth."""
+        if self.bandwidth <= 0:
+            return
+        self._send_time = max(self._send_time, time.time()) + float(size) / self.bandwidth
+        self._stop.wait(max(0, self._send_time - time.time()))
@@ -0,0 +1,197 @@
+import time
+import heapq
+import random
+import threading
+import collections
+import logging
+
+import journal
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistRetry(object):
+    """An operation waiting on a MistRetryQueue to be tried again."""
+
+    def __init__(self, operation, member_uid, item):
+        self.operation = operation
+        self.member_uid = member_uid
+        self.item = item
+        self.attempts = 0
+        # None while the operation is being tried.
+        self.due_time = None
+
+    def Key(self):
+        return (self.operation, self.member_uid, self.item)
+
+
+class MistRetryQueue(object):
+    """Mist Retry Queue class
+
+    Tries failed operations again until they succeed, backing off
+    exponentially with jitter between attempts. Every operation has a
+    handler, which is called with the member the operation is for and a
+    list of items and returns whether each one succeeded. When an operation
+    is due, up to batch_size - 1 other items for the same member that are
+    due within base_delay are tried with it.
+
+    A single thread runs every retry, and pending operations are kept in a
+    journal so that they survive a restart.
+    """
+
+    def __init__(self, path, handlers, base_delay=settings.RETRY_BASE_DELAY, max_delay=settings.RETRY_MAX_DELAY, batch_size=settings.RETRY_BATCH_SIZE):
+        self.handlers = handlers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.pending = {}
+        # Keys of the pending operations by operation and member.
+        self._groups = collections.defaultdict(collections.OrderedDict)
+        # (due time, key) of every pending operation. Entries whose due time
+        # no longer matches the operation are skipped.
+        self._heap = []
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+        self._journal = journal.MistJournal(path)
+
+    def Start(self):
+        with self._lock:
+            (snapshot, records) = self._journal.Load()
+            self.pending = snapshot or {}
+            for (operation, key, retry) in records:
+                if operation == "set":
+                    self.pending[key] = retry
+                else:
+                    self.pending.pop(key, None)
+            for (key, retry) in self.pending.items():
+                if retry.due_time is None:
+                    retry.due_time = time.time()
+                self._groups[key[:2]][key] = True
+                heapq.heappush(self._heap, (retry.due_time, key))
+        if snapshot is None or records:
+            self._Compact()
+        if self.pending:
+            logger.info("Loaded pending retries. Count: %s", len(self.pending))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._Work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        with self._condition:
+            self._stop.set()
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._Compact()
+        self._journal.Close()
+
+    def _Compact(self):
+        self._journal.Compact(lambda: self.pending, self._lock)
+
+    def _Backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _Schedule(self, retry, delay):
+        # Called with the lock held.
+        retry.due_time = time.time() + delay
+        heapq.heappush(self._heap, (retry.due_time, retry.Key()))
+        self._condition.notify()
+
+    def Add(self, operation, member_uid, item):
+        """Tries operation on item for member_uid again later, unless it is already pending."""
+        if operation not in self.handlers:
+            raise ValueError("Unknown operation: %s" % operation)
+        retry = MistRetry(operation, member_uid, item)
+        key = retry.Key()
+        with self._condition:
+            if key in self.pending:
+                return
+            self.pending[key] = retry
+            self._groups[key[:2]][key] = True
+            self._journal.Append(("set", key, retry))
+            self._Schedule(retry, self._Backoff(0))
+
+    def IsPending(self, operation, member_uid, item):
+        return (operation, member_uid, item) in self.pending
+
+    def Wake(self, member_uid):
+        """Makes every operation pending for member_uid due now, for when it is back."""
+        with self._condition:
+            for (group, keys) in self._groups.items():
+                if group[1] != member_uid:
+                    continue
+                for key in keys:
+                    if self.pending[key].due_time is not None:
+                        self._Schedule(self.pending[key], 0)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _NextBatch(self):
+        """Waits until an operation is due and returns it with others for the same member."""
+        with self._condition:
+            while not self._stop.is_set():
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                (due_time, key) = self._heap[0]
+                retry = self.pending.get(key)
+                if retry is None or retry.due_time != due_time:
+                    heapq.heappop(self._heap)
+                    continue
+                if due_time > time.time():
+                    self._condition.wait(due_time - time.time())
+                    continue
+                heapq.heappop(self._heap)
+                batch = [retry]
+                for other_key in self._groups[key[:2]]:
+                    if len(batch) >= self.batch_size:
+                        break
+                    other = self.pending[other_key]
+                    if other is not retry and other.due_time is not None and other.due_time <= due_time + self.base_delay:
+                        batch.append(other)
+                for retry in batch:
+                    retry.due_time = None
+                return batch
+        return None
+
+    def _Work(self):
+        while True:
+            batch = self._NextBatch()
+            if batch is None:
+                return
+            (operation, member_uid) = (batch[0].operation, batch[0].member_uid)
+            try:
+                results = self.handlers[operation](member_uid, [retry.item for retry in batch])
+            except Exception as e:
+                logger.warning("Retry failed. Operation: %s, Member uid: %s, Error: %s", operation, member_uid, e)
+                results = []
+            results = list(results) + [False] * (len(batch) - len(results))
+
+            with self._condition:
+                with self._journal.Batch():
+                    for (retry, succeeded) in zip(batch, results):
+                        key = retry.Key()
+                        if succeeded:
+                            del self.pending[key]
+                            del self._groups[key[:2]][key]
+                            if not self._groups[key[:2]]:
+                                del self._groups[key[:2]]
+                            self._journal.Append(("delete", key, None))
+                        else:
+                            retry.attempts += 1
+                            self._Schedule(retry, self._Backoff(retry.attempts))
+                            self._journal.Append(("set", key, retry))
+            failed_count = len(batch) - sum(bool(succeeded) for succeeded in results)
+            if failed_count:
+                logger.info("Retries failed. Operation: %s, Member uid: %s, Failed: %s of %s", operation, member_uid, failed_count, len(batch))
+            if self._journal.NeedsCompaction():
+                self._Compact()
@@ -0,0 +1,91 @@
+import bisect
+import hashlib
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistHashRing(object):
+    """Mist Hash Ring class
+
+    Consistent hash ring over member uids. Every member is placed on the
+    ring at virtual_nodes points and a key is owned by the members found
+    walking clockwise from the key's hash. Adding or removing one of N
+    members only changes the owners of about 1/N of the keys, and any node
+    that knows the members computes the same owners.
+    """
+
+    def __init__(self, member_uids=(), virtual_nodes=settings.RING_VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.member_uids = set()
+        self._points = []
+        self._point_owners = {}
+        # Every member placed at each point, as points can be shared.
+        self._point_members = {}
+        for member_uid in member_uids:
+            self.Add(member_uid)
+
+    @staticmethod
+    def _Hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def _MemberPoints(self, member_uid):
+        return [MistHashRing._Hash("%s#%s" % (member_uid, i)) for i in xrange(self.virtual_nodes)]
+
+    def Add(self, member_uid):
+        member_uid = str(member_uid)
+        if member_uid in self.member_uids:
+            return
+        self.member_uids.add(member_uid)
+        for point in self._MemberPoints(member_uid):
+            # A point shared by two members goes to the smaller uid so that
+            # every ring with the same members agrees.
+            if point in self._point_members:
+                self._point_members[point].add(member_uid)
+                self._point_owners[point] = min(self._point_owners[point], member_uid)
+            else:
+                self._point_members[point] = set([member_uid])
+                self._point_owners[point] = member_uid
+                bisect.insort(self._points, point)
+
+    def Remove(self, member_uid):
+        member_uid = str(member_uid)
+        if member_uid not in self.member_uids:
+            return
+        self.member_uids.remove(member_uid)
+        for point in self._MemberPoints(member_uid):
+            point_members = self._point_members.get(point)
+            if point_members is None or member_uid not in point_members:
+                continue
+            point_members.remove(member_uid)
+            # Hand a shared point back to any remaining member on it.
+            if point_members:
+                self._point_owners[point] = min(point_members)
+            else:
+                del self._point_members[point]
+                del self._point_owners[point]
+                del self._points[bisect.bisect_left(self._points, point)]
+
+    def Owners(self, key, count):
+        """Returns the uids of up to count distinct members that own key, in order."""
+        owners = []
+        if not self._points:
+            return owners
+        start = bisect.bisect(self._points, MistHashRing._Hash(str(key)))
+        for i in xrange(len(self._points)):
+            owner = self._point_owners[self._points[(start + i) % len(self._points)]]
+            if owner not in owners:
+                owners.append(owner)
+                if len(owners) >= count:
+                    break
+        return owners
+
+    def __contains__(self, member_uid):
+        return str(member_uid) in self.member_uids
+
+    def __len__(self):
+        return len(self.member_uids)
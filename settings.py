@@ -1,5 +1,109 @@
+import os
 import hashlib
+import tempfile
+import multiprocessing
 
 
 PASSWORD = "ChangeThisPlease"
 ENCRYPTION_KEY = hashlib.sha256(PASSWORD).digest()
+
+# Send chunk data straight to peers and only use the network for discovery.
+DIRECT_PEER_TRANSFER = True
+
+# Chunk transfers share a bounded pool of workers. Producers block once
+# TRANSFER_QUEUE_SIZE transfers are waiting.
+TRANSFER_WORKERS = 8
+TRANSFER_QUEUE_SIZE = 16
+TRANSFER_WORKERS_PER_PEER = 4
+
+# Blocks are compressed with COMPRESSION ("none", "zlib" or "lzma") at
+# COMPRESSION_LEVEL before they are encrypted. Blocks whose first
+# COMPRESSION_SAMPLE_SIZE bytes do not shrink by COMPRESSION_MIN_SAVING
+# are stored uncompressed.
+COMPRESSION = "zlib"
+COMPRESSION_LEVEL = 6
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_SAVING = 0.1
+
+# Blocks are encrypted and decrypted on CRYPTO_WORKERS processes, one per
+# core by default. With 1, they are encrypted in the calling thread.
+CRYPTO_WORKERS = multiprocessing.cpu_count()
+
+# Members prove they still hold data by returning one randomly chosen
+# block of PROOF_BLOCK_SIZE bytes along with its Merkle proof.
+PROOF_BLOCK_SIZE = 4096
+
+# Chunks with copies on members that left the network, or on members that
+# fail to prove they hold them, get new copies on other members, fewest
+# surviving copies first. Every REPAIR_INTERVAL seconds chunks are proven
+# at up to SCRUB_RATE chunks a second, then repaired sending at most
+# REPAIR_BANDWIDTH bytes a second. A rate or bandwidth of 0 turns the
+# limit off, and for SCRUB_RATE scrubbing as well.
+REPAIR_INTERVAL = 60
+SCRUB_RATE = 10
+REPAIR_BANDWIDTH = 4 * 1024 * 1024
+
+# Deletes that members could not take, and chunks that could not be stored
+# or repaired, are tried again after RETRY_BASE_DELAY seconds, backing off
+# up to RETRY_MAX_DELAY seconds. Up to RETRY_BATCH_SIZE retries for the
+# same member are sent together.
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 30 * 60
+RETRY_BATCH_SIZE = 100
+
+# File system events are synced in batches of up to WATCHDOG_BATCH_SIZE
+# events, collected for at most WATCHDOG_BATCH_WINDOW seconds. Up to
+# WATCHDOG_BATCH_WORKERS files of a batch are synced at once and the index
+# is committed once per batch.
+WATCHDOG_BATCH_WINDOW = 0.5
+WATCHDOG_BATCH_SIZE = 1000
+WATCHDOG_BATCH_WORKERS = 8
+
+# Chunks are either replicated in full or erasure coded. Erasure coded
+# chunks are split into ERASURE_DATA_FRAGMENTS fragments plus
+# ERASURE_PARITY_FRAGMENTS parity fragments on distinct members, and any
+# ERASURE_DATA_FRAGMENTS of them are enough to read the chunk.
+REPLICATED_STORAGE = "replicated"
+ERASURE_CODED_STORAGE = "erasure_coded"
+STORAGE_MODE = REPLICATED_STORAGE
+ERASURE_DATA_FRAGMENTS = 4
+ERASURE_PARITY_FRAGMENTS = 2
+
+# Every chunk is stored on REPLICATION_FACTOR distinct members, or on all
+# members if there are fewer.
+REPLICATION_FACTOR = 2
+
+# A read is sent to another replica if the first has not answered within
+# twice its usual latency, and never sooner than HEDGED_READ_DELAY seconds.
+HEDGED_READ_DELAY = 0.1
+
+# Reads retrieve READ_AHEAD_WINDOW chunks at a time, the next ones while
+# the current ones are being returned.
+READ_AHEAD_WINDOW = 4
+
+# New chunks of a file are stored in batches of STORE_BATCH_SIZE bytes,
+# with one request to every member for all of its share of a batch.
+STORE_BATCH_SIZE = 8 * 1024 * 1024
+
+# Chunks retrieved from the network are cached locally, in memory and, when
+# CHUNK_CACHE_DISK_SIZE is above 0, on disk. Sizes are in bytes and a size
+# of 0 turns that tier off.
+CHUNK_CACHE_MEMORY_SIZE = 64 * 1024 * 1024
+CHUNK_CACHE_DISK_SIZE = 0
+CHUNK_CACHE_PATH = os.path.join(tempfile.gettempdir(), "mist_chunk_cache")
+
+# Members report their free space and outstanding requests every
+# LOAD_REPORT_INTERVAL seconds. The network uses the reports to place new
+# data with PLACEMENT_POLICY, one of placement.PLACEMENT_POLICIES, and
+# avoids members with less than PLACEMENT_MIN_FREE_SPACE bytes free.
+LOAD_REPORT_INTERVAL = 5
+PLACEMENT_POLICY = "load_aware"
+PLACEMENT_MIN_FREE_SPACE = 64 * 1024 * 1024
+
+# With the consistent_hash placement policy, every member sits on a hash
+# ring at RING_VIRTUAL_NODES points. Clients refresh their copy of the ring
+# every RING_REFRESH_INTERVAL seconds, and members check every
+# REBALANCE_INTERVAL seconds whether they hold data they no longer own.
+RING_VIRTUAL_NODES = 64
+RING_REFRESH_INTERVAL = 30
+REBALANCE_INTERVAL = 30
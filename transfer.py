@@ -0,0 +1,199 @@
+import Queue
+import threading
+import collections
+import logging
+
+import settings
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistTransferTask(object):
+    """A transfer queued on a MistTransferExecutor."""
+
+    def __init__(self, func, args, kwargs):
+        self.result = None
+        self.exception = None
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+
+    def _Run(self):
+        try:
+            self.result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            logger.exception("Transfer failed.")
+            self.exception = e
+        finally:
+            self._func = self._args = self._kwargs = None
+            self._done.set()
+
+    def Done(self):
+        return self._done.is_set()
+
+    def Wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class MistTransferExecutor(object):
+    """Mist Transfer Executor
+
+    Runs chunk transfers on a fixed set of worker threads. Submit blocks
+    once the queue is full so that producers cannot get ahead of the
+    network, and PeerSlot limits how many transfers hit a single peer.
+    """
+
+    def __init__(self, workers=settings.TRANSFER_WORKERS, queue_size=settings.TRANSFER_QUEUE_SIZE, workers_per_peer=settings.TRANSFER_WORKERS_PER_PEER):
+        self.workers = workers
+        self.workers_per_peer = workers_per_peer
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._peer_semaphores = collections.defaultdict(lambda: threading.BoundedSemaphore(self.workers_per_peer))
+        self._lock = threading.Lock()
+
+    def _StartWorkers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._Work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _Work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task._Run()
+            finally:
+                self._queue.task_done()
+
+    def Submit(self, func, *args, **kwargs):
+        return self.SubmitTask(MistTransferTask(func, args, kwargs))
+
+    def SubmitTask(self, task):
+        """Queues a task made beforehand, which can be waited on before it is queued."""
+        if len(self._threads) < self.workers:
+            self._StartWorkers()
+        self._queue.put(task)
+        return task
+
+    def Prefetch(self, func, items, window=settings.READ_AHEAD_WINDOW):
+        """Yields func(item) for each item in order.
+
+        Up to window calls run ahead on the workers while earlier results
+        are consumed. An exception raised by a call is raised here.
+        """
+        items = iter(items)
+        tasks = collections.deque()
+        for item in items:
+            tasks.append(self.Submit(func, item))
+            if len(tasks) >= window:
+                break
+        while tasks:
+            task = tasks.popleft()
+            task.Wait()
+            for item in items:
+                tasks.append(self.Submit(func, item))
+                break
+            if task.exception:
+                raise task.exception
+            yield task.result
+
+    def PeerSlot(self, peer_address):
+        with self._lock:
+            return self._peer_semaphores[peer_address]
+
+    def Pending(self):
+        return self._queue.qsize()
+
+
+def RunConcurrently(func, items, workers=None):
+    """Calls func on every item and waits for all.
+
+    Calls run on up to workers threads at once, or each on its own thread
+    if workers is None. Returns the finished MistTransferTask of every
+    call, in order.
+    """
+    tasks = [MistTransferTask(func, (item,), {}) for item in items]
+    pending = Queue.Queue()
+    for task in tasks:
+        pending.put(task)
+
+    def Work():
+        while True:
+            try:
+                task = pending.get_nowait()
+            except Queue.Empty:
+                return
+            task._Run()
+
+    thread_count = len(tasks) if workers is None else min(workers, len(tasks))
+    for i in xrange(thread_count):
+        thread = threading.Thread(target=Work)
+        thread.daemon = True
+        thread.start()
+    for task in tasks:
+        task.Wait()
+    return tasks
+
+
+def _PutHedgedResult(results, func, index, item):
+    try:
+        results.put((index, func(item)))
+    except Exception as e:
+        logger.warning("Hedged call failed. Error: %s", e)
+        results.put((index, None))
+
+
+def HedgeMany(func, items, count, delay):
+    """Returns the first count results of func(item) that are not None.
+
+    Items are tried in order with count calls in flight. Another item is
+    started as soon as a call fails, or as a hedge once no call has
+    answered for delay seconds. Returns a dict of item index to result,
+    which is short if too many calls fail.
+    """
+    items = list(items)
+    results = Queue.Queue()
+
+    def Start(index):
+        thread = threading.Thread(target=_PutHedgedResult, args=(results, func, index, items[index]))
+        thread.daemon = True
+        thread.start()
+
+    done = {}
+    started = 0
+    pending = 0
+    while len(done) < count:
+        while started < len(items) and pending < count - len(done):
+            Start(started)
+            started += 1
+            pending += 1
+        if not pending:
+            break
+        try:
+            (index, result) = results.get(timeout=delay if started < len(items) else None)
+        except Queue.Empty:
+            Start(started)
+            started += 1
+            pending += 1
+            continue
+        pending -= 1
+        if result is not None:
+            done[index] = result
+    return done
+
+
+def Hedge(func, items, delay):
+    """Returns the first result of func(item) that is not None, or None.
+
+    See HedgeMany.
+    """
+    results = HedgeMany(func, items, 1, delay)
+    return results.values()[0] if results else None
+
+
+shared_transfer_executor = MistTransferExecutor()
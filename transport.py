@@ -0,0 +1,290 @@
+import json
+import time
+import struct
+import select
+import socket
+import httplib
+import urlparse
+import threading
+import collections
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MistTransportError(Exception):
+    pass
+
+
+class MistRequestSentError(MistTransportError):
+    """A request was sent but no response came back, so the peer may have acted on it."""
+    pass
+
+
+class MistConnectionPool(object):
+    """Mist Connection Pool
+
+    Keeps idle keep-alive HTTP connections per address so that consecutive
+    requests to the same peer reuse a connection and its handler thread.
+    """
+
+    DEFAULT_MAX_IDLE_CONNECTIONS = 8
+    DEFAULT_IDLE_TIMEOUT = 60
+    # Requests that can be sent twice without changing what they do.
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
+
+    def __init__(self, max_idle_connections=DEFAULT_MAX_IDLE_CONNECTIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None):
+        self.max_idle_connections = max_idle_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle_connections = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def _IsHealthy(self, connection, released_at):
+        if time.time() - released_at > self.idle_timeout or connection.sock is None:
+            return False
+        try:
+            # An idle keep-alive socket only becomes readable once the peer
+            # has closed it.
+            return not select.select([connection.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def _Acquire(self, netloc):
+        with self._lock:
+            idle_connections = self._idle_connections[netloc]
+            while idle_connections:
+                (connection, released_at) = idle_connections.pop()
+                if self._IsHealthy(connection, released_at):
+                    return (connection, True)
+                connection.close()
+        return (httplib.HTTPConnection(netloc, timeout=self.timeout), False)
+
+    def _Release(self, netloc, connection):
+        with self._lock:
+            idle_connections = self._idle_connections[netloc]
+            if len(idle_connections) < self.max_idle_connections:
+                idle_connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def Request(self, address, method, path, body=None, headers=None):
+        netloc = urlparse.urlparse(address).netloc
+        while True:
+            (connection, reused) = self._Acquire(netloc)
+            sent = False
+            try:
+                connection.request(method, path, body, headers or {})
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                # The peer may have dropped an idle connection just as it
+                # was reused, so retry those on a fresh connection. Other
+                # requests, like stores, are only retried if they were not
+                # sent, as the peer may already have acted on them.
+                if reused and (not sent or method in MistConnectionPool.IDEMPOTENT_METHODS):
+                    continue
+                if sent:
+                    raise MistRequestSentError("No response to request. Address: %s, Error: %s" % (address, e))
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._Release(netloc, connection)
+            return (response.status, data)
+
+    def CloseAll(self):
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for (connection, released_at) in idle_connections:
+                    connection.close()
+            self._idle_connections.clear()
+
+
+shared_connection_pool = MistConnectionPool()
+
+
+# Every item of a batch body is its length followed by its bytes. A length
+# of -1 stands for an item that is missing.
+ITEM_HEADER = "<q"
+
+
+def PackItems(items):
+    """Frames a list of byte strings, any of which may be None, into one body."""
+    return "".join(struct.pack(ITEM_HEADER, -1) if item is None else struct.pack(ITEM_HEADER, len(item)) + item for item in items)
+
+
+def UnpackItems(body):
+    items = []
+    offset = 0
+    header_size = struct.calcsize(ITEM_HEADER)
+    while offset < len(body):
+        if offset + header_size > len(body):
+            raise MistTransportError("Truncated batch body.")
+        (length,) = struct.unpack_from(ITEM_HEADER, body, offset)
+        offset += header_size
+        if length < 0:
+            items.append(None)
+            continue
+        if offset + length > len(body):
+            raise MistTransportError("Truncated batch body.")
+        items.append(body[offset:offset + length])
+        offset += length
+    return items
+
+
+class MistDataTransportClient(object):
+    """Mist Data Transport Client
+
+    Moves chunk bytes as raw HTTP bodies so that they are not base64 encoded
+    into JSON-RPC requests. Control messages still go over JSON-RPC. Many
+    chunks can be stored or retrieved in a single request, with a result
+    for each of them.
+    """
+
+    DATA_PATH = "/data"
+    MANY_DATA_PATH = "/data_many"
+    CONTENT_TYPE = "application/octet-stream"
+
+    def __init__(self, address, connection_pool=None):
+        self.address = address
+        self.connection_pool = connection_pool or shared_connection_pool
+
+    def _Request(self, method, path, body=None):
+        headers = {"Content-Type": MistDataTransportClient.CONTENT_TYPE}
+        return self.connection_pool.Request(self.address, method, path, body, headers)
+
+    def _DataPath(self, uids, data_path=DATA_PATH):
+        return "/".join((data_path,) + tuple(str(uid) for uid in uids))
+
+    def StoreData(self, data, *uids):
+        (status, body) = self._Request("PUT", self._DataPath(uids), data)
+        if status != httplib.OK:
+            raise MistTransportError("Unable to store data. Address: %s, Status: %s, Error: %s" % (self.address, status, body))
+        return json.loads(body)
+
+    def RetrieveData(self, *uids):
+        (status, body) = self._Request("GET", self._DataPath(uids))
+        if status != httplib.OK:
+            logger.error("Unable to retrieve data. Address: %s, Status: %s", self.address, status)
+            return None
+        return body
+
+    def StoreManyData(self, datas, *uids):
+        """Stores every data in one request.
+
+        Returns the response for each data, which holds an error_message
+        instead if that data could not be stored.
+        """
+        (status, body) = self._Request("PUT", self._DataPath(uids, MistDataTransportClient.MANY_DATA_PATH), PackItems(datas))
+        if status != httplib.OK:
+            raise MistTransportError("Unable to store data. Address: %s, Status: %s, Error: %s" % (self.address, status, body))
+        responses = json.loads(body)
+        if len(responses) != len(datas):
+            raise MistTransportError("Wrong number of responses. Address: %s, Expected: %s, Received: %s" % (self.address, len(datas), len(responses)))
+        return responses
+
+    def RetrieveManyData(self, data_uids, *uids):
+        """Returns the data of every data uid, or None for the data that could not be retrieved."""
+        (status, body) = self.connection_pool.Request(self.address, "POST", self._DataPath(uids, MistDataTransportClient.MANY_DATA_PATH), json.dumps(map(str, data_uids)), {"Content-Type": "application/json"})
+        if status != httplib.OK:
+            logger.error("Unable to retrieve data. Address: %s, Status: %s", self.address, status)
+            return [None] * len(data_uids)
+        datas = UnpackItems(body)
+        if len(datas) != len(data_uids):
+            logger.error("Wrong number of data retrieved. Address: %s, Expected: %s, Received: %s", self.address, len(data_uids), len(datas))
+            return [None] * len(data_uids)
+        return datas
+
+
+class MistDataTransportRequestHandlerMixin(object):
+    """Serves raw chunk bytes next to the JSON-RPC methods of a handler.
+
+    Handlers implement StoreDataRequest(data, *uids), which returns a
+    JSON-able response, and RetrieveDataRequest(*uids), which returns the
+    data or None. Batches are served one item at a time with them unless
+    StoreManyDataRequest and RetrieveManyDataRequest are overridden.
+    """
+
+    # Outlive the idle timeout of client pools so that a pooled connection
+    # is never closed under a client that is about to reuse it.
+    timeout = MistConnectionPool.DEFAULT_IDLE_TIMEOUT * 2
+
+    def _IsDataPath(self, data_path=MistDataTransportClient.DATA_PATH):
+        return self.path == data_path or self.path.startswith(data_path + "/")
+
+    def _DataPathUids(self, data_path=MistDataTransportClient.DATA_PATH):
+        return filter(None, self.path[len(data_path) + 1:].split("/"))
+
+    def _SendBody(self, content_type, body):
+        self.send_response(httplib.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def StoreManyDataRequest(self, datas, *uids):
+        responses = []
+        for data in datas:
+            try:
+                responses.append(self.StoreDataRequest(data, *uids))
+            except Exception as e:
+                logger.warning("Unable to store data. Error: %s", e)
+                responses.append({"error_message": str(e)})
+        return responses
+
+    def RetrieveManyDataRequest(self, data_uids, *uids):
+        datas = []
+        for data_uid in data_uids:
+            try:
+                datas.append(self.RetrieveDataRequest(*(uids + (data_uid,))))
+            except Exception as e:
+                logger.warning("Unable to retrieve data. Error: %s", e)
+                datas.append(None)
+        return datas
+
+    def do_PUT(self):
+        many = self._IsDataPath(MistDataTransportClient.MANY_DATA_PATH)
+        if not many and not self._IsDataPath():
+            return self.send_error(httplib.NOT_FOUND)
+
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if many:
+                response = self.StoreManyDataRequest(UnpackItems(data), *self._DataPathUids(MistDataTransportClient.MANY_DATA_PATH))
+            else:
+                response = self.StoreDataRequest(data, *self._DataPathUids())
+        except Exception as e:
+            logger.exception("Unable to store data.")
+            return self.send_error(httplib.SERVICE_UNAVAILABLE, str(e))
+        self._SendBody("application/json", json.dumps(response))
+
+    def do_GET(self):
+        if not self._IsDataPath():
+            return super(MistDataTransportRequestHandlerMixin, self).do_GET()
+
+        try:
+            data = self.RetrieveDataRequest(*self._DataPathUids())
+        except Exception as e:
+            logger.error("Unable to retrieve data. Error: %s", e)
+            return self.send_error(httplib.NOT_FOUND, str(e))
+        if data is None:
+            return self.send_error(httplib.NOT_FOUND, "Unable to retrieve data.")
+        self._SendBody(MistDataTransportClient.CONTENT_TYPE, data)
+
+    def do_POST(self):
+        if not self._IsDataPath(MistDataTransportClient.MANY_DATA_PATH):
+            return super(MistDataTransportRequestHandlerMixin, self).do_POST()
+
+        data_uids = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        try:
+            datas = self.RetrieveManyDataRequest(data_uids, *self._DataPathUids(MistDataTransportClient.MANY_DATA_PATH))
+        except Exception as e:
+            logger.error("Unable to retrieve data. Error: %s", e)
+            return self.send_error(httplib.NOT_FOUND, str(e))
+        self._SendBody(MistDataTransportClient.CONTENT_TYPE, PackItems(datas))